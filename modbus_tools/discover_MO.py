@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+discover_MO.py
+
+découverte des ID modbus des micro onduleurs (MO) APSystems déclarés dans un ECU-R
+les autres scripts demandent de connaître les ID modbus des MO (-u 1,11,12). Les chercher un par un à la main, avec le timeout
+de 5s des autres scripts, prend plusieurs minutes. Ce script :
+  . interroge les ID candidats en parallèle (au plus WORKERS connexions simultanées), avec un timeout court : un ID sans MO
+    ne répond pas, ou répond en erreur
+  . lit le numéro de série et le modèle de chaque MO qui répond (ainsi que fabricant, version et ID modbus, pour le cache des MO)
+  . écrit l'inventaire (ID modbus -> numéro de série, modèle) dans un fichier JSON, utilisable par read_MO.py, read_all_MO.py
+    et le démon de régulation (option --inventory), et alimente le cache des MO (voir mo_metadata.py)
+
+syntaxe :
+  discover_MO.py -h : pour de l'aide
+  discover_MO.py 192.168.1.120 : recherche des MO d'ID modbus 1 à 32 sur l'ECU à l'adresse IP 192.168.1.120
+  discover_MO.py 192.168.1.120 -r 1-247 -j 8 : recherche sur toute la plage modbus, avec 8 connexions simultanées
+  read_all_MO.py -i mo_inventory.json : interrogation de tous les MO de l'inventaire
+"""
+
+import argparse
+import logging
+import queue
+import threading
+import time
+
+from pymodbus.client import ModbusTcpClient
+
+from mo_metadata import DEFAULT_INVENTORY_FILE, DEFAULT_METADATA_FILE, METADATA_REGISTERS, MetadataCache, read_register, save_inventory
+
+DEFAULT_MODBUS_IP = "192.168.1.120"
+DEFAULT_MODBUS_PORT = 502
+# plage des ID modbus interrogés par défaut
+DEFAULT_UNIT_RANGE = "1-32"
+# timeout en secondes d'une requête. L'ECU répond en 165ms environ : 1s laisse de la marge, sans attendre 5s par ID absent
+DEFAULT_TIMEOUT_S = 1.0
+# nombre de connexions modbus simultanées. L'ECU supporte mal d'être interrogé par trop de clients en même temps
+DEFAULT_WORKERS = 4
+
+
+def parse_units(text):
+    """'1-32,40,50-60' -> liste triée des ID modbus (1 à 247)"""
+    units = set()
+    for item in text.split(","):
+        first, _, last = item.strip().partition("-")
+        units.update(range(int(first), int(last or first) + 1))
+    if not units or min(units) < 1 or max(units) > 247:
+        raise ValueError(f"plage d'ID modbus invalide : {text}")
+    return sorted(units)
+
+
+def probe_worker(host, port, timeout, pending, found, lock):
+    """Interroge les ID de la file pending sur une connexion dédiée. Les MO trouvés sont ajoutés à found (ID -> infos)."""
+    client = ModbusTcpClient(host=host, port=port, timeout=timeout, retries=0)
+    try:
+        while True:
+            try:
+                unit = pending.get_nowait()
+            except queue.Empty:
+                return
+            serial = read_register(client, unit, "serialnumber")
+            if serial is None:
+                # pas de réponse : la connexion est refaite, pour ne pas recevoir une réponse tardive à la requête suivante
+                client.close()
+                logging.debug(f"ID {unit} : pas de MO")
+                continue
+            values = {key: read_register(client, unit, key) for key in METADATA_REGISTERS if key != "serialnumber"}
+            values["serialnumber"] = serial
+            logging.info(f"ID {unit} : MO {values.get('model')} numéro de série {serial}")
+            with lock:
+                found[unit] = values
+    finally:
+        client.close()
+
+
+def discover(host, port, units, timeout=DEFAULT_TIMEOUT_S, workers=DEFAULT_WORKERS):
+    """Interroge les ID modbus units en parallèle. Retourne {ID modbus: infos statiques} des MO qui ont répondu."""
+    pending, found, lock = queue.Queue(), {}, threading.Lock()
+    for unit in units:
+        pending.put(unit)
+    threads = [threading.Thread(target=probe_worker, args=(host, port, timeout, pending, found, lock), daemon=True)
+               for _ in range(max(1, min(workers, len(units))))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return found
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("host", type=str, nargs='?', default = DEFAULT_MODBUS_IP, help=f"Modbus TCP address. default {DEFAULT_MODBUS_IP}")
+    argparser.add_argument("-p", "--port", type=int, default = DEFAULT_MODBUS_PORT, help=f"Modbus TCP port. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-r", "--range", type=str, default=DEFAULT_UNIT_RANGE, help=f"ID modbus à interroger, par exemple 1-32,40. default {DEFAULT_UNIT_RANGE}")
+    argparser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS, help=f"nombre de connexions modbus simultanées. default {DEFAULT_WORKERS}")
+    argparser.add_argument("-t", "--timeout", type=float, default=DEFAULT_TIMEOUT_S, help=f"timeout d'une requête, en secondes. default {DEFAULT_TIMEOUT_S}")
+    argparser.add_argument("-o", "--output", type=str, default=DEFAULT_INVENTORY_FILE, help=f"fichier d'inventaire produit. default {DEFAULT_INVENTORY_FILE}")
+    argparser.add_argument("-mc", "--metadata-cache", type=str, default=DEFAULT_METADATA_FILE, help=f"fichier du cache des informations statiques des MO, chaine vide pour ne pas l'alimenter. default {DEFAULT_METADATA_FILE}")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="logs détaillés (un message par ID interrogé)")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    try:
+        units = parse_units(args.range)
+    except ValueError as e:
+        argparser.error(str(e))
+
+    print(f"Recherche des MO de {args.host}:{args.port}, ID modbus {args.range}, {args.workers} connexions simultanées")
+    start = time.monotonic()
+    found = discover(args.host, args.port, units, args.timeout, args.workers)
+    print(f"{len(found)} MO trouvé(s) sur {len(units)} ID interrogés, en {time.monotonic() - start:.1f}s")
+    if not found:
+        print("Aucun MO : vérifier l'adresse de l'ECU, ou augmenter le timeout (-t)")
+        return
+    for unit in sorted(found):
+        print(f"  ID {unit:3d} : {found[unit].get('model')}, numéro de série {found[unit]['serialnumber']}")
+
+    save_inventory(args.output, args.host, args.port, {unit: {"serialnumber": found[unit]["serialnumber"], "model": found[unit].get("model")} for unit in found})
+    print(f"Inventaire écrit dans {args.output}")
+    if args.metadata_cache:
+        cache = MetadataCache(args.metadata_cache)
+        for unit, values in found.items():
+            cache.store(args.host, args.port, unit, values)
+    print(f"read_all_MO.py -i {args.output} : interrogation de ces MO (ou read_all_MO.py {args.host} -u {','.join(str(unit) for unit in sorted(found))})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+ecu_emulator.py
+
+émulateur d'un ECU-R APSystems et de ses micro onduleurs (MO) DS3, pour les essais et les mesures de performance sans matériel
+basé sur le serveur modbus de pymodbus. Il reproduit :
+  . la table de registres SunSpec lue par read_MO.py et read_all_MO.py (40000 à 40251), pour chaque MO
+  . les registres de contrôle 40188 (Conn), 40189 (power_limit) et 40193 (WMaxLim_Ena), globaux à l'installation : une écriture
+    sur un MO s'applique à tous
+  . la lecture de power_limit à 30.0% (300) quand l'ECU a perdu la valeur : au démarrage, chaque nuit, ou sur demande
+  . la coupure de la connexion modbus après environ 5s sans requête, et le temps de réponse modbus (environ 165ms)
+  . le rafraichissement des infos des MO par l'ECU toutes les 5mn seulement
+  . la dynamique des MO : temps mort (2s en modbus, 10s en http) puis réponse du premier ordre, la production disponible
+    suivant un profil d'ensoleillement (ciel clair, nuageux, ou fichier)
+  . l'URL http /index.php/configuration/set_maxpower, qui ne traite que 2 requêtes en parallèle, chacune en 2.3s environ
+Il peut tourner en temps réel, ou en temps accéléré (option --speed) : l'horloge de l'installation (ensoleillement, dynamique
+des MO, nuits, rafraichissement 5mn) va alors plus vite ; les délais protocolaires (modbus, http) restent en temps réel.
+
+Pour les essais, il expose aussi sur son port http :
+  . GET /emulator/state : état de l'installation en JSON (production, power_limit effectif, défauts en cours, ...)
+  . POST /emulator/faults : injection de défauts en JSON, par ex. {"offline": true} ou {"hang_s": 10} (voir la classe Faults)
+
+syntaxe :
+  ecu_emulator.py -h : pour de l'aide
+  ecu_emulator.py : émulation de 3 MO (ID modbus 1, 11, 12), modbus sur le port 5502, http sur le port 8080
+  ecu_emulator.py --speed 60 --start 10:00 --profile cloudy : une heure de l'installation par minute, à partir de 10h, ciel nuageux
+  read_all_MO.py 127.0.0.1 -p 5502 -u 1,11,12
+  solar_power_regulator.py --modbus-port 5502 127.0.0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import struct
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from pymodbus.datastore import ModbusBaseSlaveContext, ModbusServerContext
+from pymodbus.server import ModbusTcpServer
+
+DEFAULT_LISTEN_HOST = "127.0.0.1"
+DEFAULT_MODBUS_PORT = 5502   # le port 502 nécessite les droits root
+DEFAULT_HTTP_PORT = 8080
+
+# Les MO de l'installation : ID modbus, numéro de série, décalage en heures du pic de production (orientation : <0 Est, >0 Ouest)
+INVERTERS = [
+    (1,  "704000162664", -1.5),
+    (11, "704000587038",  1.5),
+    (12, "704000585573",  1.5),
+]
+MO_RATED_POWER_W = 880       # DS3 : 880W, 2 panneaux
+MO_PANEL_MAX_W = 500         # valeur maximum de maxpower (http), par panneau
+
+# --- comportement de l'ECU ---
+MODBUS_RESPONSE_DELAY_S = 0.165    # durée mesurée d'une requête modbus
+MODBUS_IDLE_DISCONNECT_S = 5       # l'ECU coupe la connexion modbus après ce délai sans requête
+BUGGY_LIMIT_PERMILLE = 300         # valeur lue quand l'ECU ne connait pas power_limit
+ECU_REFRESH_INTERVAL_S = 300       # l'ECU ne relit les infos des MO que toutes les 5mn. 0 : infos toujours à jour
+ECU_REFRESH_OFFSET_S = 35          # ... à xx:x0:35 et xx:x5:35 environ
+HTTP_REQUEST_DURATION_S = 2.3      # durée mesurée d'une requête set_maxpower
+HTTP_MAX_CONCURRENT = 2            # l'ECU ne traite que 2 requêtes http en parallèle, les autres attendent
+
+# --- dynamique des MO (temps de l'installation) ---
+MODBUS_DEAD_TIME_S = 2             # début de réaction des MO après une écriture modbus
+HTTP_DEAD_TIME_S = 10              # début de réaction des MO après une requête http
+INVERTER_TIME_CONSTANT_S = 5       # constante de temps du premier ordre : 95% de la consigne en 15s environ
+PLANT_TICK_S = 0.5                 # pas de calcul de la dynamique
+
+# --- ensoleillement ---
+SUNRISE_H, SUNSET_H = 6.5, 21.5    # lever et coucher du soleil, en heures
+CLEAR_SKY_PEAK = 0.85              # production maximum par ciel clair, en fraction de la puissance nominale
+
+# --- table de registres ---
+REGISTER_BASE = 40000
+REGISTER_END = 40252               # exclu
+CONTROL_CONN, CONTROL_POWER_LIMIT, CONTROL_POWER_LIMIT_ENA = 40188, 40189, 40193
+CONTROL_REGISTERS = (CONTROL_CONN, CONTROL_POWER_LIMIT, CONTROL_POWER_LIMIT_ENA)
+# chaîne des modèles SunSpec : (adresse de l'entête, identifiant du modèle, longueur).
+# Les adresses des données lues par read_MO.py sont celles de l'ECU ; les longueurs des modèles 121 et du modèle constructeur sont supposées.
+SUNSPEC_MODELS = [
+    (40002, 1, 66),        # Common : Mn 40004, Md 40020, Opt 40036, Vr 40044, SN 40052, DA 40068
+    (40070, 101, 50),      # onduleur monophasé : A 40072, PhVphA 40080, W 40084, Hz 40086, VA 40088, VAr 40090, PF 40092, WH 40094, TmpCab 40103, St 40108
+    (40122, 120, 26),      # Nameplate
+    (40150, 121, 32),      # Basic settings
+    (40184, 123, 24),      # Immediate controls : Conn 40188, WMaxLimPct 40189, WMaxLim_Ena 40193
+    (40210, 64001, 38),    # modèle constructeur, float32 : tension DC 40214/40216, courant DC 40230/40232, puissance DC 40246/40248
+    (40250, 0xFFFF, 0),    # fin de chaîne
+]
+
+INVERTER_STATUS_SLEEPING, INVERTER_STATUS_PRODUCING, INVERTER_STATUS_THROTTLED = 2, 4, 5
+
+
+class EmulatedClock:
+    """Horloge de l'installation, éventuellement accélérée."""
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.origin_real = time.monotonic()
+        self.origin = (start or datetime.now()).timestamp()
+
+    def now(self):
+        return self.origin + (time.monotonic() - self.origin_real) * self.speed
+
+    def datetime(self):
+        return datetime.fromtimestamp(self.now())
+
+
+class Irradiance:
+    """Production disponible, en fraction de la puissance nominale, selon l'heure et l'orientation du MO.
+    profile : "clear" (ciel clair), "cloudy" (passages nuageux aléatoires), ou un fichier CSV "HH:MM;pourcentage"."""
+    def __init__(self, profile="clear", seed=0):
+        self.profile, self.points, self.clouds = profile, None, {}
+        self.random = random.Random(seed)
+        if profile not in ("clear", "cloudy"):
+            with open(profile, encoding="utf-8") as f:
+                self.points = sorted((int(h) + int(m) / 60, float(v) / 100) for h, m, v in
+                                     (line.replace(":", ";").split(";")[:3] for line in f if line.strip() and not line.startswith("#")))
+
+    def cloud_factor(self, t):
+        """Atténuation nuageuse, constante par tranche de 2mn et interpolée entre les tranches."""
+        def level(slot):
+            if slot not in self.clouds:
+                self.clouds[slot] = 1.0 if self.random.random() < 0.5 else self.random.uniform(0.2, 0.9)
+                if len(self.clouds) > 1000: self.clouds.pop(next(iter(self.clouds)))
+            return self.clouds[slot]
+        slot, frac = divmod(t / 120, 1)
+        return level(int(slot)) * (1 - frac) + level(int(slot) + 1) * frac
+
+    def fraction(self, t, peak_shift_h):
+        day = datetime.fromtimestamp(t)
+        hour = day.hour + day.minute / 60 + day.second / 3600
+        if self.points:
+            for (h0, v0), (h1, v1) in zip(self.points, self.points[1:]):
+                if h0 <= hour <= h1:
+                    return v0 + (v1 - v0) * (hour - h0) / (h1 - h0) if h1 > h0 else v0
+            return 0.0
+        position = (hour - SUNRISE_H - peak_shift_h / 2) / (SUNSET_H - SUNRISE_H)
+        if not 0 < position < 1: return 0.0
+        value = CLEAR_SKY_PEAK * math.sin(math.pi * position) ** 1.5
+        return value * self.cloud_factor(t) if self.profile == "cloudy" else value
+
+
+class Faults:
+    """Défauts injectables, par l'API python (attributs) ou par POST /emulator/faults."""
+    FIELDS = {
+        "offline": bool,         # l'ECU refuse les connexions modbus (et coupe celles en cours)
+        "hang_s": float,         # les requêtes modbus ne reçoivent de réponse qu'après ce délai (ECU figé)
+        "extra_delay_s": float,  # délai ajouté à chaque requête modbus
+        "error_rate": float,     # proportion de requêtes modbus en erreur (exception SLAVE_FAILURE)
+        "ignore_writes": bool,   # les écritures de power_limit sont acceptées mais les MO ne réagissent pas
+        "dropout": lambda units: [int(u) for u in units],   # ID modbus des MO qui ont décroché (production nulle)
+    }
+
+    def __init__(self):
+        self.offline, self.hang_s, self.extra_delay_s, self.error_rate, self.ignore_writes = False, 0.0, 0.0, 0.0, False
+        self.dropout = []
+
+    def update(self, values):
+        unknown = set(values) - set(self.FIELDS) - {"forget_limit"}
+        if unknown:
+            raise ValueError(f"défaut(s) inconnu(s): {', '.join(sorted(unknown))}")
+        for name, value in values.items():
+            if name in self.FIELDS: setattr(self, name, self.FIELDS[name](value))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class Inverter:
+    """Un MO : consigne avec temps mort, réponse du premier ordre, registres SunSpec."""
+    def __init__(self, modbus_id, serial, peak_shift_h):
+        self.modbus_id, self.serial, self.peak_shift_h = modbus_id, serial, peak_shift_h
+        self.power = 0.0                        # puissance AC actuelle, W
+        self.energy_wh = 0.0
+        self.panel_max_w = MO_PANEL_MAX_W       # maxpower http, par panneau
+        self.pending = []                       # (instant d'application, panel_max_w) : requêtes http en temps mort
+        self.registers = [0] * (REGISTER_END - REGISTER_BASE)
+        self.init_registers()
+
+    def set(self, address, values):
+        self.registers[address - REGISTER_BASE:address - REGISTER_BASE + len(values)] = values
+
+    def set_string(self, address, length, text):
+        data = text.encode().ljust(length * 2, b"\0")[:length * 2]
+        self.set(address, list(struct.unpack(f">{length}H", data)))
+
+    def set_float(self, address, value):
+        self.set(address, list(struct.unpack(">2H", struct.pack(">f", value))))
+
+    def init_registers(self):
+        self.set(40000, [0x5375, 0x6E53])   # "SunS"
+        for header, model_id, length in SUNSPEC_MODELS:
+            self.set(header, [model_id, length])
+        self.set_string(40004, 16, "APsystems")
+        self.set_string(40020, 16, "DS3")
+        self.set_string(40044, 8, "V5312")
+        self.set_string(40052, 16, self.serial)
+        self.set(40068, [self.modbus_id])
+        # facteurs d'échelle (read_MO.py applique directement ces facteurs)
+        self.set(40076, [0xFFFE]); self.set(40083, [0xFFFF]); self.set(40085, [0xFFFF]); self.set(40087, [0xFFFE])
+        self.set(40089, [0xFFFF]); self.set(40091, [0xFFFF]); self.set(40093, [0xFFFD]); self.set(40107, [0xFFFF])
+
+    def target(self, available_w, power_limit_permille, enabled):
+        """Puissance vers laquelle tend le MO."""
+        limit = MO_RATED_POWER_W * power_limit_permille / 1000 if enabled else MO_RATED_POWER_W
+        return max(0.0, min(available_w, limit, 2 * self.panel_max_w))
+
+    def step(self, now, dt, available_w, power_limit_permille, enabled, connected):
+        while self.pending and self.pending[0][0] <= now:
+            self.panel_max_w = self.pending.pop(0)[1]
+        target = self.target(available_w, power_limit_permille, enabled) if connected else 0.0
+        self.power += (target - self.power) * (1 - math.exp(-dt / INVERTER_TIME_CONSTANT_S))
+        self.energy_wh += self.power * dt / 3600
+
+    def refresh_registers(self, throttled):
+        """Recopie l'état du MO dans ses registres, comme le fait l'ECU lors de son rafraichissement."""
+        power, voltage = self.power, 234.0
+        status = INVERTER_STATUS_SLEEPING if power < 1 else (INVERTER_STATUS_THROTTLED if throttled else INVERTER_STATUS_PRODUCING)
+        self.set(40072, [round(power / voltage * 100)])
+        self.set(40080, [round(voltage * 10)])
+        self.set(40084, [round(power * 10)])
+        self.set(40086, [5000])
+        self.set(40088, [round(power * 1.02 * 10)])
+        self.set(40090, [round(power * 0.2 * 10)])
+        self.set(40092, [980 if power >= 1 else 0])
+        self.set(40094, list(divmod(int(self.energy_wh) & 0xFFFFFFFF, 0x10000)))
+        self.set(40103, [round((25 + power * 0.02) * 10)])
+        self.set(40108, [status])
+        dc_power = power / 0.95
+        for i in range(2):
+            dc_voltage = 33.5 if dc_power >= 1 else 0.0
+            self.set_float(40214 + 2 * i, dc_voltage)
+            self.set_float(40230 + 2 * i, dc_power / 2 / dc_voltage if dc_voltage else 0.0)
+            self.set_float(40246 + 2 * i, dc_power / 2)
+
+
+class Ecu:
+    """L'ECU-R : registres de contrôle globaux, mémoire de power_limit, rafraichissement des infos des MO."""
+    def __init__(self, clock, irradiance, refresh_interval=ECU_REFRESH_INTERVAL_S, startup_quirk=True):
+        self.clock, self.irradiance, self.refresh_interval = clock, irradiance, refresh_interval
+        self.faults = Faults()
+        self.inverters = {modbus_id: Inverter(modbus_id, serial, shift) for modbus_id, serial, shift in INVERTERS}
+        self.by_serial = {inv.serial: inv for inv in self.inverters.values()}
+        self.conn, self.power_limit_ena = 1, 1
+        self.power_limit = 1000                      # valeur effective, appliquée par les MO
+        self.power_limit_known = not startup_quirk   # False : la lecture de 40189 retourne 300
+        self.pending = []                            # (instant d'application, power_limit) : écritures modbus en temps mort
+        self.applied_limit = self.power_limit
+        self.last_refresh_slot = None
+        self.last_day = clock.datetime().date()
+        self.stats = {"modbus_reads": 0, "modbus_writes": 0, "modbus_connections": 0, "idle_disconnects": 0,
+                      "http_requests": 0, "http_queued": 0}
+        self.http_slots = None                       # asyncio.Semaphore, créé dans la boucle
+
+    # --- modbus ---
+    def read(self, unit, address, count):
+        self.stats["modbus_reads"] += 1
+        values = self.inverters[unit].registers[address - REGISTER_BASE:address - REGISTER_BASE + count]
+        for register, value in ((CONTROL_CONN, self.conn), (CONTROL_POWER_LIMIT_ENA, self.power_limit_ena),
+                                (CONTROL_POWER_LIMIT, self.power_limit if self.power_limit_known else BUGGY_LIMIT_PERMILLE)):
+            if address <= register < address + count:
+                values[register - address] = value
+        return values
+
+    def write(self, unit, address, values):
+        self.stats["modbus_writes"] += 1
+        for offset, value in enumerate(values):
+            register = address + offset
+            if register == CONTROL_POWER_LIMIT:
+                self.power_limit, self.power_limit_known = min(int(value), 1000), True
+                if not self.faults.ignore_writes:
+                    self.pending.append((self.clock.now() + MODBUS_DEAD_TIME_S, self.power_limit))
+            elif register == CONTROL_CONN:
+                self.conn = 1 if value else 0
+            elif register == CONTROL_POWER_LIMIT_ENA:
+                self.power_limit_ena = 1 if value else 0
+            # les autres registres sont en lecture seule sur l'ECU : l'écriture est ignorée
+
+    async def before_request(self):
+        """Délais et défauts appliqués à chaque requête modbus."""
+        await asyncio.sleep(MODBUS_RESPONSE_DELAY_S + self.faults.extra_delay_s + self.faults.hang_s)
+        if self.faults.error_rate and random.random() < self.faults.error_rate:
+            raise RuntimeError("défaut injecté")
+
+    def forget_limit(self):
+        """L'ECU perd la valeur de power_limit (redémarrage, nuit, ...) : la lecture retourne 300 jusqu'à la prochaine écriture."""
+        self.power_limit_known = False
+
+    # --- dynamique ---
+    def step(self, dt):
+        now = self.clock.now()
+        today = self.clock.datetime().date()
+        if today != self.last_day:
+            logging.info(f"Nouvelle journée {today} : l'ECU perd la valeur de power_limit")
+            self.last_day = today
+            self.forget_limit()
+        while self.pending and self.pending[0][0] <= now:
+            self.applied_limit = self.pending.pop(0)[1]
+        for inv in self.inverters.values():
+            available = MO_RATED_POWER_W * self.irradiance.fraction(now, inv.peak_shift_h)
+            inv.step(now, dt, available, self.applied_limit, self.power_limit_ena, self.conn and inv.modbus_id not in self.faults.dropout)
+        slot = int((now - ECU_REFRESH_OFFSET_S) // self.refresh_interval) if self.refresh_interval else now
+        if slot != self.last_refresh_slot:
+            self.last_refresh_slot = slot
+            throttled = self.power_limit_ena and self.applied_limit < 1000
+            for inv in self.inverters.values():
+                inv.refresh_registers(throttled)
+
+    async def run_plant(self):
+        last = self.clock.now()
+        self.step(0)
+        while True:
+            await asyncio.sleep(max(PLANT_TICK_S / self.clock.speed, 0.05))
+            now = self.clock.now()
+            self.step(now - last)
+            last = now
+
+    def state(self):
+        return {
+            "time": self.clock.datetime().isoformat(timespec="seconds"),
+            "power_limit": self.power_limit, "power_limit_read": self.power_limit if self.power_limit_known else BUGGY_LIMIT_PERMILLE,
+            "power_limit_applied": self.applied_limit, "conn": self.conn, "power_limit_ena": self.power_limit_ena,
+            "total_power": round(sum(inv.power for inv in self.inverters.values()), 1),
+            "available_power": round(sum(MO_RATED_POWER_W * self.irradiance.fraction(self.clock.now(), inv.peak_shift_h) for inv in self.inverters.values()), 1),
+            "inverters": {inv.modbus_id: {"power": round(inv.power, 1), "energy_wh": round(inv.energy_wh, 1), "panel_max_w": inv.panel_max_w}
+                          for inv in self.inverters.values()},
+            "faults": self.faults.as_dict(), "stats": self.stats,
+        }
+
+
+class UnitContext(ModbusBaseSlaveContext):
+    """Contexte modbus d'un MO : les registres de holding sont servis par l'ECU."""
+    def __init__(self, ecu, unit):
+        self.ecu, self.unit = ecu, unit
+
+    def reset(self):
+        pass
+
+    def validate(self, fc_as_hex, address, count=1):
+        return self.decode(fc_as_hex) == "h" and REGISTER_BASE <= address and address + count <= REGISTER_END
+
+    def getValues(self, fc_as_hex, address, count=1):
+        return self.ecu.read(self.unit, address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        self.ecu.write(self.unit, address, values)
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        await self.ecu.before_request()
+        return self.getValues(fc_as_hex, address, count)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        await self.ecu.before_request()
+        self.setValues(fc_as_hex, address, values)
+
+
+class EcuModbusServer(ModbusTcpServer):
+    """Serveur modbus pymodbus, avec la coupure des connexions inactives et le défaut "offline"."""
+    def __init__(self, ecu, address):
+        self.ecu = ecu
+        context = ModbusServerContext(slaves={unit: UnitContext(ecu, unit) for unit in ecu.inverters}, single=False)
+        super().__init__(context, address=address)
+
+    def callback_new_connection(self):
+        handler = super().callback_new_connection()
+        ecu, idle = self.ecu, {"timer": None}
+
+        def close():
+            if handler.transport: handler.transport.close()
+
+        def arm():
+            if idle["timer"]: idle["timer"].cancel()
+            idle["timer"] = asyncio.get_running_loop().call_later(MODBUS_IDLE_DISCONNECT_S, idle_close)
+
+        def idle_close():
+            if handler.transport:
+                ecu.stats["idle_disconnects"] += 1
+                logging.debug("Connexion modbus inactive : fermeture par l'ECU")
+                close()
+
+        connected, data = handler.callback_connected, handler.callback_data
+        def callback_connected():
+            connected()
+            ecu.stats["modbus_connections"] += 1
+            if ecu.faults.offline: close()
+            else: arm()
+        def callback_data(payload, addr=None):
+            if ecu.faults.offline:
+                close(); return len(payload)
+            arm()
+            return data(payload, addr)
+        handler.callback_connected, handler.callback_data = callback_connected, callback_data
+        return handler
+
+
+class EcuHttpServer:
+    """URL set_maxpower de l'ECU (2 requêtes en parallèle au plus), et URL de pilotage de l'émulateur."""
+    def __init__(self, ecu):
+        self.ecu = ecu
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while (line := (await reader.readline()).decode("latin-1").strip()):
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = (await reader.readexactly(int(headers.get("content-length", 0)))).decode()
+            method, path = request_line[0], request_line[1].split("?")[0]
+            status, payload, content_type = await self.route(method, path, body)
+        except Exception as e:
+            status, payload, content_type = 400, {"message": str(e)}, "application/json"
+        data = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if path == "/index.php/configuration/set_maxpower" and method == "POST":
+            return 200, await self.set_maxpower(parse_qs(body)), "text/html; charset=utf-8"   # l'ECU répond en text/html
+        if path == "/emulator/state" and method == "GET":
+            return 200, self.ecu.state(), "application/json"
+        if path == "/emulator/faults" and method == "POST":
+            values = json.loads(body or "{}")
+            self.ecu.faults.update(values)
+            if values.get("forget_limit"): self.ecu.forget_limit()
+            logging.info(f"Défauts : {self.ecu.faults.as_dict()}")
+            return 200, self.ecu.faults.as_dict(), "application/json"
+        return 404, {"message": "not found"}, "application/json"
+
+    async def set_maxpower(self, form):
+        ecu = self.ecu
+        ecu.stats["http_requests"] += 1
+        received = ecu.clock.now()
+        if ecu.http_slots.locked(): ecu.stats["http_queued"] += 1
+        async with ecu.http_slots:
+            await asyncio.sleep(HTTP_REQUEST_DURATION_S)
+        inverter = ecu.by_serial.get(form.get("id", [""])[0])
+        try:
+            maxpower = int(form.get("maxpower", [""])[0])
+        except ValueError:
+            maxpower = -1
+        if inverter is None or not 20 <= maxpower <= MO_PANEL_MAX_W:
+            return {"value": 1, "message": "parameter error"}
+        inverter.pending.append((received + HTTP_DEAD_TIME_S, maxpower))
+        return {"value": 0, "message": "success"}
+
+
+class EcuEmulator:
+    """Émulateur complet : serveur modbus, serveur http, dynamique de l'installation.
+    Utilisable depuis un autre programme python : start_in_thread() le lance dans une boucle asyncio dédiée."""
+    def __init__(self, host=DEFAULT_LISTEN_HOST, modbus_port=DEFAULT_MODBUS_PORT, http_port=DEFAULT_HTTP_PORT,
+                 speed=1.0, start=None, profile="clear", refresh_interval=ECU_REFRESH_INTERVAL_S, startup_quirk=True, seed=0):
+        self.host, self.modbus_port, self.http_port = host, modbus_port, http_port
+        self.ecu = Ecu(EmulatedClock(speed, start), Irradiance(profile, seed), refresh_interval, startup_quirk)
+        self.loop = None
+        self.ready = threading.Event()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.ecu.http_slots = asyncio.Semaphore(HTTP_MAX_CONCURRENT)
+        self.modbus_server = EcuModbusServer(self.ecu, (self.host, self.modbus_port))
+        await self.modbus_server.serve_forever(background=True)
+        http_server = await asyncio.start_server(EcuHttpServer(self.ecu).handle, self.host, self.http_port) if self.http_port else None
+        logging.info(f"Emulateur ECU : modbus {self.host}:{self.modbus_port}, http {self.host}:{self.http_port}, "
+                     f"MO {', '.join(str(u) for u in self.ecu.inverters)}, vitesse x{self.ecu.clock.speed}")
+        plant = asyncio.create_task(self.ecu.run_plant())
+        self.ready.set()
+        try:
+            await self.modbus_server.serving
+        finally:
+            plant.cancel()
+            if http_server: http_server.close()
+
+    def start_in_thread(self):
+        """Lance l'émulateur dans un thread, et attend qu'il soit prêt."""
+        threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True).start()
+        if not self.ready.wait(10):
+            raise RuntimeError("l'émulateur n'a pas démarré")
+        return self
+
+    def stop(self):
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self.modbus_server.shutdown(), self.loop)
+
+    def set_faults(self, **values):
+        """Injection de défauts depuis un autre thread (voir Faults)."""
+        self.loop.call_soon_threadsafe(lambda: (self.ecu.faults.update(values), values.get("forget_limit") and self.ecu.forget_limit()))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Emulateur d'ECU-R APSystems et de MO DS3 (modbus et http).")
+    argparser.add_argument("-lh", "--listen-host", type=str, default=DEFAULT_LISTEN_HOST, help=f"adresse d'écoute. default {DEFAULT_LISTEN_HOST}")
+    argparser.add_argument("-p", "--port", type=int, default=DEFAULT_MODBUS_PORT, help=f"port modbus. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-hp", "--http-port", type=int, default=DEFAULT_HTTP_PORT, help=f"port http. 0 pour désactiver. default {DEFAULT_HTTP_PORT}")
+    argparser.add_argument("-s", "--speed", type=float, default=1.0, help="accélération de l'horloge de l'installation. default 1 (temps réel)")
+    argparser.add_argument("--start", type=str, help="heure de départ de l'horloge de l'installation, HH:MM. default : heure actuelle")
+    argparser.add_argument("--profile", type=str, default="clear", help="ensoleillement : clear, cloudy, ou fichier CSV 'HH:MM;pourcentage'. default clear")
+    argparser.add_argument("--refresh", type=float, default=ECU_REFRESH_INTERVAL_S, help=f"intervalle de rafraichissement des infos MO par l'ECU, en secondes. 0 : toujours à jour. default {ECU_REFRESH_INTERVAL_S}")
+    argparser.add_argument("--no-startup-quirk", action="store_true", help="au démarrage, power_limit est lu à sa valeur réelle, et non à 30.0%%")
+    argparser.add_argument("--seed", type=int, default=0, help="graine aléatoire du profil nuageux. default 0")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="logs détaillés")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    start = None
+    if args.start:
+        hour, minute = (int(x) for x in args.start.split(":"))
+        start = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+    emulator = EcuEmulator(args.listen_host, args.port, args.http_port, args.speed, start, args.profile, args.refresh,
+                           not args.no_startup_quirk, args.seed)
+    try:
+        asyncio.run(emulator.serve())
+    except KeyboardInterrupt:
+        logging.info("Arrêt de l'émulateur.")
+
+if __name__ == "__main__":
+    main()
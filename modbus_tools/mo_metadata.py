@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+mo_metadata.py
+
+cache des informations statiques des micro onduleurs (MO) : fabricant, modèle, version, numéro de série, ID modbus
+ces informations ne changent jamais (sauf remplacement d'un MO) : les relire à chaque interrogation coûte des requêtes modbus
+(plusieurs registres de 8 ou 16 mots par MO), alors que l'ECU répond lentement (165ms par requête environ).
+
+Le cache est gardé en mémoire, et sauvegardé dans un petit fichier JSON, par ECU (adresse:port) et par ID modbus.
+Une entrée est vérifiée (lecture du seul numéro de série) au plus tard toutes les METADATA_CHECK_INTERVAL_S secondes, ou quand
+une anomalie est signalée (flag(), par exemple après une lecture en échec) ; toutes les informations sont relues si le
+numéro de série a changé. Utilisé par read_MO.py et read_all_MO.py.
+
+On y trouve aussi la lecture et l'écriture de l'inventaire des MO (ID modbus -> numéro de série, modèle), produit par discover_MO.py.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
+
+# fichier du cache, dans le répertoire des scripts
+DEFAULT_METADATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mo_metadata.json")
+# fichier d'inventaire des MO, produit par discover_MO.py
+DEFAULT_INVENTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mo_inventory.json")
+# délai maximum entre deux vérifications du numéro de série d'un MO
+METADATA_CHECK_INTERVAL_S = 86400
+
+# key, data_type, length (les registres statiques du modèle SunSpec 1)
+METADATA_REGISTERS = {
+    "manufacturer":       (40004, ModbusTcpClient.DATATYPE.STRING,  16),
+    "model":              (40020, ModbusTcpClient.DATATYPE.STRING,  16),
+    "version":            (40044, ModbusTcpClient.DATATYPE.STRING,  8),
+    "serialnumber":       (40052, ModbusTcpClient.DATATYPE.STRING,  16),
+    "modbusid":           (40068, ModbusTcpClient.DATATYPE.UINT16,  1),
+}
+
+
+def read_register(client, unit, key):
+    """Lit un registre statique. Retourne la valeur, ou None en cas d'erreur."""
+    addr, data_type, length = METADATA_REGISTERS[key]
+    try:
+        rr = client.read_holding_registers(address=addr, count=length, slave=unit)
+    except (ModbusException, OSError):
+        return None
+    if rr.isError():
+        return None
+    value = client.convert_from_registers(rr.registers, data_type)
+    return value.strip("\x00 ") if isinstance(value, str) else value
+
+
+class MetadataCache:
+    """Cache des informations statiques des MO, persistant. path vide : cache en mémoire seulement."""
+    def __init__(self, path=DEFAULT_METADATA_FILE):
+        self.path = path
+        self.entries = {}      # "adresse:port" -> {"ID modbus": {clé: valeur, "checked": timestamp}}
+        self.flagged = set()   # (ecu, unit) à vérifier au prochain refresh()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Cache des MO {path} illisible, il sera reconstruit : {e}")
+
+    @staticmethod
+    def _ecu(host, port):
+        return f"{host}:{port}"
+
+    def get(self, host, port, unit):
+        return self.entries.get(self._ecu(host, port), {}).get(str(unit))
+
+    def flag(self, host, port, unit):
+        """Signale une anomalie sur un MO (lecture en échec, valeur incohérente) : il sera vérifié au prochain refresh()."""
+        self.flagged.add((self._ecu(host, port), str(unit)))
+
+    def refresh(self, client, host, port, unit, force=False):
+        """Retourne les informations statiques du MO, en ne faisant des requêtes modbus que si nécessaire :
+        entrée absente, vérification trop ancienne, anomalie signalée, ou force. Retourne None si le MO ne répond pas."""
+        ecu, key = self._ecu(host, port), str(unit)
+        entry = self.entries.get(ecu, {}).get(key)
+        if entry and not force and (ecu, key) not in self.flagged and time.time() - entry.get("checked", 0) < METADATA_CHECK_INTERVAL_S:
+            return entry
+        serial = read_register(client, unit, "serialnumber")
+        if serial is None:
+            return entry if entry and not force else None
+        self.flagged.discard((ecu, key))
+        if entry and entry.get("serialnumber") == serial:
+            entry["checked"] = time.time()
+        else:
+            if entry:
+                print(f"MO {unit} de {ecu} : numéro de série {entry.get('serialnumber')} remplacé par {serial}, relecture des informations")
+            entry = {k: read_register(client, unit, k) for k in METADATA_REGISTERS if k != "serialnumber"}
+            entry["serialnumber"] = serial
+            return self.store(host, port, unit, entry)
+        self.save()
+        return entry
+
+    def store(self, host, port, unit, values):
+        """Enregistre les informations statiques lues par ailleurs (discover_MO.py par exemple). Retourne l'entrée."""
+        entry = dict(values, read=datetime.now().isoformat(timespec="seconds"), checked=time.time())
+        self.entries.setdefault(self._ecu(host, port), {})[str(unit)] = entry
+        self.flagged.discard((self._ecu(host, port), str(unit)))
+        self.save()
+        return entry
+
+    def save(self):
+        """Ecriture atomique du fichier (fichier temporaire puis renommage)."""
+        if not self.path: return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Ecriture du cache des MO {self.path} impossible : {e}")
+
+
+def load_inventory(path):
+    """Lit l'inventaire produit par discover_MO.py. Retourne (host, port, liste triée des ID modbus, inventaire).
+    Lève OSError ou ValueError si le fichier est absent, illisible, ou ne contient aucun MO."""
+    with open(path, "r", encoding="utf-8") as f:
+        inventory = json.load(f)
+    units = sorted(int(unit) for unit in inventory.get("units", {}))
+    if not units:
+        raise ValueError(f"aucun MO dans l'inventaire {path}")
+    return inventory.get("host"), inventory.get("port"), units, inventory
+
+
+def save_inventory(path, host, port, units):
+    """Ecriture atomique de l'inventaire. units : {ID modbus: {"serialnumber": ..., "model": ...}}"""
+    inventory = {"host": host, "port": port, "discovered": datetime.now().isoformat(timespec="seconds"),
+                 "units": {str(unit): units[unit] for unit in sorted(units)}}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(inventory, f, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+modbus_proxy.py
+
+proxy Modbus TCP local pour l'ECU-R APSystems
+l'ECU supporte mal d'être interrogé par plusieurs clients en même temps (démon de régulation, read_all_MO.py en cron,
+read_MO.py, domotique, ...), chacun avec sa propre session TCP. Ce proxy :
+  . garde une seule session TCP vers l'ECU, et y sérialise toutes les requêtes
+  . traite les requêtes par priorité : écritures des registres de contrôle (power_limit, ...) d'abord, puis les autres écritures, puis les lectures
+  . répond aux lectures répétées depuis un cache. La durée de vie du cache (5mn) correspond au rafraichissement des infos MO par l'ECU
+    les registres de contrôle (40188 à 40193) ne sont pas mis en cache : ils sont toujours lus sur l'ECU
+  . fusionne les lectures identiques simultanées : une seule requête est envoyée à l'ECU, la réponse est servie à tous les demandeurs
+Les outils existants n'ont qu'à utiliser l'adresse (et le port) du proxy au lieu de celle de l'ECU.
+
+syntaxe :
+  modbus_proxy.py -h : pour de l'aide
+  modbus_proxy.py 192.168.1.120 : proxy vers l'ECU à l'adresse IP 192.168.1.120, en écoute sur le port 5020
+  read_all_MO.py 127.0.0.1 -p 5020 -u 1,11,12 : interrogation des MO à travers le proxy
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import struct
+import time
+
+DEFAULT_MODBUS_IP = "192.168.1.120"
+DEFAULT_MODBUS_PORT = 502
+DEFAULT_LISTEN_HOST = "0.0.0.0"
+DEFAULT_LISTEN_PORT = 5020   # le port 502 nécessite les droits root
+
+# Durée de vie en secondes d'une lecture en cache. L'ECU ne rafraichit les infos des MO que toutes les 5mn.
+CACHE_TTL_S = 300
+# Registres de contrôle, globaux à l'installation (connected, power_limit, power_limit_ena) : jamais en cache.
+CONTROL_REGISTERS = range(40188, 40194)
+# Timeout en secondes d'une requête vers l'ECU (connexion ou réponse)
+UPSTREAM_TIMEOUT_S = 5
+# l'ECU coupe la connexion modbus après environ 5s sans requête : au-delà de ce délai, on se reconnecte avant d'envoyer
+UPSTREAM_IDLE_RECONNECT_S = 4.5
+# Intervalle en secondes entre deux écritures des statistiques dans la log. 0 pour désactiver.
+STATS_INTERVAL_S = 600
+
+# Priorités de traitement (la plus petite valeur est servie en premier)
+PRIORITY_CONTROL_WRITE = 0
+PRIORITY_WRITE = 1
+PRIORITY_CONTROL_READ = 2
+PRIORITY_READ = 3
+
+# Codes fonction modbus
+FC_READ_HOLDING = 0x03
+FC_READ_INPUT = 0x04
+FC_WRITE_SINGLE = 0x06
+FC_WRITE_MULTIPLE = 0x10
+READ_FUNCTIONS = (FC_READ_HOLDING, FC_READ_INPUT)
+
+# Codes d'exception "passerelle" renvoyés au client si l'ECU ne répond pas
+EXC_GATEWAY_PATH_UNAVAILABLE = 0x0A
+EXC_GATEWAY_TARGET_FAILED = 0x0B
+
+
+def exception_pdu(function_code, exception_code):
+    return bytes([function_code | 0x80, exception_code])
+
+def register_range(pdu):
+    """Retourne (premier registre, nombre de registres) concernés par une requête, ou None si non applicable."""
+    function_code = pdu[0]
+    if function_code in READ_FUNCTIONS + (FC_WRITE_MULTIPLE,) and len(pdu) >= 5:
+        return struct.unpack(">HH", pdu[1:5])
+    if function_code == FC_WRITE_SINGLE and len(pdu) >= 5:
+        return struct.unpack(">H", pdu[1:3])[0], 1
+    return None
+
+def touches_control_registers(address, count):
+    return address < CONTROL_REGISTERS.stop and address + count > CONTROL_REGISTERS.start
+
+
+class Upstream:
+    """Session TCP unique vers l'ECU. Un seul worker consomme la file de priorité : les requêtes sont strictement sérialisées."""
+    def __init__(self, host, port, stats):
+        self.host, self.port, self.stats = host, port, stats
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()   # départage les requêtes de même priorité : ordre d'arrivée
+        self.transaction_ids = itertools.count(1)
+        self.reader = self.writer = None
+        self.last_activity = 0
+
+    def submit(self, priority, unit, pdu):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.order), unit, pdu, future))
+        return future
+
+    async def run(self):
+        while True:
+            priority, _, unit, pdu, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            response = await self._execute(unit, pdu)
+            if not future.done():
+                future.set_result(response)
+
+    async def _connect(self):
+        self.close()
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), UPSTREAM_TIMEOUT_S)
+        self.stats["upstream_connects"] += 1
+        logging.debug(f"Connexion à l'ECU {self.host}:{self.port} établie")
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _execute(self, unit, pdu):
+        """Envoie une requête à l'ECU et retourne la PDU de réponse. Une seule nouvelle tentative, sur une connexion neuve."""
+        error_code = EXC_GATEWAY_TARGET_FAILED
+        for attempt in range(2):
+            try:
+                if self.writer is None or time.monotonic() - self.last_activity > UPSTREAM_IDLE_RECONNECT_S:
+                    error_code = EXC_GATEWAY_PATH_UNAVAILABLE
+                    await self._connect()
+                    error_code = EXC_GATEWAY_TARGET_FAILED
+                transaction_id = next(self.transaction_ids) & 0xFFFF
+                self.writer.write(struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, unit) + pdu)
+                await self.writer.drain()
+                self.stats["upstream_requests"] += 1
+                while True:
+                    header = await asyncio.wait_for(self.reader.readexactly(7), UPSTREAM_TIMEOUT_S)
+                    rx_transaction_id, _, length, _ = struct.unpack(">HHHB", header)
+                    if length == 0:
+                        raise ConnectionError("entête MBAP de longueur nulle")
+                    body = await asyncio.wait_for(self.reader.readexactly(length - 1), UPSTREAM_TIMEOUT_S)
+                    if rx_transaction_id == transaction_id:
+                        break   # une réponse tardive à une requête abandonnée est ignorée
+                self.last_activity = time.monotonic()
+                return body
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                logging.debug(f"Erreur de communication avec l'ECU (tentative {attempt + 1}): {e!r}")
+                self.close()
+        self.stats["upstream_errors"] += 1
+        logging.warning(f"L'ECU ne répond pas. Requête unit {unit}, fonction {pdu[0]} en échec")
+        return exception_pdu(pdu[0], error_code)
+
+
+class ModbusProxy:
+    """Serveur Modbus TCP : cache, fusion des lectures identiques, et transmission à l'ECU par priorité."""
+    def __init__(self, upstream_host, upstream_port, cache_ttl):
+        self.cache_ttl = cache_ttl
+        self.stats = dict.fromkeys(("requests", "cache_hits", "coalesced", "upstream_requests", "upstream_errors", "upstream_connects"), 0)
+        self.upstream = Upstream(upstream_host, upstream_port, self.stats)
+        self.cache = {}       # (unit, fonction, adresse, nombre) -> (instant d'expiration, pdu de réponse)
+        self.inflight = {}    # (unit, fonction, adresse, nombre) -> future de la lecture en cours
+        self.tasks = set()    # la boucle asyncio ne garde qu'une référence faible des tâches : une tâche non référencée peut disparaître
+
+    def spawn(self, coroutine):
+        """Lance une tâche, référencée jusqu'à sa fin."""
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        logging.debug(f"Client connecté: {peer}")
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit = struct.unpack(">HHHB", header)
+                if length == 0:
+                    # la longueur compte l'unit id : readexactly(-1) lirait jusqu'à la fermeture, et la trame suivante serait perdue
+                    logging.warning(f"Entête MBAP de longueur nulle reçue de {peer}, connexion fermée")
+                    break
+                pdu = await reader.readexactly(length - 1)
+                # les requêtes d'un même client peuvent être traitées en parallèle : les réponses portent l'identifiant de transaction
+                self.spawn(self._answer(writer, transaction_id, protocol_id, unit, pdu))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            logging.debug(f"Client déconnecté: {peer}")
+            writer.close()
+
+    async def _answer(self, writer, transaction_id, protocol_id, unit, pdu):
+        response = await self.process(unit, pdu)
+        if not writer.is_closing():
+            writer.write(struct.pack(">HHHB", transaction_id, protocol_id, len(response) + 1, unit) + response)
+
+    async def process(self, unit, pdu):
+        """Traite une requête et retourne la PDU de réponse."""
+        self.stats["requests"] += 1
+        if not pdu:
+            return exception_pdu(0, 0x01)
+        function_code, registers = pdu[0], register_range(pdu)
+
+        if function_code not in READ_FUNCTIONS or registers is None:
+            control = registers is not None and touches_control_registers(*registers)
+            response = await self.upstream.submit(PRIORITY_CONTROL_WRITE if control else PRIORITY_WRITE, unit, pdu)
+            if registers is not None and not response[0] & 0x80:
+                self._invalidate(unit, *registers)
+            return response
+
+        key = (unit, function_code) + registers
+        control = touches_control_registers(*registers)
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self.stats["cache_hits"] += 1
+            return cached[1]
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.inflight[key])
+
+        future = self.upstream.submit(PRIORITY_CONTROL_READ if control else PRIORITY_READ, unit, pdu)
+        self.inflight[key] = future
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            del self.inflight[key]
+        if not control and self.cache_ttl > 0 and not response[0] & 0x80:
+            self.cache[key] = (time.monotonic() + self.cache_ttl, response)
+        return response
+
+    def _invalidate(self, unit, address, count):
+        """Après une écriture, retire du cache les lectures qui recouvrent les registres écrits.
+        Les registres de contrôle étant globaux à l'installation, leur écriture concerne tous les MO."""
+        all_units = touches_control_registers(address, count)
+        for key in [k for k in self.cache if (all_units or k[0] == unit) and k[2] < address + count and k[2] + k[3] > address]:
+            del self.cache[key]
+
+    async def purge_and_report(self):
+        """Purge périodique des entrées expirées du cache, et statistiques dans la log."""
+        while True:
+            await asyncio.sleep(STATS_INTERVAL_S or CACHE_TTL_S)
+            now = time.monotonic()
+            for key in [k for k, (expires, _) in self.cache.items() if expires <= now]:
+                del self.cache[key]
+            if STATS_INTERVAL_S:
+                logging.info("Statistiques: " + ", ".join(f"{k}={v}" for k, v in self.stats.items()) + f", cache={len(self.cache)}")
+
+
+async def serve(args):
+    proxy = ModbusProxy(args.host, args.port, args.ttl)
+    server = await asyncio.start_server(proxy.handle_client, args.listen_host, args.listen_port)
+    logging.info(f"Proxy modbus en écoute sur {args.listen_host}:{args.listen_port}, vers l'ECU {args.host}:{args.port}. Cache {args.ttl}s")
+    proxy.spawn(proxy.upstream.run())
+    proxy.spawn(proxy.purge_and_report())
+    async with server:
+        await server.serve_forever()
+
+def main():
+    argparser = argparse.ArgumentParser(description="Proxy Modbus TCP avec cache, pour l'ECU-R APSystems.")
+    argparser.add_argument("host", type=str, nargs='?', default=DEFAULT_MODBUS_IP, help=f"ECU Modbus TCP address. default {DEFAULT_MODBUS_IP}")
+    argparser.add_argument("-p", "--port", type=int, default=DEFAULT_MODBUS_PORT, help=f"ECU Modbus TCP port. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-lh", "--listen-host", type=str, default=DEFAULT_LISTEN_HOST, help=f"adresse d'écoute du proxy. default {DEFAULT_LISTEN_HOST}")
+    argparser.add_argument("-lp", "--listen-port", type=int, default=DEFAULT_LISTEN_PORT, help=f"port d'écoute du proxy. default {DEFAULT_LISTEN_PORT}")
+    argparser.add_argument("-t", "--ttl", type=float, default=CACHE_TTL_S, help=f"durée de vie du cache des lectures, en secondes. 0 pour désactiver. default {CACHE_TTL_S}")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="logs détaillés")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        logging.info("Arrêt du proxy.")
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ read_MO.py
 lecture modbus de registres de micro onduleurs APSystems
 teste avec des MO DS3
 pas optimisé : fait une requete par registre à lire
+les informations statiques (fabricant, modèle, version, numéro de série, ID modbus) viennent du cache des MO (voir mo_metadata.py)
 
 syntaxe : 
   read_MO.py -h : pour de l'aide
@@ -24,17 +25,34 @@ from pymodbus.pdu import ExceptionResponse
 
 from pprint import pprint
 
+from mo_metadata import DEFAULT_METADATA_FILE, MetadataCache, load_inventory
+
 DEFAULT_MODBUS_IP = "192.168.1.120"
 DEFAULT_MODBUS_PORT = 502
 
 def main():
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("host", type=str, nargs='?', default = DEFAULT_MODBUS_IP, help=f"Modbus TCP address. default {DEFAULT_MODBUS_IP}")
-    argparser.add_argument("-p", "--port", type=int, default = DEFAULT_MODBUS_PORT, help=f"Modbus TCP port. default {DEFAULT_MODBUS_PORT}")
-    argparser.add_argument("-u", "--unit", type=int, default=1, help="Modbus device address. default 1")
+    argparser.add_argument("host", type=str, nargs='?', help=f"Modbus TCP address. default : celle de l'inventaire, sinon {DEFAULT_MODBUS_IP}")
+    argparser.add_argument("-p", "--port", type=int, help=f"Modbus TCP port. default : celui de l'inventaire, sinon {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-u", "--unit", type=int, help="Modbus device address. default : le premier MO de l'inventaire, sinon 1")
+    argparser.add_argument("-mc", "--metadata-cache", type=str, default=DEFAULT_METADATA_FILE, help=f"fichier du cache des informations statiques des MO, chaine vide pour un cache en mémoire seulement. default {DEFAULT_METADATA_FILE}")
+    argparser.add_argument("-rm", "--refresh-metadata", action="store_true", help="vérifie le numéro de série du MO, même si le cache est récent")
+    argparser.add_argument("-i", "--inventory", type=str, help="inventaire produit par discover_MO.py : donne l'ECU et l'ID modbus par défaut")
     args = argparser.parse_args()
 
-    print(f"Interrogation modbus de {DEFAULT_MODBUS_IP} pour le device {args.unit}")
+    inv_host, inv_port, units = None, None, [1]
+    if args.inventory:
+        try:
+            inv_host, inv_port, units, _ = load_inventory(args.inventory)
+        except (OSError, ValueError) as e:
+            argparser.error(f"inventaire {args.inventory} illisible : {e}")
+    args.host = args.host or inv_host or DEFAULT_MODBUS_IP
+    args.port = args.port or inv_port or DEFAULT_MODBUS_PORT
+    if args.unit is None: args.unit = units[0]
+    elif args.unit not in units and args.inventory:
+        print(f"Attention : le MO {args.unit} n'est pas dans l'inventaire {args.inventory} ({', '.join(str(unit) for unit in units)})")
+
+    print(f"Interrogation modbus de {args.host} pour le device {args.unit}")
     print("-" * 50)    
     
     client: ModbusTcpClient = ModbusTcpClient(
@@ -44,15 +62,20 @@ def main():
     )
     registers = getRegisters
     client.connect()
-    read_registers(client, args.unit)
+    metadata = MetadataCache(args.metadata_cache).refresh(client, args.host, args.port, args.unit, force=args.refresh_metadata)
+    read_registers(client, args.unit, metadata or {})
     client.close()
 
-def read_registers(client: ModbusTcpClient, slave) -> None:
-    """Read registers."""
+def read_registers(client: ModbusTcpClient, slave, metadata=None) -> None:
+    """Read registers. Les informations statiques présentes dans metadata ne sont pas relues."""
+    metadata = metadata or {}
     error = False
 
     for k, v in getRegisters(client).items():
         addr, data_type, length, factor, comment, unit = v
+        if metadata.get(k) is not None:
+            print(f"{comment} = {metadata[k]} {unit}")
+            continue
     
         if error:
             error = False
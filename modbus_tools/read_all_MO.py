@@ -6,18 +6,32 @@ lecture modbus de certains registres pour plusieurs micro onduleurs APSystems
 teste avec des MO DS3
 se limite aux infos les plus importantes (pour moi)
 calcule les totaux de puissance
-pas optimisé : fait une requete par registre à lire
+lecture par blocs : les adresses des registres sont celles de la chaîne de modèles SunSpec du MO (voir sunspec.py), et tous les
+registres d'un MO sont lus en une ou deux requêtes. Si la chaîne est introuvable, une requete par registre, aux adresses de getRegisters
+le numéro de série n'est pas relu à chaque interrogation : il vient du cache des informations statiques des MO (voir mo_metadata.py)
+
+mode acquisition (option -a) : lecture en continu, calée sur le rafraichissement des infos par l'ECU (toutes les 5mn, + DELTA_SECONDS),
+  sans dérive, écriture en NDJSON ou CSV dans des fichiers journaliers. Remplace le cron conseillé dans README-modbus-APSystems.MD
 
 syntaxe : 
   read_all_MO.py -h : pour de l'aide
   read_all_MO.py 192.168.1.120 -u 1,11,12 : interrogation de l'ECU a l'adresse IP 192.168.1.120, pour les MO d'ID modbus 1,11,12
+  read_all_MO.py 192.168.1.120 -u 1,11,12 -a /var/lib/apsystems/mo : acquisition dans /var/lib/apsystems/mo_AAAA-MM-JJ.ndjson
   par défaut : DEFAULT_MODBUS_IP, DEFAULT_MODBUS_PORT, DEFAULT_MODBUS_DEVICES
 """
 
 import argparse
+import glob
+import json
+import logging
+import math
+import os
 import re
+import signal
+import threading
+from collections import deque
 from enum import Enum
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 import sys
 
@@ -30,15 +44,45 @@ from pymodbus.pdu import ExceptionResponse
 
 from pprint import pprint
 
+from mo_metadata import DEFAULT_METADATA_FILE, MetadataCache, load_inventory
+from sunspec import DEFAULT_LAYOUT_FILE, LayoutCache, SunSpecError, read_blocks
+
 DEFAULT_MODBUS_IP = "192.168.1.120"
 DEFAULT_MODBUS_PORT = 502
 DEFAULT_MODBUS_DEVICES = "1,11,12"
 
 # nombre de secondes après le passage à la minute exacte modulo 5 mn : xh:0mn:{delta_s}, xh:5mn:{delta_s}, etc.
 DELTA_SECONDS = 40
+# période de rafraichissement des infos des MO par l'ECU
+CYCLE_SECONDS = 300
+
+# --- mode acquisition (option -a) ---
+# l'ECU coupe une connexion modbus inutilisée depuis 5s environ : au-delà, elle est rouverte avant le cycle suivant
+ECU_IDLE_DISCONNECT_S = 5
+# nombre maximum de lignes gardées en mémoire si le fichier ne peut pas être écrit (disque plein, clé USB absente, ...).
+# Au-delà, les lignes les plus anciennes sont perdues (et comptées)
+WRITE_BUFFER_MAX_LINES = 10000
+# nombre de fichiers journaliers conservés. 0 : pas de suppression
+DEFAULT_KEEP_FILES = 90
+# statistiques d'acquisition écrites dans la log tous les STATS_LOG_CYCLES cycles (12 : toutes les heures)
+STATS_LOG_CYCLES = 12
 
 MOs = []   # liste des MO a interroger
 
+# point SunSpec (modèle, nom du point) de chaque registre lu : son adresse est celle de la disposition du MO
+SUNSPEC_POINTS = {
+    "serialnumber":      (1, "SN"),
+    "power_ac":          (101, "W"),
+    "energy_total":      (101, "WH"),
+    "temperature":       (101, "TmpCab"),
+    "status":            (101, "St"),
+    "connected":         (123, "Conn"),
+    "power_max_lim":     (123, "WMaxLimPct"),
+    "power_max_lim_ena": (123, "WMaxLim_Ena"),
+    "DC1_power":         (64001, "DCW1"),
+    "DC2_power":         (64001, "DCW2"),
+}
+
 INVERTER_STATUS_MAP = [
     "Undefined",
     "Off",
@@ -53,12 +97,30 @@ INVERTER_STATUS_MAP = [
 
 def main() -> None:    
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("host", type=str, nargs='?', default = DEFAULT_MODBUS_IP, help=f"Modbus TCP address. default {DEFAULT_MODBUS_IP}")
-    argparser.add_argument("-p", "--port", type=int, default = DEFAULT_MODBUS_PORT, help=f"Modbus TCP port. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("host", type=str, nargs='?', help=f"Modbus TCP address. default : celle de l'inventaire, sinon {DEFAULT_MODBUS_IP}")
+    argparser.add_argument("-p", "--port", type=int, help=f"Modbus TCP port. default : celui de l'inventaire, sinon {DEFAULT_MODBUS_PORT}")
     argparser.add_argument("-u", "--units", type=str, default = DEFAULT_MODBUS_DEVICES, help=f"List Modbus devices address. default {DEFAULT_MODBUS_DEVICES}")
     argparser.add_argument("-r", "--repeat", action="store_true", help="Répète la lecture toutes les 5 minutes à xx:x0:35s et xx:x5:35s.")
     argparser.add_argument("-nv", "--noverbose", action="store_true", help="sortie avec infos limitées, en format CSV")
+    argparser.add_argument("-a", "--acquire", type=str, metavar="PREFIX", help="mode acquisition : lecture en continu toutes les 5 minutes, écriture dans PREFIX_AAAA-MM-JJ.ndjson (ou .csv)")
+    argparser.add_argument("-f", "--format", type=str, choices=["ndjson", "csv"], default="ndjson", help="mode acquisition : format des fichiers. default ndjson")
+    argparser.add_argument("-k", "--keep", type=int, default=DEFAULT_KEEP_FILES, help=f"mode acquisition : nombre de fichiers journaliers conservés, 0 pour tous. default {DEFAULT_KEEP_FILES}")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="mode acquisition : logs détaillés (un message par cycle)")
+    argparser.add_argument("-mc", "--metadata-cache", type=str, default=DEFAULT_METADATA_FILE, help=f"fichier du cache des informations statiques des MO, chaine vide pour un cache en mémoire seulement. default {DEFAULT_METADATA_FILE}")
+    argparser.add_argument("-rm", "--refresh-metadata", action="store_true", help="vérifie le numéro de série de chaque MO au démarrage, même si le cache est récent")
+    argparser.add_argument("-lc", "--layout-cache", type=str, default=DEFAULT_LAYOUT_FILE, help=f"fichier du cache des dispositions SunSpec, chaine vide pour un cache en mémoire seulement. default {DEFAULT_LAYOUT_FILE}")
+    argparser.add_argument("-i", "--inventory", type=str, help="inventaire produit par discover_MO.py : interrogation de tous les MO de l'inventaire (remplace -u)")
     args = argparser.parse_args()
+
+    inv_host = inv_port = None
+    if args.inventory:
+        try:
+            inv_host, inv_port, units, _ = load_inventory(args.inventory)
+        except (OSError, ValueError) as e:
+            argparser.error(f"inventaire {args.inventory} illisible : {e}")
+        args.units = ",".join(str(unit) for unit in units)
+    args.host = args.host or inv_host or DEFAULT_MODBUS_IP
+    args.port = args.port or inv_port or DEFAULT_MODBUS_PORT
     
     liste = ""
     for item in args.units.split(','):
@@ -73,9 +135,17 @@ def main() -> None:
     )
 
     registers = getRegisters(client)
+    cache = MetadataCache(args.metadata_cache)
+    layouts = LayoutCache(args.layout_cache)
+
+    if args.acquire:
+        logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+        acquire(client, MOs, registers, AcquisitionWriter(args.acquire, args.format, args.keep, registers), cache, layouts)
+        return
     
     # Exécution immédiate de la fonction
-    read_all_MOs(client, MOs, liste, registers)
+    read_all_MOs(client, MOs, liste, registers, cache=cache, force_check=args.refresh_metadata, layouts=layouts)
     
     if args.noverbose:
         print("timestamp;modbus_id;serial_number;power;DC1_power;DC2_power;power_max_limit")
@@ -90,31 +160,14 @@ def main() -> None:
         try:
             while True:
                 # Calcul du prochain instant d'exécution
-                now = datetime.now()
-                minute_de_base = (now.minute // 5) * 5
-                
-                prochain_instant = now.replace(minute=minute_de_base, second=DELTA_SECONDS, microsecond=0) + timedelta(minutes=5)
-
-                instant_cette_periode = now.replace(minute=minute_de_base, second=DELTA_SECONDS, microsecond=0)
-                if now < instant_cette_periode + timedelta(minutes=5):
-                     prochain_instant = instant_cette_periode + timedelta(minutes=5)
-                
-                if now.minute % 5 == 0 and now.second < DELTA_SECONDS:
-                    prochain_instant = now.replace(second=DELTA_SECONDS, microsecond=0)
-                
-                if now > instant_cette_periode and now < instant_cette_periode + timedelta(seconds=2):
-                    prochain_instant = instant_cette_periode + timedelta(minutes=5)
-                
-                if prochain_instant <= now:
-                    prochain_instant = prochain_instant + timedelta(minutes=5)
-
-                temps_a_attendre = (prochain_instant - now).total_seconds()
+                prochain_instant = next_cycle_time(time.time())
+                temps_a_attendre = max(0, prochain_instant - time.time())
                 
                 if not args.noverbose:
-                    print(f"Prochaine lecture à {prochain_instant.strftime('%Y-%m-%d %H:%M:%S')}. En attente pendant {temps_a_attendre:.0f} secondes.")
+                    print(f"Prochaine lecture à {datetime.fromtimestamp(prochain_instant).strftime('%Y-%m-%d %H:%M:%S')}. En attente pendant {temps_a_attendre:.0f} secondes.")
                 time.sleep(temps_a_attendre)
                 
-                read_all_MOs(client, MOs, liste, registers)
+                read_all_MOs(client, MOs, liste, registers, cache=cache, layouts=layouts)
                 
                 if args.noverbose:
                     print_resultcsv(MOs, liste, registers)
@@ -126,22 +179,197 @@ def main() -> None:
             sys.exit(0)
 
 
-def read_all_MOs(client, MOs, liste, registers):
-    client.connect()
+def next_cycle_time(now):
+    """Prochain instant (timestamp) de lecture, strictement après now : minute exacte modulo 5mn, + DELTA_SECONDS.
+    Calculé depuis l'origine des timestamps, et non par cumul de délais : pas de dérive. Les fuseaux horaires étant décalés
+    de multiples de 15mn, le calage sur l'heure locale est le même."""
+    return (math.floor((now - DELTA_SECONDS) / CYCLE_SECONDS) + 1) * CYCLE_SECONDS + DELTA_SECONDS
+
+def read_all_MOs(client, MOs, liste, registers, keep_open=False, cache=None, force_check=False, layouts=None):
+    if not keep_open or not client.connected:
+        client.connect()
+    host, port = client.comm_params.host, client.comm_params.port
 
     for one_MO in MOs:
         for k in registers.keys():
             one_MO[k] = None
-        read_one_MO(client, one_MO, registers)
+        skip, metadata = (), None
+        if cache is not None:
+            metadata = cache.refresh(client, host, port, one_MO["modbusid"], force=force_check)
+            if metadata:
+                one_MO["serialnumber"] = metadata["serialnumber"]
+                skip = ("serialnumber",)
+        layout = None
+        if layouts is not None:
+            try:
+                layout = layouts.layout(client, one_MO["modbusid"], metadata)
+            except SunSpecError as e:
+                print(f"{e} : lecture registre par registre")
+        if layout is not None:
+            read_one_MO_blocks(client, one_MO, registers, layout, skip, layouts)
+        else:
+            read_one_MO(client, one_MO, registers, skip)
+        if cache is not None and any(one_MO.get(k) is None for k in registers):
+            cache.flag(host, port, one_MO["modbusid"])   # MO remplacé ou déconnecté ? vérification au prochain cycle
+    if not keep_open:
+        client.close()
+
+
+class AcquisitionWriter:
+    """Ecriture des mesures en NDJSON ou CSV, dans un fichier par jour (PREFIX_AAAA-MM-JJ.ext).
+    Les lignes passent par un tampon borné : si l'écriture échoue, elles sont gardées pour le cycle suivant, dans la limite
+    de WRITE_BUFFER_MAX_LINES. Seuls les `keep` fichiers les plus récents sont conservés."""
+    def __init__(self, prefix, fmt, keep, registers):
+        self.prefix, self.fmt, self.keep = prefix, fmt, keep
+        self.columns = ["timestamp", "modbus_id", "ok"] + list(registers)
+        self.buffer = deque(maxlen=WRITE_BUFFER_MAX_LINES)   # (jour, ligne)
+        self.dropped = 0
+        self.write_errors = 0
+        self.current_path = None
+
+    def add(self, timestamp, MOs, registers):
+        day = timestamp.strftime("%Y-%m-%d")
+        for one_MO in MOs:
+            record = {"timestamp": timestamp.isoformat(timespec="seconds"), "modbus_id": one_MO["modbusid"],
+                      "ok": all(one_MO.get(k) is not None for k in registers)}
+            for k, (addr, data_type, length, factor, comment, unit) in registers.items():
+                value = one_MO.get(k)
+                if value is not None and factor != 0:
+                    value = round(value * factor, 3)
+                elif isinstance(value, float):
+                    value = round(value, 3)
+                record[k] = value
+            if self.fmt == "ndjson":
+                line = json.dumps(record)
+            else:
+                line = ";".join("" if record[c] is None else str(record[c]) for c in self.columns)
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append((day, line))
+
+    def flush(self):
+        """Ecrit le tampon. Retourne False si l'écriture a échoué (les lignes restent dans le tampon)."""
+        while self.buffer:
+            day = self.buffer[0][0]
+            lines = []
+            while self.buffer and self.buffer[0][0] == day:
+                lines.append(self.buffer.popleft()[1])
+            path = f"{self.prefix}_{day}.{self.fmt}"
+            try:
+                new_file = not os.path.exists(path)
+                with open(path, "a", encoding="utf-8") as f:
+                    if new_file and self.fmt == "csv":
+                        f.write(";".join(self.columns) + "\n")
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                self.write_errors += 1
+                logging.warning(f"Ecriture impossible dans {path} : {e}. {len(lines) + len(self.buffer)} lignes gardées en mémoire")
+                self.buffer.extendleft((day, line) for line in reversed(lines))
+                return False
+            if path != self.current_path:
+                self.current_path = path
+                logging.info(f"Ecriture dans {path}")
+                self.rotate()
+        return True
+
+    def rotate(self):
+        if self.keep <= 0: return
+        for old in sorted(glob.glob(f"{glob.escape(self.prefix)}_????-??-??.{self.fmt}"))[:-self.keep]:
+            try:
+                os.remove(old)
+                logging.info(f"Suppression de l'ancien fichier {old}")
+            except OSError as e:
+                logging.warning(f"Suppression de {old} impossible : {e}")
+
+
+def acquire(client, MOs, registers, writer, cache, layouts=None):
+    """Mode acquisition : un cycle de lecture à chaque instant donné par next_cycle_time(), jusqu'à SIGTERM ou Ctrl-C.
+    Si un cycle déborde sur le suivant (ECU lent, machine suspendue), les instants dépassés sont comptés comme manqués."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    units = ", ".join(str(one_MO["modbusid"]) for one_MO in MOs)
+    logging.info(f"Acquisition des MO {units} toutes les {CYCLE_SECONDS}s (+{DELTA_SECONDS}s), format {writer.fmt}, préfixe {writer.prefix}")
+
+    stats = {"cycles": 0, "missed": 0, "errors": 0, "late_max": 0.0, "durations": []}
+    last_used = 0.0
+    due = next_cycle_time(time.time())
+    while not stop.wait(max(0.0, due - time.time())):
+        started = time.time()
+        late = started - due
+        if time.time() - last_used > ECU_IDLE_DISCONNECT_S:
+            client.close()    # connexion probablement coupée par l'ECU : rouverte proprement par read_all_MOs
+        read_all_MOs(client, MOs, None, registers, keep_open=True, cache=cache, force_check=stats["cycles"] == 0, layouts=layouts)
+        failed = [one_MO["modbusid"] for one_MO in MOs if any(one_MO.get(k) is None for k in registers)]
+        if failed:
+            # une requête en échec laisse la connexion dans un état incertain : nouvelle tentative, sur une connexion neuve
+            client.close()
+            retry = [one_MO for one_MO in MOs if one_MO["modbusid"] in failed]
+            read_all_MOs(client, retry, None, registers, keep_open=True, cache=cache, layouts=layouts)
+            failed = [one_MO["modbusid"] for one_MO in retry if any(one_MO.get(k) is None for k in registers)]
+        last_used = time.time()
+        duration = last_used - started
+        writer.add(datetime.fromtimestamp(due), MOs, registers)
+        writer.flush()
+
+        stats["cycles"] += 1
+        stats["errors"] += len(failed)
+        stats["late_max"] = max(stats["late_max"], late)
+        stats["durations"].append(duration)
+        logging.debug(f"Cycle {datetime.fromtimestamp(due).strftime('%H:%M:%S')} : retard {late:.2f}s, durée {duration:.2f}s"
+                      + (f", MO en erreur : {', '.join(str(u) for u in failed)}" if failed else ""))
+        if failed:
+            logging.warning(f"Lecture en échec pour les MO {', '.join(str(u) for u in failed)}")
+
+        next_due = next_cycle_time(time.time())
+        missed = round((next_due - due) / CYCLE_SECONDS) - 1
+        if missed > 0:
+            logging.warning(f"{missed} cycle(s) manqué(s) : le cycle de {datetime.fromtimestamp(due).strftime('%H:%M:%S')} a duré {duration:.0f}s")
+            stats["missed"] += missed
+        due = next_due
+        if stats["cycles"] % STATS_LOG_CYCLES == 0:
+            log_stats(stats, writer)
+    writer.flush()
     client.close()
+    log_stats(stats, writer)
+    logging.info("Arrêt de l'acquisition")
+
+def log_stats(stats, writer):
+    durations = sorted(stats["durations"])
+    if not durations: return
+    logging.info(f"Acquisition : {stats['cycles']} cycles, {stats['missed']} manqués, {stats['errors']} lectures de MO en échec. "
+                 f"Durée d'un cycle : médiane {durations[len(durations) // 2]:.2f}s, max {durations[-1]:.2f}s. Retard max {stats['late_max']:.2f}s. "
+                 f"Lignes en attente d'écriture {len(writer.buffer)}, perdues {writer.dropped}, erreurs d'écriture {writer.write_errors}")
+    stats["durations"].clear()
+    stats["late_max"] = 0.0
     
     
-def read_one_MO(client: ModbusTcpClient, one_MO, registers):
-    """Read registers."""
+def read_one_MO_blocks(client: ModbusTcpClient, one_MO, registers, layout, skip=(), layouts=None):
+    """Read registers par blocs, aux adresses de la disposition SunSpec du MO, sauf ceux de skip (déjà connus).
+    Les valeurs sont brutes, comme pour read_one_MO : le facteur de getRegisters est appliqué à l'affichage."""
+    slave = one_MO.get("modbusid")
+    addresses = {}
+    for k, (addr, data_type, length, factor, comment, unit) in registers.items():
+        if k not in skip:
+            addresses[k] = layout.address(*SUNSPEC_POINTS[k]) if k in SUNSPEC_POINTS else addr
+    image = read_blocks(client, slave, layout, [(addresses[k], registers[k][2]) for k in addresses if addresses[k]], layouts)
+    for k, addr in addresses.items():
+        values = [image.get(a) for a in range(addr, addr + registers[k][2])] if addr else [None]
+        if None in values:
+            print(f"Erreur de lecture pour MO {slave} au registre {addr or k}")
+            return
+        one_MO[k] = client.convert_from_registers(values, registers[k][1])
+
+def read_one_MO(client: ModbusTcpClient, one_MO, registers, skip=()):
+    """Read registers, sauf ceux de skip (déjà connus)."""
     error = False
 
     for k, v in registers.items():
         addr, data_type, length, factor, comment, unit = v
+        if k in skip:
+            continue
     
         if error:
             return
@@ -150,7 +378,7 @@ def read_one_MO(client: ModbusTcpClient, one_MO, registers):
 
         try:
             rr = client.read_holding_registers(address=addr, count=length, slave=slave)
-        except ModbusException as exc:
+        except (ModbusException, OSError) as exc:   # OSError : connexion coupée par l'ECU
             print(f"Erreur Modbus pour MO {slave} au registre {addr}: {exc!s}")
             error = True
             continue
@@ -191,7 +419,7 @@ def print_result(MOs, liste, registers):
         print(f"|{comment:^15}", end='')
     print("|")
     for one_MO in MOs:
-        print(f"|{one_MO.get("modbusid"):^15}", end='')
+        print(f"|{one_MO.get('modbusid'):^15}", end='')
         for k, v in registers.items():
             addr, data_type, length, factor, comment, unit = v
             value = one_MO.get(k)
@@ -221,9 +449,9 @@ def print_result(MOs, liste, registers):
                 totaux[k] += value
         print("|")
     print("", "-"*((16*(len(registers)+1)-1)))
-    print(f"Total AC Power : {totaux.get("power_ac"):.0f} W")
-    print(f"Total DC Power : {(totaux.get("DC1_power") + totaux.get("DC2_power")):.0f} W")
-    print(f"Total Energy   : {totaux.get("energy_total"):.3f} kWh")
+    print(f"Total AC Power : {totaux.get('power_ac'):.0f} W")
+    print(f"Total DC Power : {(totaux.get('DC1_power') + totaux.get('DC2_power')):.0f} W")
+    print(f"Total Energy   : {totaux.get('energy_total'):.3f} kWh")
     
 def getRegisters(client: ModbusTcpClient):
 # key, data_type, length, factor, comment, unit
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+sunspec.py
+
+lecture des MO APSystems par la structure SunSpec, sans adresses de registres codées en dur
+les registres d'un MO sont organisés en une chaîne de modèles SunSpec, qui commence après le marqueur 'SunS' (40000) :
+  modèle commun (1), onduleur (101 monophasé, 103 triphasé), plaque signalétique (120), réglages (121), contrôles immédiats (123),
+  modèle constructeur APsystems (64001 : tension, courant et puissance DC de chaque entrée)
+Chaque modèle a une entête (identifiant, longueur) : la chaîne est parcourue une fois, et la disposition obtenue est gardée dans
+un petit fichier JSON, par firmware (fabricant/modèle/version). Les MO suivants, et les exécutions suivantes, n'ont plus à la
+parcourir.
+
+Les lectures se font par modèle entier : les modèles demandés sont regroupés en blocs de registres contigus, de
+MAX_REGISTERS_PER_REQUEST registres au plus, soit une ou deux requêtes modbus par MO au lieu d'une par registre. Si l'ECU
+refuse un bloc trop grand, la taille maximum est divisée par deux, et retenue avec la disposition.
+Les facteurs d'échelle (points *_SF) sont appliqués au décodage de chaque modèle.
+
+syntaxe :
+  sunspec.py -h : pour de l'aide
+  sunspec.py 192.168.1.120 -u 11 : chaîne de modèles et valeurs décodées du MO d'ID modbus 11
+  sunspec.py 192.168.1.120 -u 11 -m 101,64001 : seulement les modèles 101 et 64001
+"""
+
+import argparse
+import json
+import os
+import struct
+from datetime import datetime
+
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
+
+DEFAULT_MODBUS_IP = "192.168.1.120"
+DEFAULT_MODBUS_PORT = 502
+# fichier du cache des dispositions, dans le répertoire des scripts
+DEFAULT_LAYOUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sunspec_layout.json")
+
+# adresses possibles du marqueur 'SunS' (norme SunSpec). L'ECU APsystems utilise 40000
+SUNSPEC_BASE_ADDRESSES = (40000, 0, 50000)
+SUNSPEC_MARKER = [0x5375, 0x6E53]    # "SunS"
+SUNSPEC_END_MODEL = 0xFFFF
+# nombre maximum de registres par requête (limite du protocole modbus). Réduit automatiquement si l'ECU refuse
+MAX_REGISTERS_PER_REQUEST = 125
+# nombre maximum de modèles dans une chaîne : protection contre une chaîne corrompue
+MAX_MODELS = 32
+
+# --- points décodés, par modèle : nom -> (décalage depuis le début des données, type, longueur, facteur d'échelle) ---
+# le facteur d'échelle est le nom d'un point *_SF du même modèle, ou un exposant fixe (entier), ou None
+INVERTER_POINTS = {
+    "A":       (0,  "uint16", 1, "A_SF"),     "AphA":  (1,  "uint16", 1, "A_SF"),
+    "AphB":    (2,  "uint16", 1, "A_SF"),     "AphC":  (3,  "uint16", 1, "A_SF"),
+    "A_SF":    (4,  "sunssf", 1, None),
+    "PhVphA":  (8,  "uint16", 1, "V_SF"),     "PhVphB": (9, "uint16", 1, "V_SF"),
+    "PhVphC":  (10, "uint16", 1, "V_SF"),     "V_SF":  (11, "sunssf", 1, None),
+    "W":       (12, "int16",  1, "W_SF"),     "W_SF":  (13, "sunssf", 1, None),
+    "Hz":      (14, "uint16", 1, "Hz_SF"),    "Hz_SF": (15, "sunssf", 1, None),
+    "VA":      (16, "int16",  1, "VA_SF"),    "VA_SF": (17, "sunssf", 1, None),
+    "VAr":     (18, "int16",  1, "VAr_SF"),   "VAr_SF": (19, "sunssf", 1, None),
+    "PF":      (20, "int16",  1, "PF_SF"),    "PF_SF": (21, "sunssf", 1, None),
+    "WH":      (22, "acc32",  2, "WH_SF"),    "WH_SF": (24, "sunssf", 1, None),
+    "TmpCab":  (31, "int16",  1, "Tmp_SF"),   "Tmp_SF": (35, "sunssf", 1, None),
+    "St":      (36, "enum16", 1, None),       "StVnd": (37, "enum16", 1, None),
+    "Evt1":    (38, "uint32", 2, None),
+}
+MODEL_POINTS = {
+    1: {
+        "Mn": (0, "string", 16, None), "Md": (16, "string", 16, None), "Opt": (32, "string", 8, None),
+        "Vr": (40, "string", 8, None), "SN": (48, "string", 16, None), "DA":  (64, "uint16", 1, None),
+    },
+    101: INVERTER_POINTS,
+    103: INVERTER_POINTS,
+    120: {
+        "DERTyp": (0, "enum16", 1, None),
+        "WRtg":   (1, "uint16", 1, "WRtg_SF"),  "WRtg_SF":  (2, "sunssf", 1, None),
+        "VARtg":  (3, "uint16", 1, "VARtg_SF"), "VARtg_SF": (4, "sunssf", 1, None),
+        "ARtg":   (10, "uint16", 1, "ARtg_SF"), "ARtg_SF":  (11, "sunssf", 1, None),
+    },
+    121: {
+        "WMax":  (0, "uint16", 1, "WMax_SF"),   "WMax_SF": (20, "sunssf", 1, None),
+        "VRef":  (1, "uint16", 1, "VRef_SF"),   "VRef_SF": (21, "sunssf", 1, None),
+        "VMax":  (3, "uint16", 1, "VMinMax_SF"), "VMin": (4, "uint16", 1, "VMinMax_SF"),
+        "VMinMax_SF": (23, "sunssf", 1, None),
+        "VAMax": (5, "uint16", 1, "VAMax_SF"),  "VAMax_SF": (24, "sunssf", 1, None),
+    },
+    123: {
+        "Conn":         (2,  "enum16", 1, None),
+        # l'ECU ne renseigne pas WMaxLimPct_SF : échelle 0.1% de la doc APSystems_modbus_registers.xlsx
+        "WMaxLimPct":   (3,  "uint16", 1, -1),
+        "WMaxLim_Ena":  (7,  "enum16", 1, None),
+        "OutPFSet":     (8,  "int16",  1, "OutPFSet_SF"),
+        "OutPFSet_Ena": (12, "enum16", 1, None),
+        "VArPct_Mod":   (19, "enum16", 1, None),
+        "VArPct_Ena":   (20, "enum16", 1, None),
+        "OutPFSet_SF":  (22, "sunssf", 1, None),
+    },
+    64001: {
+        "DCV1": (2,  "float32", 2, None), "DCV2": (4,  "float32", 2, None),
+        "DCA1": (18, "float32", 2, None), "DCA2": (20, "float32", 2, None),
+        "DCW1": (34, "float32", 2, None), "DCW2": (36, "float32", 2, None),
+    },
+}
+# valeurs "non implémenté" de la norme SunSpec
+NOT_IMPLEMENTED = {"uint16": 0xFFFF, "enum16": 0xFFFF, "int16": 0x8000, "sunssf": 0x8000, "uint32": 0xFFFFFFFF}
+
+
+class SunSpecError(Exception):
+    """Chaîne de modèles introuvable ou invalide."""
+
+
+def decode_point(registers, data_type):
+    """Décode les registres d'un point. Retourne None pour une valeur "non implémenté"."""
+    if data_type == "string":
+        return struct.pack(f">{len(registers)}H", *registers).decode(errors="replace").strip("\x00 ")
+    if data_type == "float32":
+        return struct.unpack(">f", struct.pack(">2H", *registers))[0]
+    value = registers[0] << 16 | registers[1] if len(registers) == 2 else registers[0]
+    if value == NOT_IMPLEMENTED.get(data_type):
+        return None
+    if data_type in ("int16", "sunssf") and value >= 0x8000:
+        value -= 0x10000
+    return value
+
+
+def decode_model(model_id, registers):
+    """Décode les données d'un modèle (registres qui suivent l'entête) : les points bruts d'abord, puis les facteurs d'échelle
+    appliqués en une passe. Les points inconnus ou hors de la longueur du modèle sont ignorés."""
+    points = MODEL_POINTS.get(model_id, {})
+    raw = {name: decode_point(registers[offset:offset + length], data_type)
+           for name, (offset, data_type, length, sf) in points.items() if offset + length <= len(registers)}
+    values = {}
+    for name, value in raw.items():
+        sf = points[name][3]
+        if name.endswith("_SF"):
+            continue
+        exponent = sf if isinstance(sf, int) else (raw.get(sf) or 0) if sf else 0
+        values[name] = value * 10 ** exponent if value is not None and exponent else value
+    return values
+
+
+def read_registers(client, unit, address, count):
+    """Lecture d'un bloc de registres. Retourne la liste des valeurs, ExceptionResponse si l'ECU refuse la requête, ou None
+    en cas d'erreur de communication."""
+    try:
+        rr = client.read_holding_registers(address=address, count=count, slave=unit)
+    except (ModbusException, OSError):
+        return None
+    if isinstance(rr, ExceptionResponse):
+        return rr
+    if rr.isError():
+        return None
+    return rr.registers
+
+
+class Layout:
+    """Disposition des modèles d'un firmware : [(identifiant, adresse de l'entête, longueur)], et taille maximum d'une requête."""
+    def __init__(self, models, max_block=MAX_REGISTERS_PER_REQUEST):
+        self.models = [tuple(model) for model in models]
+        self.max_block = max_block
+
+    def find(self, model_id):
+        """(adresse des données, longueur) du premier modèle model_id, ou None. 101 et 103 sont interchangeables."""
+        for mid, header, length in self.models:
+            if mid == model_id or {mid, model_id} == {101, 103}:
+                return header + 2, length
+        return None
+
+    def address(self, model_id, point):
+        """Adresse absolue d'un point, ou None si le modèle est absent."""
+        found = self.find(model_id)
+        return found[0] + MODEL_POINTS[model_id][point][0] if found else None
+
+    def plan(self, spans):
+        """Regroupe des plages (adresse, nombre) en blocs contigus de max_block registres au plus ; une plage plus longue est
+        découpée. Les registres entre deux plages d'un même bloc sont lus aussi : ils appartiennent à la chaîne, la lecture
+        est sans effet."""
+        blocks = []
+        for address, count in sorted(spans):
+            for piece in range(address, address + count, self.max_block):
+                end = min(piece + self.max_block, address + count)
+                if blocks and end - blocks[-1][0] <= self.max_block:
+                    blocks[-1] = (blocks[-1][0], max(blocks[-1][1], end - blocks[-1][0]))
+                else:
+                    blocks.append((piece, end - piece))
+        return blocks
+
+    def as_dict(self):
+        return {"models": [list(model) for model in self.models], "max_block": self.max_block}
+
+
+def read_common(client, unit):
+    """Cherche le marqueur 'SunS', et lit le modèle commun dans la même requête. Retourne (adresse du marqueur, valeurs du
+    modèle commun). Lève SunSpecError si le marqueur est introuvable, ou si le MO ne répond pas."""
+    for base in SUNSPEC_BASE_ADDRESSES:
+        registers = read_registers(client, unit, base, 4 + 66)
+        if isinstance(registers, ExceptionResponse):
+            # requête trop grande pour l'ECU, ou pas de registres à cette adresse : marqueur et entête seuls
+            registers = read_registers(client, unit, base, 4)
+            if isinstance(registers, list) and registers[:2] == SUNSPEC_MARKER:
+                image = read_blocks(client, unit, Layout([], MAX_REGISTERS_PER_REQUEST // 2), [(base + 4, registers[3])])
+                registers += [image.get(a, 0) for a in range(base + 4, base + 4 + registers[3])]
+        if registers is None:
+            break    # pas de réponse : inutile d'essayer les autres adresses
+        if isinstance(registers, list) and registers[:2] == SUNSPEC_MARKER and registers[2] == 1:
+            return base, decode_model(1, registers[4:4 + registers[3]])
+    raise SunSpecError(f"MO {unit} : marqueur SunSpec introuvable")
+
+
+def walk_chain(client, unit, found=None):
+    """Parcourt la chaîne de modèles depuis le marqueur 'SunS'. found : résultat de read_common, s'il a déjà été lu.
+    Retourne (Layout, valeurs du modèle commun). Lève SunSpecError si la chaîne est introuvable, ou si le MO ne répond pas."""
+    base, common = found or read_common(client, unit)
+    models, header = [], base + 2
+    for _ in range(MAX_MODELS):
+        entry = read_registers(client, unit, header, 2)
+        if not isinstance(entry, list):
+            raise SunSpecError(f"MO {unit} : lecture de l'entête de modèle {header} impossible")
+        model_id, length = entry
+        if model_id == SUNSPEC_END_MODEL:
+            return Layout(models), common
+        models.append((model_id, header, length))
+        header += 2 + length
+    raise SunSpecError(f"MO {unit} : chaîne de modèles trop longue, pas de marqueur de fin")
+
+
+def firmware_key(common):
+    return f"{common.get('Mn')}/{common.get('Md')}/{common.get('Vr')}"
+
+
+class LayoutCache:
+    """Dispositions des chaînes de modèles, par firmware, persistantes. path vide : cache en mémoire seulement."""
+    def __init__(self, path=DEFAULT_LAYOUT_FILE):
+        self.path = path
+        self.layouts = {}    # "fabricant/modèle/version" -> Layout
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.layouts = {key: Layout(**value) for key, value in json.load(f).items()}
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Cache des dispositions SunSpec {path} illisible, il sera reconstruit : {e}")
+
+    def layout(self, client, unit, metadata=None, refresh=False):
+        """Disposition des modèles du MO. metadata : informations statiques du MO (voir mo_metadata.py) ; si elles sont
+        connues, et la disposition de ce firmware aussi, aucune requête n'est faite. Sinon, le modèle commun est lu (une
+        requête), et la chaîne n'est parcourue que pour un firmware inconnu. Lève SunSpecError."""
+        if metadata and not refresh:
+            key = f"{metadata.get('manufacturer')}/{metadata.get('model')}/{metadata.get('version')}"
+            if key in self.layouts:
+                return self.layouts[key]
+        found = None
+        if not refresh:
+            found = read_common(client, unit)
+            layout = self.layouts.get(firmware_key(found[1]))
+            if layout:
+                return layout
+        layout, common = walk_chain(client, unit, found)
+        self.layouts[firmware_key(common)] = layout
+        self.save()
+        return layout
+
+    def save(self):
+        """Ecriture atomique du fichier (fichier temporaire puis renommage)."""
+        if not self.path: return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({key: layout.as_dict() for key, layout in self.layouts.items()}, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Ecriture du cache des dispositions SunSpec {self.path} impossible : {e}")
+
+
+def read_blocks(client, unit, layout, spans, cache=None):
+    """Lit les plages (adresse, nombre) en un minimum de requêtes. Retourne {adresse: valeur} des registres lus (les plages
+    en échec sont absentes). Si l'ECU refuse un bloc, la taille maximum est divisée par deux (et sauvegardée dans cache)."""
+    image, needed = {}, sorted({a for address, count in spans for a in range(address, address + count)})
+    while True:
+        # plages de registres pas encore lus : après un refus, elles sont regroupées à nouveau avec la taille réduite
+        missing = [a for a in needed if a not in image]
+        if not missing:
+            return image
+        runs = []
+        for a in missing:
+            if runs and runs[-1][0] + runs[-1][1] == a: runs[-1][1] += 1
+            else: runs.append([a, 1])
+        address, count = layout.plan(runs)[0]
+        registers = read_registers(client, unit, address, count)
+        if isinstance(registers, ExceptionResponse) and count > 1:
+            layout.max_block = max(1, min(layout.max_block, count) // 2)
+            if cache is not None: cache.save()
+            continue
+        if not isinstance(registers, list):
+            return image    # MO déconnecté ou ECU muet : inutile d'insister
+        image.update(zip(range(address, address + count), registers))
+
+
+def read_models(client, unit, layout, model_ids, cache=None):
+    """Lit et décode des modèles entiers. Retourne {identifiant: {point: valeur}} des modèles lus."""
+    spans = {model_id: layout.find(model_id) for model_id in model_ids}
+    image = read_blocks(client, unit, layout, [span for span in spans.values() if span], cache)
+    models = {}
+    for model_id, span in spans.items():
+        if span and all(a in image for a in range(span[0], span[0] + span[1])):
+            models[model_id] = decode_model(model_id, [image[a] for a in range(span[0], span[0] + span[1])])
+    return models
+
+
+def main():
+    from pymodbus.client import ModbusTcpClient
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("host", type=str, nargs='?', default = DEFAULT_MODBUS_IP, help=f"Modbus TCP address. default {DEFAULT_MODBUS_IP}")
+    argparser.add_argument("-p", "--port", type=int, default = DEFAULT_MODBUS_PORT, help=f"Modbus TCP port. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-u", "--unit", type=int, default=1, help="Modbus device address. default 1")
+    argparser.add_argument("-m", "--models", type=str, help="identifiants des modèles à lire, par exemple 101,64001. default : tous")
+    argparser.add_argument("-lc", "--layout-cache", type=str, default=DEFAULT_LAYOUT_FILE, help=f"fichier du cache des dispositions, chaine vide pour un cache en mémoire seulement. default {DEFAULT_LAYOUT_FILE}")
+    argparser.add_argument("-r", "--refresh", action="store_true", help="parcourt à nouveau la chaîne de modèles, même si la disposition est connue")
+    args = argparser.parse_args()
+
+    client = ModbusTcpClient(host=args.host, port=args.port, timeout=5)
+    client.connect()
+    cache = LayoutCache(args.layout_cache)
+    try:
+        layout = cache.layout(client, args.unit, refresh=args.refresh)
+    except SunSpecError as e:
+        print(e)
+        client.close()
+        return
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}. MO {args.unit} de {args.host} : {len(layout.models)} modèles, {layout.max_block} registres par requête au plus")
+    for model_id, header, length in layout.models:
+        print(f"  modèle {model_id:5d} : entête {header}, {length} registres")
+    model_ids = [int(m) for m in args.models.split(",")] if args.models else [model[0] for model in layout.models]
+    for model_id, values in read_models(client, args.unit, layout, model_ids, cache).items():
+        print(f"\nmodèle {model_id}")
+        for name, value in values.items():
+            print(f"  {name:12} = {value:.3f}" if isinstance(value, float) else f"  {name:12} = {value}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+chaos_scenarios.py
+
+Banc de non-régression de la robustesse de la régulation : injection de défauts dans l'ECU émulé, mesure du rétablissement.
+Pour chaque scénario, le programme lance :
+  . l'émulateur d'ECU (modbus_tools/ecu_emulator.py), dans ce process, en temps réel, à 13h par ciel clair
+  . le démon solar_power_regulator.py, dans un process séparé, avec une configuration de test (régulation permanente,
+    sans MQTT, watchdog et lecture périodique raccourcis)
+  . un Shelly simulé en boucle fermée : injection = production de l'émulateur - consommation de la maison. Il suit le
+    comportement de solar_power_regulator.js (délai sensor_read_interval, pause de 60s en cas d'erreur ou de timeout de 5s)
+Déroulement d'un scénario : stabilisation de la régulation, puis au début du défaut la consommation de la maison baisse
+brutalement (la régulation doit réduire la production pendant que le défaut est actif), fin du défaut, et observation.
+
+Mesures, par scénario :
+  . temps de rétablissement : délai entre la fin du défaut et le retour durable de l'injection dans la plage visée
+    (RECOVERY_BAND_W pendant RECOVERY_HOLD_S)
+  . énergie injectée en excès (au-delà de la plage recherchée 0..30W) et énergie importée, du début du défaut à la fin
+    de l'observation
+  . injection maximum, codes retour du démon, et erreurs http vues par le Shelly
+
+syntaxe :
+  chaos_scenarios.py -h : pour de l'aide
+  chaos_scenarios.py : tous les scénarios (environ 5mn chacun)
+  chaos_scenarios.py -s baseline,connection_reset --csv chaos.csv : deux scénarios, résultats ajoutés au fichier chaos.csv
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modbus_tools"))
+from ecu_emulator import EcuEmulator   # noqa: E402
+
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "solar_power_regulator.py")
+DEFAULT_MODBUS_PORT = 5602
+DEFAULT_HTTP_PORT = 8602            # port http du démon
+EMULATOR_START = "13:00"
+
+# --- configuration du démon pendant les essais ---
+DAEMON_CONFIG = {
+    "_comment": "configuration générée par chaos_scenarios.py",
+    "REGULATION_WINDOWS": [],       # régulation permanente
+    "MQTT_ENABLE": 0,
+    "WATCHDOG_TIMEOUT_S": 30,
+    "PERIODIC_MODBUS_READ_INTERVAL_S": 30,
+    "PERIODIC_TASK_INTERVAL_S": 5,
+}
+DAEMON_STARTUP_TIMEOUT_S = 15
+
+# --- Shelly simulé (voir CONFIG dans solar_power_regulator.js) ---
+DEFAULT_REQUEST_INTERVAL_S = 5
+PAUSE_ON_ERROR_S = 60
+HTTP_TIMEOUT_S = 5
+
+# --- maison simulée ---
+HOUSE_LOAD_W = 1200                 # consommation pendant la stabilisation
+LOAD_DROP_W = 600                   # baisse de consommation au début du défaut
+LOAD_NOISE_W = 15                   # bruit de mesure, +/-
+
+# --- déroulement et mesures ---
+SETTLE_S = 90                       # stabilisation de la régulation avant le défaut
+OBSERVE_S = 150                     # observation après la fin du défaut
+SAMPLE_INTERVAL_S = 1
+TARGET_INJECTION_W = 30             # au-delà, l'injection est comptée en excès
+RECOVERY_BAND_W = (-100, 130)       # plage d'injection considérée comme rétablie
+RECOVERY_HOLD_S = 20                # durée minimum dans la plage
+
+# faults remis à zéro en fin de défaut
+NO_FAULTS = {"offline": False, "hang_s": 0, "extra_delay_s": 0, "error_rate": 0, "ignore_writes": False, "dropout": []}
+
+# nom : (description, défauts injectés dans l'ECU, durée du défaut en secondes, Shelly muet pendant le défaut)
+SCENARIOS = {
+    "baseline":         ("aucun défaut, baisse de consommation seule", {}, 0, False),
+    "connection_reset": ("ECU injoignable : connexions modbus refusées ou coupées", {"offline": True}, 45, False),
+    "latency_spike":    ("pic de latence : +2.5s sur chaque requête modbus", {"extra_delay_s": 2.5}, 60, False),
+    "error_responses":  ("50% des requêtes modbus en erreur", {"error_rate": 0.5}, 60, False),
+    "hang":             ("ECU figé : réponse modbus après 8s", {"hang_s": 8}, 45, False),
+    "buggy_readback":   ("l'ECU perd power_limit : relu à 30.0%", {"forget_limit": True}, 0, False),
+    "inverter_dropout": ("décrochage du MO 11", {"dropout": [11]}, 60, False),
+    "silent_shelly":    ("Shelly muet plus longtemps que le watchdog", {}, DAEMON_CONFIG["WATCHDOG_TIMEOUT_S"] + 70, True),
+}
+
+
+class ShellySimulator:
+    """Shelly en boucle fermée sur l'émulateur. Tourne dans un thread jusqu'à stop()."""
+    def __init__(self, ecu, url, seed):
+        self.ecu, self.url = ecu, url
+        self.load_w = HOUSE_LOAD_W
+        self.silent = threading.Event()
+        self.stopped = threading.Event()
+        self.return_codes = Counter()
+        self.seq = 0
+        self.http_errors = 0
+        self.random = random.Random(seed)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def injection(self):
+        return sum(inv.power for inv in self.ecu.inverters.values()) - self.load_w
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.silent.is_set():
+                self.stopped.wait(1); continue
+            production = sum(inv.power for inv in self.ecu.inverters.values())
+            measured = production - self.load_w + self.random.uniform(-LOAD_NOISE_W, LOAD_NOISE_W)
+            payload = json.dumps({"injection_power": round(measured, 1), "solar_power": round(production, 1),
+                                  "seq": self.seq, "ts": round(time.time() * 1000)}).encode()
+            self.seq += 1
+            request = urllib.request.Request(self.url, data=payload, headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_S) as response:
+                    body = json.loads(response.read())
+                self.return_codes[body.get("return_code")] += 1
+                interval = body.get("sensor_read_interval") or -1
+                delay = interval if interval > 0 else DEFAULT_REQUEST_INTERVAL_S
+            except (OSError, ValueError) as e:   # URLError, timeout, réponse non JSON
+                logging.debug(f"Shelly : erreur http {e}")
+                self.http_errors += 1
+                delay = PAUSE_ON_ERROR_S
+            self.stopped.wait(delay)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def wait_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def start_daemon(args, workdir):
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(DAEMON_CONFIG, f, indent=2)
+    command = [sys.executable, DAEMON_SCRIPT, "-nd", "-ll", args.daemon_loglevel, "-lf", os.path.join(workdir, "daemon.log"),
+               "--modbus-port", str(args.modbus_port), "--http-port", str(args.http_port), "--http-host", "127.0.0.1",
+               "--state-file", "", "--energy-file", "", "-c", config_path, "127.0.0.1"]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    if not wait_port(args.http_port, DAEMON_STARTUP_TIMEOUT_S):
+        process.kill()
+        raise RuntimeError(f"le démon n'a pas démarré, voir {workdir}/daemon.log")
+    return process
+
+def recovery_time(samples, t_from):
+    """Premier instant après t_from à partir duquel l'injection reste dans RECOVERY_BAND_W pendant RECOVERY_HOLD_S.
+    Retourne le délai depuis t_from, ou None si l'injection ne s'est pas rétablie pendant l'observation."""
+    low, high = RECOVERY_BAND_W
+    start = None
+    for t, injection in samples:
+        if t < t_from: continue
+        if low <= injection <= high:
+            if start is None: start = t
+            if t - start >= RECOVERY_HOLD_S:
+                return start - t_from
+        else:
+            start = None
+    return None
+
+def run_scenario(name, args):
+    description, faults, duration, silent = SCENARIOS[name]
+    hour, minute = (int(x) for x in EMULATOR_START.split(":"))
+    start = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+    emulator = EcuEmulator("127.0.0.1", args.modbus_port, 0, start=start, refresh_interval=0, startup_quirk=False, seed=args.seed)
+    emulator.start_in_thread()
+    workdir = tempfile.mkdtemp(prefix=f"chaos_{name}_")
+    daemon = start_daemon(args, workdir)
+    shelly = ShellySimulator(emulator.ecu, f"http://127.0.0.1:{args.http_port}/regulate", args.seed)
+    samples = []   # (t, injection)
+    try:
+        shelly.start()
+        t0 = time.monotonic()
+        fault_start, fault_end, end = args.settle, args.settle + duration, args.settle + duration + args.observe
+        phase = "stabilisation"
+        while True:
+            t = time.monotonic() - t0
+            if t >= end: break
+            if phase == "stabilisation" and t >= fault_start:
+                logging.info(f"{name} : début du défaut ({description})")
+                shelly.load_w = HOUSE_LOAD_W - LOAD_DROP_W
+                if faults: emulator.set_faults(**faults)
+                if silent: shelly.silent.set()
+                phase = "défaut"
+            if phase == "défaut" and t >= fault_end:
+                logging.info(f"{name} : fin du défaut")
+                emulator.set_faults(**NO_FAULTS)
+                shelly.silent.clear()
+                phase = "observation"
+            samples.append((t, shelly.injection()))
+            time.sleep(SAMPLE_INTERVAL_S)
+    finally:
+        shelly.stop()
+        daemon.terminate()
+        daemon.wait(10)
+        emulator.stop()
+
+    in_fault = [(t, inj) for t, inj in samples if t >= fault_start]
+    excess_wh = sum(max(0.0, inj - TARGET_INJECTION_W) for _, inj in in_fault) * SAMPLE_INTERVAL_S / 3600
+    import_wh = sum(max(0.0, -inj) for _, inj in in_fault) * SAMPLE_INTERVAL_S / 3600
+    recovery = recovery_time(samples, fault_end)
+    return {
+        "scenario": name, "recovery_s": None if recovery is None else round(recovery, 1),
+        "excess_wh": round(excess_wh, 2), "import_wh": round(import_wh, 2),
+        "max_injection_w": round(max(inj for _, inj in in_fault), 0),
+        "return_codes": dict(sorted(shelly.return_codes.items(), key=lambda kv: str(kv[0]))), "http_errors": shelly.http_errors,
+        "log": os.path.join(workdir, "daemon.log"),
+    }
+
+def print_results(results):
+    print(f"\n{'scénario':<18} {'rétabli (s)':>11} {'excès (Wh)':>10} {'import (Wh)':>11} {'inj max (W)':>11} {'err http':>8}  codes retour")
+    for r in results:
+        recovery = "non rétabli" if r["recovery_s"] is None else f"{r['recovery_s']:.1f}"
+        codes = " ".join(f"{code}:{count}" for code, count in r["return_codes"].items())
+        print(f"{r['scenario']:<18} {recovery:>11} {r['excess_wh']:>10.2f} {r['import_wh']:>11.2f} {r['max_injection_w']:>11.0f} {r['http_errors']:>8}  {codes}")
+
+def append_csv(path, results):
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, delimiter=";")
+        if new_file:
+            writer.writerow(["date", "scenario", "recovery_s", "excess_wh", "import_wh", "max_injection_w", "http_errors"])
+        date = datetime.now().isoformat(timespec="seconds")
+        for r in results:
+            writer.writerow([date, r["scenario"], "" if r["recovery_s"] is None else r["recovery_s"], r["excess_wh"], r["import_wh"],
+                             r["max_injection_w"], r["http_errors"]])
+
+def main():
+    argparser = argparse.ArgumentParser(description="Scénarios de défauts : mesure du rétablissement de la régulation.",
+                                        epilog="scénarios : " + ", ".join(f"{name} ({desc})" for name, (desc, *_) in SCENARIOS.items()))
+    argparser.add_argument("-s", "--scenario", type=str, default=",".join(SCENARIOS), help="scénarios à exécuter, séparés par des virgules. default : tous")
+    argparser.add_argument("-p", "--modbus-port", type=int, default=DEFAULT_MODBUS_PORT, help=f"port modbus de l'émulateur. default {DEFAULT_MODBUS_PORT}")
+    argparser.add_argument("-hp", "--http-port", type=int, default=DEFAULT_HTTP_PORT, help=f"port http du démon. default {DEFAULT_HTTP_PORT}")
+    argparser.add_argument("--settle", type=float, default=SETTLE_S, help=f"durée de stabilisation avant le défaut, en secondes. default {SETTLE_S}")
+    argparser.add_argument("--observe", type=float, default=OBSERVE_S, help=f"durée d'observation après le défaut, en secondes. default {OBSERVE_S}")
+    argparser.add_argument("--csv", type=str, help="ajoute les résultats à ce fichier csv (suivi des régressions)")
+    argparser.add_argument("--seed", type=int, default=0, help="graine aléatoire du bruit de mesure. default 0")
+    argparser.add_argument("-ll", "--daemon-loglevel", type=str, default="info", choices=['debug', 'info', 'warn', 'err'], help="niveau de log du démon. default info")
+    argparser.add_argument("-v", "--verbose", action="store_true", help="logs détaillés")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    names = [name.strip() for name in args.scenario.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        argparser.error(f"scénario(s) inconnu(s) : {', '.join(unknown)}")
+
+    results = []
+    for name in names:
+        logging.info(f"--- scénario {name} ---")
+        result = run_scenario(name, args)
+        recovery = "non rétabli" if result["recovery_s"] is None else f"rétablissement {result['recovery_s']}s"
+        logging.info(f"{name} : {recovery}, excès {result['excess_wh']}Wh, log du démon {result['log']}")
+        results.append(result)
+    print_results(results)
+    if args.csv:
+        append_csv(args.csv, results)
+
+
+if __name__ == "__main__":
+    main()
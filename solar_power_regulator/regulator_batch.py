@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exécution vectorisée du coeur de régulation (controller_step de solar_power_regulator.py).
+
+Fait avancer N instances indépendantes du régulateur sur des tableaux NumPy de mesures (N instances x T pas) en un seul appel.
+Chaque instance peut avoir ses propres paramètres (réglages, comparaisons) ; les écritures Modbus sont supposées réussies.
+Utile pour les simulations et le réglage des seuils : plusieurs millions de pas par seconde.
+
+Utilisation en ligne de commande : vérification croisée avec controller_step() et mesure de débit,
+sur des mesures aléatoires ou rejouées depuis un fichier CSV "run" (voir samples).
+Il faut installer numpy : pip install numpy
+"""
+
+import argparse
+import csv
+import random
+import time
+import numpy as np
+
+from solar_power_regulator import RegulationConfig, ControllerState, controller_step, written_limit
+
+# code de la règle appliquée à chaque pas (tableau "rule" du résultat)
+RULE_THRESHOLD = 0        # régulation par seuils (l'indice du seuil est dans le tableau "threshold_index")
+RULE_FAST_RISE = 1
+RULE_FAST_DROP = 2
+RULE_IMPORT_RESET = 3
+RULE_OUT_OF_RANGE = 4     # aucun seuil ne correspond
+RULE_UNKNOWN_STATE = 5    # power_limit inconnu (-1)
+
+# libellés de controller_step() correspondant aux règles autres que RULE_THRESHOLD
+RULE_INFO = {RULE_FAST_RISE: "Importation très forte", RULE_FAST_DROP: "Injection haute", RULE_IMPORT_RESET: "Importation continue",
+             RULE_OUT_OF_RANGE: "Hors plage", RULE_UNKNOWN_STATE: "État inconnu"}
+
+
+def stack_params(params, n):
+    """Transforme un ControllerParams (commun) ou une liste de N ControllerParams en tableaux de taille N."""
+    if hasattr(params, "_fields"):
+        params = [params]
+    if len(params) not in (1, n):
+        raise ValueError(f"{len(params)} jeux de paramètres pour {n} instances")
+    if len({len(p.thresholds) for p in params}) != 1:
+        raise ValueError("toutes les instances doivent avoir le même nombre de seuils")
+    col = lambda get, dtype=np.int64: np.broadcast_to(np.array([get(p) for p in params], dtype=dtype), (n,)).copy()
+    cols = lambda get: np.broadcast_to(np.array([[get(t) for t in p.thresholds] for p in params], dtype=np.int64), (n, len(params[0].thresholds))).copy()
+    return {
+        "min_limit": col(lambda p: p.min_limit), "max_limit": col(lambda p: p.max_limit), "buggy_limit": col(lambda p: p.buggy_limit),
+        "thr_value": cols(lambda t: t[0]), "thr_increment": cols(lambda t: t[1]), "thr_interval": cols(lambda t: t[2]),
+        "import_reset": col(lambda p: p.import_count_for_reset),
+        "drop_enable": col(lambda p: p.fast_drop_enable, bool),
+        "drop_thresh": col(lambda p: p.fast_drop_thresholds[0]), "drop_count": col(lambda p: p.fast_drop_thresholds[1]),
+        "drop_limit": col(lambda p: p.fast_drop_thresholds[2]), "drop_delay": col(lambda p: p.fast_drop_thresholds[3]),
+        "rise_enable": col(lambda p: p.fast_rise_enable, bool),
+        "rise_thresh": col(lambda p: p.fast_rise_thresholds[0]), "rise_count": col(lambda p: p.fast_rise_thresholds[1]),
+        "rise_limit": col(lambda p: p.fast_rise_thresholds[2]), "rise_delay": col(lambda p: p.fast_rise_thresholds[3]),
+        "cooldown_nb": col(lambda p: p.fast_cooldown_nb), "rated_power": col(lambda p: p.rated_power, np.float64),
+    }
+
+
+def run_batch(params, injection, solar, initial_limit=1000):
+    """Fait avancer N instances sur T pas. injection et solar : tableaux (N, T) ou (T,) (mesures communes à toutes les instances).
+    params : un ControllerParams commun, ou une liste de N ControllerParams. initial_limit : scalaire ou tableau (N,).
+    Retourne un dict de tableaux (N, T) : limit (après écriture), increment, interval, rule, threshold_index,
+    et "state" : l'état final de chaque instance (dict de tableaux (N,))."""
+    injection, solar = np.atleast_2d(np.asarray(injection, dtype=np.float64)), np.atleast_2d(np.asarray(solar, dtype=np.float64))
+    n_params = 1 if hasattr(params, "_fields") else len(params)
+    n = max(injection.shape[0], solar.shape[0], n_params, np.size(initial_limit))
+    injection, solar = np.broadcast_to(injection, (n, injection.shape[1])), np.broadcast_to(solar, (n, solar.shape[1]))
+    steps = injection.shape[1]
+    p = stack_params(params, n)
+    rows = np.arange(n)
+
+    limit = np.broadcast_to(np.asarray(initial_limit, dtype=np.int64), (n,)).copy()
+    import_count, high_count, deep_count, cooldown = (np.zeros(n, dtype=np.int64) for _ in range(4))
+    out = {name: np.empty((n, steps), dtype=np.int64) for name in ("limit", "increment", "interval", "rule", "threshold_index")}
+
+    for t in range(steps):
+        inj, sol = injection[:, t], solar[:, t]
+        known = limit != -1
+        new_limit, interval = limit.copy(), np.full(n, -1, dtype=np.int64)
+        rule, thr_index = np.full(n, RULE_UNKNOWN_STATE, dtype=np.int64), np.full(n, -1, dtype=np.int64)
+
+        cooldown = np.where(known & (cooldown > 0), cooldown - 1, cooldown)
+
+        # --- FAST RISE ---
+        on = known & p["rise_enable"]
+        deep_count = np.where(on, np.where(inj < p["rise_thresh"], deep_count + 1, 0), deep_count)
+        fire = on & (deep_count >= p["rise_count"]) & (cooldown == 0) & (limit < p["rise_limit"])
+        new_limit[fire], interval[fire], rule[fire] = p["rise_limit"][fire], p["rise_delay"][fire], RULE_FAST_RISE
+        deep_count[fire], cooldown[fire] = 0, p["cooldown_nb"][fire]
+        active = known & ~fire
+
+        # --- FAST DROP ---
+        on = active & p["drop_enable"]
+        high_count = np.where(on, np.where(inj > p["drop_thresh"], high_count + 1, 0), high_count)
+        estimated = np.trunc(((sol - inj) / p["rated_power"]) * 1000).astype(np.int64)
+        fire = on & (high_count >= p["drop_count"]) & (limit > p["drop_limit"]) & (sol > 0) & (cooldown == 0) & (estimated < limit)
+        new_limit[fire], interval[fire], rule[fire] = estimated[fire], p["drop_delay"][fire], RULE_FAST_DROP
+        high_count[fire], cooldown[fire] = 0, p["cooldown_nb"][fire]
+        active &= ~fire
+
+        # --- IMPORT LOCK ---
+        importing = inj < 0
+        import_count = np.where(active, np.where(importing, import_count + 1, 0), import_count)
+        fire = active & importing & (import_count >= p["import_reset"])
+        new_limit[fire], interval[fire], rule[fire] = p["max_limit"][fire], -1, RULE_IMPORT_RESET
+        import_count[fire] = 0
+        active &= ~fire
+
+        # --- régulation par seuils : premier seuil (tri décroissant) inférieur ou égal à l'injection ---
+        match = inj[:, None] >= p["thr_value"]
+        k = match.argmax(axis=1)
+        rule[active & ~match.any(axis=1)] = RULE_OUT_OF_RANGE
+        on = active & match.any(axis=1)
+        increment, thr_interval = p["thr_increment"][rows, k], p["thr_interval"][rows, k]
+        stepped = np.clip(limit + increment, p["min_limit"], p["max_limit"])
+        stepped_interval = np.where((limit == p["max_limit"]) & (stepped == p["max_limit"]), -1, thr_interval)
+        stepped = np.where(stepped == p["buggy_limit"], stepped + np.where(increment > 0, 5, -5), stepped)
+        moving = increment != 0
+        new_limit[on & moving] = stepped[on & moving]
+        interval[on] = np.where(moving, stepped_interval, thr_interval)[on]
+        rule[on], thr_index[on] = RULE_THRESHOLD, k[on]
+
+        # écriture supposée réussie, avec les corrections de perform_write()
+        changed = known & (new_limit != limit)
+        written = np.maximum(np.where(new_limit == p["buggy_limit"], new_limit + 1, new_limit), p["min_limit"])
+        out["increment"][:, t] = np.where(known, new_limit - limit, 0)
+        limit = np.where(changed, written, limit)
+        out["limit"][:, t], out["interval"][:, t], out["rule"][:, t], out["threshold_index"][:, t] = limit, interval, rule, thr_index
+
+    out["state"] = {"limit": limit, "import_count": import_count, "high_injection_count": high_count,
+                    "deep_import_count": deep_count, "fast_cooldown": cooldown}
+    return out
+
+
+def run_scalar(params, injection, solar, initial_limit=1000):
+    """Référence : même simulation, une instance, pas à pas avec controller_step().
+    Retourne la liste des (limite après écriture, incrément, délai) de chaque pas."""
+    cstate, steps = ControllerState(initial_limit, 0, 0, 0, 0), []
+    for inj, sol in zip(injection, solar):
+        previous = cstate.limit
+        cstate, decision, _ = controller_step(params, cstate, inj, sol)
+        if decision.limit != previous:   # écriture, comme perform_write() dans le démon
+            cstate = cstate._replace(limit=written_limit(params, decision.limit))
+        steps.append((cstate.limit, decision.increment, decision.interval))
+    return steps
+
+
+def read_samples(path):
+    """Lit les colonnes solar et injection d'un fichier CSV "run" (séparateur ';')."""
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f, delimiter=';'))
+    return np.array([float(r['injection']) for r in rows]), np.array([float(r['solar']) for r in rows])
+
+
+def random_samples(n, steps, seed):
+    """Mesures aléatoires : production en marche aléatoire, consommation avec des appels de charge (four, bouilloire...)."""
+    rng = np.random.default_rng(seed)
+    solar = np.clip(np.cumsum(rng.normal(0, 40, (n, steps)), axis=1) + rng.uniform(0, 2000, (n, 1)), 0, 2640)
+    house = rng.uniform(150, 400, (n, steps)) + np.where(rng.random((n, steps)) < 0.1, rng.uniform(500, 2500, (n, steps)), 0)
+    return np.round(solar - house), np.round(solar)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulation vectorisée du régulateur : vérification croisée et mesure de débit.")
+    parser.add_argument("-c", "--config", help="Fichier JSON de configuration du démon. Défaut : valeurs du code")
+    parser.add_argument("-f", "--file", help="Fichier CSV 'run' à rejouer (colonnes solar et injection). Défaut : mesures aléatoires")
+    parser.add_argument("-n", "--instances", type=int, default=1000, help="Nombre d'instances. Défaut : 1000")
+    parser.add_argument("-s", "--steps", type=int, default=1000, help="Nombre de pas, pour les mesures aléatoires. Défaut : 1000")
+    parser.add_argument("-k", "--check", type=int, default=20, help="Nombre d'instances vérifiées avec controller_step(). Défaut : 20")
+    parser.add_argument("--seed", type=int, default=0, help="Graine aléatoire. Défaut : 0")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = RegulationConfig.from_file(args.config) if args.config else RegulationConfig()
+    base = config.controller_params
+    if args.file:
+        inj, sol = read_samples(args.file)
+        injection, solar = np.tile(inj, (args.instances, 1)), np.tile(sol, (args.instances, 1))
+    else:
+        injection, solar = random_samples(args.instances, args.steps, args.seed)
+
+    # une variante de réglage par instance : c'est aussi ce qui fait diverger les instances sur des mesures rejouées
+    rnd = random.Random(args.seed)
+    params = [base._replace(fast_cooldown_nb=rnd.randint(0, 10), fast_drop_enable=rnd.random() < 0.8, fast_rise_enable=rnd.random() < 0.8,
+                            fast_drop_thresholds=(rnd.randint(0, 200),) + tuple(base.fast_drop_thresholds[1:]))
+              for _ in range(args.instances)]
+    initial = np.array([rnd.randint(base.min_limit, base.max_limit) for _ in range(args.instances)])
+
+    start = time.perf_counter()
+    result = run_batch(params, injection, solar, initial)
+    elapsed = time.perf_counter() - start
+    total = injection.shape[0] * injection.shape[1]
+    print(f"{injection.shape[0]} instances x {injection.shape[1]} pas = {total} pas en {elapsed:.3f}s, soit {total/elapsed:,.0f} pas/s")
+
+    errors = 0
+    for i in range(min(args.check, args.instances)):
+        expected = run_scalar(params[i], injection[i], solar[i], int(initial[i]))
+        got = list(zip(result["limit"][i].tolist(), result["increment"][i].tolist(), result["interval"][i].tolist()))
+        if expected != got:
+            t = next(t for t, (a, b) in enumerate(zip(expected, got)) if a != b)
+            print(f"ECART instance {i}, pas {t}: controller_step={expected[t]}, batch={got[t]}")
+            errors += 1
+    print(f"Vérification croisée sur {min(args.check, args.instances)} instances : {'OK' if errors == 0 else f'{errors} écart(s)'}")
+    counts = np.bincount(result["rule"].ravel(), minlength=len(RULE_INFO) + 1)
+    print("Règles appliquées : " + ", ".join(f"{RULE_INFO.get(r, 'Seuils')}={c}" for r, c in enumerate(counts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Rejeu de journées enregistrées, en boucle fermée, pour comparer des variantes de la régulation.
+
+Un fichier CSV "run" (voir samples) donne, toutes les 5s environ, la production, l'injection et power_limit mesurés.
+On en déduit les grandeurs qui ne dépendent pas de la régulation :
+  . la consommation de la maison = production - injection
+  . la production disponible : la production mesurée quand elle n'était pas bridée (sous HEADROOM_UNCONSTRAINED_RATIO fois la limite),
+    interpolée linéairement entre ces mesures quand elle l'était, et jamais inférieure à la production mesurée
+Chaque variante est ensuite simulée seconde par seconde : le Shelly mesure au délai demandé par la régulation, controller_step()
+décide, et la production suit la limite écrite selon le modèle de l'installation (PlantModel : temps mort puis premier ordre).
+Le résultat est l'énergie injectée et importée de chaque variante, par intégration de l'injection simulée.
+
+Variantes : "réactive" (la régulation du démon) et "anticipation" (FEEDFORWARD_ENABLE, voir TrendPredictor).
+Ne sont pas simulés : le délai adaptatif, le plafond de production disponible (clamp_to_headroom) et les échecs Modbus.
+
+Exemple : regulator_replay.py -f samples/solar_power_regulator_16h10-18h10_run.csv
+"""
+
+import argparse
+import bisect
+import csv
+import os
+from datetime import datetime
+
+from solar_power_regulator import (RegulationConfig, ControllerState, PlantModel, TrendPredictor, controller_step, written_limit,
+                                   _split_trapezoid, ACTUATION_DEFAULT_SETTLE_S, FEEDFORWARD_HORIZON_RATIO, FEEDFORWARD_WINDOW_S,
+                                   HEADROOM_UNCONSTRAINED_RATIO, SHELLY_DEFAULT_INTERVAL_S)
+
+DEFAULT_RUN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "solar_power_regulator_16h10-18h10_run.csv")
+# pas de la simulation, en secondes
+SIMULATION_STEP_S = 1.0
+
+
+def read_run(path):
+    """Lit un fichier CSV "run" (séparateur ';'). Retourne les listes instants (s), production, injection, power_limit (pour mille)."""
+    times, solar, injection, limits = [], [], [], []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            times.append(datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S").timestamp())
+            solar.append(float(row['solar'])); injection.append(float(row['injection'])); limits.append(round(float(row['power_limit']) * 10))
+    return times, solar, injection, limits
+
+
+def available_production(solar, limits, rated_power):
+    """Production disponible estimée à chaque mesure (voir l'en-tête du fichier)."""
+    known = [i for i, (s, limit) in enumerate(zip(solar, limits)) if s < HEADROOM_UNCONSTRAINED_RATIO * limit * rated_power / 1000]
+    if not known:
+        return list(solar)
+    available = []
+    for i, s in enumerate(solar):
+        k = bisect.bisect_left(known, i)
+        if k < len(known) and known[k] == i:
+            value = s
+        elif k == 0 or k == len(known):
+            value = solar[known[min(k, len(known) - 1)]]
+        else:
+            i0, i1 = known[k - 1], known[k]
+            value = solar[i0] + (solar[i1] - solar[i0]) * (i - i0) / (i1 - i0)
+        available.append(max(value, s))
+    return available
+
+
+def interpolate(times, values, t):
+    k = bisect.bisect_right(times, t)
+    if k == 0: return values[0]
+    if k == len(times): return values[-1]
+    t0, t1 = times[k - 1], times[k]
+    return values[k - 1] + (values[k] - values[k - 1]) * (t - t0) / (t1 - t0)
+
+
+def replay(params, times, house, available, initial_limit, feedforward=False, horizon_ratio=FEEDFORWARD_HORIZON_RATIO,
+           window_s=FEEDFORWARD_WINDOW_S):
+    """Simule une variante de la régulation sur les grandeurs exogènes d'un enregistrement. Retourne un dictionnaire de résultats."""
+    rated = params.rated_power
+    plant = PlantModel(rated, initial_limit, production=min(available[0], initial_limit * rated / 1000))
+    predictor = TrendPredictor(window_s=window_s)
+    cstate = ControllerState(initial_limit, 0, 0, 0, 0)
+    injected = imported = 0.0
+    writes, last_write, next_sample = 0, float("-inf"), times[0]
+    t, previous = times[0], None
+    while t <= times[-1]:
+        production = plant.step(t, interpolate(times, available, t))
+        injection = production - interpolate(times, house, t)
+        if previous is not None:
+            positive, negative = _split_trapezoid(previous, injection, SIMULATION_STEP_S)
+            injected += positive; imported += negative
+        previous = injection
+        if t >= next_sample:
+            solar, inj = round(production), round(injection)
+            step_solar, step_inj = solar, inj
+            if feedforward:
+                settled = t - last_write > ACTUATION_DEFAULT_SETTLE_S
+                unconstrained = solar < HEADROOM_UNCONSTRAINED_RATIO * cstate.limit * rated / 1000
+                predictor.observe(solar, solar - inj, settled and unconstrained, now=t)
+                step_solar, step_inj = predictor.predict(solar, inj, ACTUATION_DEFAULT_SETTLE_S * horizon_ratio, cstate.limit * rated / 1000, now=t)
+            previous_limit = cstate.limit
+            cstate, decision, _ = controller_step(params, cstate, step_inj, step_solar)
+            if decision.limit != previous_limit:
+                cstate = cstate._replace(limit=written_limit(params, decision.limit))
+                plant.write(t, cstate.limit)
+                writes, last_write = writes + 1, t
+            next_sample = t + (decision.interval if decision.interval > 0 else SHELLY_DEFAULT_INTERVAL_S)
+        t += SIMULATION_STEP_S
+    return {"injected_wh": injected, "imported_wh": imported, "writes": writes}
+
+
+def recorded_energy(times, injection):
+    """Energie injectée et importée de l'enregistrement lui-même, pour comparaison."""
+    injected = imported = 0.0
+    for i in range(1, len(times)):
+        positive, negative = _split_trapezoid(injection[i - 1], injection[i], times[i] - times[i - 1])
+        injected += positive; imported += negative
+    return {"injected_wh": injected, "imported_wh": imported, "writes": None}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Rejeu de journées enregistrées : comparaison de la régulation réactive et de l'anticipation.")
+    parser.add_argument("-c", "--config", help="Fichier JSON de configuration du démon. Défaut : valeurs du code")
+    parser.add_argument("-f", "--file", nargs='+', default=[DEFAULT_RUN_FILE], help="Fichier(s) CSV 'run' à rejouer. Défaut : l'enregistrement de samples")
+    parser.add_argument("-r", "--horizon-ratio", type=float, default=FEEDFORWARD_HORIZON_RATIO,
+                        help=f"Horizon de l'anticipation, en fraction du temps d'établissement ({ACTUATION_DEFAULT_SETTLE_S}s). Défaut : {FEEDFORWARD_HORIZON_RATIO}")
+    parser.add_argument("-w", "--window", type=float, default=FEEDFORWARD_WINDOW_S, help=f"Historique de la tendance, en secondes. Défaut : {FEEDFORWARD_WINDOW_S}")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = RegulationConfig.from_file(args.config) if args.config else RegulationConfig()
+    params = config.controller_params
+    totals = {}
+    for path in args.file:
+        times, solar, injection, limits = read_run(path)
+        house = [s - i for s, i in zip(solar, injection)]
+        available = available_production(solar, limits, params.rated_power)
+        results = {"enregistrement": recorded_energy(times, injection),
+                   "réactive": replay(params, times, house, available, limits[0]),
+                   "anticipation": replay(params, times, house, available, limits[0], True, args.horizon_ratio, args.window)}
+        print(f"{os.path.basename(path)} : {len(times)} mesures, {(times[-1] - times[0]) / 3600:.1f}h")
+        for name, r in results.items():
+            writes = "-" if r["writes"] is None else r["writes"]
+            print(f"  {name:14s} injecté {r['injected_wh']:7.1f}Wh  importé {r['imported_wh']:7.1f}Wh  écritures {writes}")
+            total = totals.setdefault(name, [0.0, 0.0, 0])
+            total[0] += r["injected_wh"]; total[1] += r["imported_wh"]; total[2] += r["writes"] or 0
+    reactive, anticipation = totals["réactive"], totals["anticipation"]
+    delta = [a - r for a, r in zip(anticipation, reactive)]
+    # écarts signés : une anticipation qui n'apporte rien, ou qui coûte, se lit directement
+    print(f"Anticipation par rapport à la régulation réactive : injection {delta[0]:+.1f}Wh ({100 * delta[0] / reactive[0]:+.0f}%), "
+          f"importation {delta[1]:+.1f}Wh, écritures {delta[2]:+d}" if reactive[0] > 0 else "Aucune injection simulée")
+
+
+if __name__ == "__main__":
+    main()
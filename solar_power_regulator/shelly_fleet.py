@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+shelly_fleet.py
+
+Générateur de charge : simule des centaines de Shelly exécutant solar_power_regulator.js, vers un ou plusieurs démons.
+Chaque Shelly virtuel se comporte comme le script :
+  . envoie {"injection_power", "solar_power"} en POST, avec un timeout de 5s
+  . attend ensuite sensor_read_interval secondes (si > 0), sinon DEFAULT_REQUEST_INTERVAL_S, et PAUSE_ON_ERROR_S en cas d'erreur
+  . en mode nuit, n'envoie rien et se réveille toutes les NIGHT_MODE_INTERVAL_S secondes
+La consommation de la maison est rejouée depuis un fichier CSV "run" (voir samples ; consommation = solar - injection),
+avec un décalage aléatoire par Shelly, ou générée (talon + appels de charge). La production suit le power_limit retourné par le démon
+(réponse du premier ordre), dans la limite du soleil disponible : l'injection envoyée est donc cohérente avec les décisions du démon.
+
+Le générateur affiche régulièrement, puis en fin d'exécution : débit de requêtes, erreurs, codes retour, et distribution des latences.
+
+syntaxe :
+  shelly_fleet.py -h : pour de l'aide
+  shelly_fleet.py -n 200 -d 300 http://127.0.0.1:8000/regulate : 200 Shelly pendant 5mn
+  shelly_fleet.py -n 500 --time-scale 10 -f samples/solar_power_regulator_16h10-18h10_run.csv http://127.0.0.1:8000/regulate
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import math
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+# --- comportement du script Shelly (voir CONFIG dans solar_power_regulator.js) ---
+DEFAULT_REQUEST_INTERVAL_S = 5
+PAUSE_ON_ERROR_S = 60
+HTTP_TIMEOUT_S = 5
+NIGHT_MODE_ENABLE = True
+NIGHT_MODE_START_H = 22
+NIGHT_MODE_END_H = 6
+NIGHT_MODE_INTERVAL_S = 900
+
+# --- installation simulée ---
+TOTAL_RATED_SOLAR_POWER = 2640     # W, comme dans solar_power_regulator.py
+PRODUCTION_TIME_CONSTANT_S = 5     # réponse des MO à un nouveau power_limit
+SYNTHETIC_BASE_LOAD_W = (150, 400) # talon de consommation, tiré au hasard par Shelly
+SYNTHETIC_APPLIANCES = [           # (puissance W, durée moyenne s, probabilité de démarrage par seconde)
+    (2000, 600, 1 / 3600),         # four
+    (2200, 120, 1 / 1800),         # bouilloire
+    (1200, 1800, 1 / 7200),        # lave-linge
+    (800, 60, 1 / 600),            # micro-ondes
+]
+
+# --- statistiques ---
+REPORT_INTERVAL_S = 10
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies, self.interval_latencies = [], []
+        self.requests = self.interval_requests = 0
+        self.errors = Counter()        # type d'erreur -> nombre
+        self.return_codes = Counter()  # return_code du démon -> nombre
+        self.start = self.interval_start = time.monotonic()
+
+    def record(self, latency, return_code=None, error=None):
+        self.requests += 1; self.interval_requests += 1
+        if error:
+            self.errors[error] += 1
+        else:
+            self.latencies.append(latency); self.interval_latencies.append(latency)
+            self.return_codes[return_code] += 1
+
+    @staticmethod
+    def percentiles(values):
+        if not values: return "-"
+        values = sorted(values)
+        parts = [f"p{p}={values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)] * 1000:.0f}ms" for p in LATENCY_PERCENTILES]
+        return ", ".join(parts + [f"max={values[-1] * 1000:.0f}ms"])
+
+    def report_interval(self, active):
+        now = time.monotonic()
+        rate = self.interval_requests / (now - self.interval_start)
+        print(f"[{now - self.start:6.0f}s] {active} Shelly actifs, {rate:.1f} req/s, latence {self.percentiles(self.interval_latencies)}, "
+              f"erreurs cumulées {sum(self.errors.values())}")
+        self.interval_latencies, self.interval_requests, self.interval_start = [], 0, now
+
+    def report_final(self):
+        elapsed = time.monotonic() - self.start
+        print("-" * 80)
+        print(f"Durée {elapsed:.0f}s, {self.requests} requêtes, {self.requests / elapsed:.1f} req/s")
+        print(f"Latence : {self.percentiles(self.latencies)}")
+        print("Codes retour : " + (", ".join(f"{code}={n}" for code, n in sorted(self.return_codes.items())) or "-"))
+        print("Erreurs : " + (", ".join(f"{name}={n}" for name, n in self.errors.most_common()) or "aucune"))
+
+
+class HouseProfile:
+    """Consommation de la maison et soleil disponible, en fonction du temps écoulé (secondes)."""
+    def __init__(self, samples, rnd):
+        self.samples, self.random = samples, rnd
+        self.offset = rnd.uniform(0, samples[-1][0]) if samples else 0
+        self.base = rnd.uniform(*SYNTHETIC_BASE_LOAD_W)
+        self.running = []             # (fin, puissance) des appareils en marche
+        self.last_t = 0
+
+    def at(self, t):
+        """Retourne (consommation, production disponible) à l'instant t."""
+        if self.samples:
+            t = (t + self.offset) % self.samples[-1][0]
+            for when, house, solar in self.samples:
+                if when >= t: return house, solar
+            return self.samples[-1][1:]
+        # synthétique : on tire les démarrages d'appareils depuis le dernier appel
+        dt, self.last_t = t - self.last_t, t
+        for power, duration, probability in SYNTHETIC_APPLIANCES:
+            if self.random.random() < 1 - (1 - probability) ** dt:
+                self.running.append((t + self.random.expovariate(1 / duration), power))
+        self.running = [(end, power) for end, power in self.running if end > t]
+        return self.base + sum(power for _, power in self.running), 0.7 * TOTAL_RATED_SOLAR_POWER
+
+
+def read_samples(path):
+    """Lit un fichier CSV "run" : retourne [(secondes depuis le début, consommation, production)]."""
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f, delimiter=';'))
+    t0 = datetime.strptime(rows[0]['time'], "%Y-%m-%d %H:%M:%S")
+    return [((datetime.strptime(r['time'], "%Y-%m-%d %H:%M:%S") - t0).total_seconds(), float(r['solar']) - float(r['injection']), float(r['solar']))
+            for r in rows]
+
+
+async def post_json(url, payload):
+    """POST HTTP/1.0 minimal (le démon ferme la connexion après la réponse). Retourne (statut HTTP, corps)."""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        body = json.dumps(payload).encode()
+        writer.write(f"POST {parts.path or '/'} HTTP/1.0\r\nHost: {parts.netloc}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), content
+
+
+class VirtualShelly:
+    """Un Shelly exécutant solar_power_regulator.js, avec une installation simulée."""
+    def __init__(self, url, profile, args, stats):
+        self.url, self.profile, self.args, self.stats = url, profile, args, stats
+        self.power_limit = 100.0      # %, dernier power_limit retourné par le démon
+        self.production = 0.0
+
+    def clock(self, t):
+        """Heure simulée : heure de départ + temps écoulé (accéléré par --time-scale)."""
+        return self.args.start_time + timedelta(seconds=t * self.args.time_scale)
+
+    async def sleep(self, delay_s, deadline):
+        await asyncio.sleep(max(0, min(delay_s / self.args.time_scale, deadline - time.monotonic())))
+
+    def measure(self, t, dt):
+        house, available = self.profile.at(t * self.args.time_scale)
+        target = min(available, self.power_limit / 100 * TOTAL_RATED_SOLAR_POWER)
+        self.production += (target - self.production) * (1 - math.exp(-dt / PRODUCTION_TIME_CONSTANT_S))
+        return int(self.production - house), int(self.production)
+
+    async def run(self, deadline):
+        start, last = time.monotonic(), 0.0
+        while time.monotonic() < deadline:
+            t = time.monotonic() - start
+            hour = self.clock(t).hour
+            if NIGHT_MODE_ENABLE and not self.args.no_night and (hour >= NIGHT_MODE_START_H or hour < NIGHT_MODE_END_H):
+                await self.sleep(NIGHT_MODE_INTERVAL_S, deadline)
+                continue
+            injection, solar = self.measure(t, (t - last) * self.args.time_scale)
+            last = t
+            next_delay = DEFAULT_REQUEST_INTERVAL_S
+            sent = time.monotonic()
+            try:
+                status, content = await asyncio.wait_for(post_json(self.url, {"injection_power": injection, "solar_power": solar}), HTTP_TIMEOUT_S)
+                latency = time.monotonic() - sent
+                if status != 200:
+                    raise ValueError(f"HTTP {status}")
+                response = json.loads(content)
+                self.stats.record(latency, response.get("return_code"))
+                if response.get("sensor_read_interval", -1) > 0:
+                    next_delay = response["sensor_read_interval"]
+                if response.get("return_code") in (0, 1):
+                    self.power_limit = float(response["power_limit_value"])
+            except asyncio.TimeoutError:
+                self.stats.record(None, error="timeout"); next_delay = PAUSE_ON_ERROR_S
+            except json.JSONDecodeError:
+                self.stats.record(None, error="JSON invalide"); next_delay = PAUSE_ON_ERROR_S
+            except (OSError, ValueError, IndexError) as e:
+                self.stats.record(None, error=str(e) if isinstance(e, ValueError) else type(e).__name__); next_delay = PAUSE_ON_ERROR_S
+            await self.sleep(next_delay, deadline)
+
+
+async def run_fleet(args):
+    samples = read_samples(args.file) if args.file else None
+    stats, rnd = Stats(), random.Random(args.seed)
+    deadline = time.monotonic() + args.duration
+    shellies = [VirtualShelly(args.urls[i % len(args.urls)], HouseProfile(samples, random.Random(rnd.random())), args, stats)
+                for i in range(args.number)]
+
+    async def start(shelly, delay):
+        await asyncio.sleep(delay)   # démarrages étalés, comme des Shelly mis sous tension à des instants différents
+        await shelly.run(deadline)
+
+    tasks = [asyncio.create_task(start(s, rnd.uniform(0, args.ramp))) for s in shellies]
+    while not all(t.done() for t in tasks):
+        await asyncio.wait(tasks, timeout=REPORT_INTERVAL_S)
+        stats.report_interval(sum(not t.done() for t in tasks))
+    for t in tasks:
+        if t.exception(): raise t.exception()
+    stats.report_final()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Générateur de charge : flotte de Shelly virtuels exécutant solar_power_regulator.js.")
+    parser.add_argument("urls", nargs='+', help="URL(s) du ou des démons, par ex. http://127.0.0.1:8000/regulate. Les Shelly sont répartis entre les URL")
+    parser.add_argument("-n", "--number", type=int, default=100, help="Nombre de Shelly virtuels. Défaut : 100")
+    parser.add_argument("-d", "--duration", type=float, default=60, help="Durée du test en secondes. Défaut : 60")
+    parser.add_argument("-f", "--file", help="Fichier CSV 'run' de consommation à rejouer. Défaut : consommation synthétique")
+    parser.add_argument("-r", "--ramp", type=float, default=DEFAULT_REQUEST_INTERVAL_S, help=f"Etalement des démarrages, en secondes. Défaut : {DEFAULT_REQUEST_INTERVAL_S}")
+    parser.add_argument("-ts", "--time-scale", type=float, default=1.0, help="Accélération : tous les délais du script Shelly sont divisés par cette valeur. Défaut : 1")
+    parser.add_argument("--start", default=None, help="Heure simulée de départ HH:MM, pour le mode nuit. Défaut : heure actuelle")
+    parser.add_argument("--no-night", action="store_true", help="Désactive le mode nuit")
+    parser.add_argument("--seed", type=int, default=0, help="Graine aléatoire. Défaut : 0")
+    args = parser.parse_args()
+    args.start_time = datetime.now()
+    if args.start:
+        hour, minute = (int(x) for x in args.start.split(":"))
+        args.start_time = args.start_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return args
+
+
+def main():
+    args = parse_arguments()
+    print(f"{args.number} Shelly virtuels vers {', '.join(args.urls)}, pendant {args.duration:.0f}s, accélération x{args.time_scale}")
+    try:
+        asyncio.run(run_fleet(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 // solar_power_regulator.js
 // envoie de manière régulière en POST HTTP les informations d'import/export d'électricité vers le réseau, et éventuellement les infos de production solaire au démon solar_power_regulator.py
 //
-// les infos envoyées dans le POST HTTP (format JSON) sont : { "injection_power": <valeur_injection_enWatts>, "solar_power": <valeur_production_enWatts> }
+// les infos envoyées dans le POST HTTP (format JSON) sont : { "injection_power": <valeur_injection_enWatts>, "solar_power": <valeur_production_enWatts>, "seq": <numero>, "ts": <horodatage> }
 //      <valeur_injection_enWatts> est positive si injection, négative si importation
 //      <valeur_production_enWatts> est positive ou nulle si cette info est transmise, ou -1 si pas disponible
+//      <numero> : numéro de la mesure, incrémenté à chaque envoi (repart de 0 au démarrage du script)
+//      <horodatage> : instant de la mesure, en millisecondes depuis le 01/01/1970 (horloge du Shelly)
+//      seq et ts permettent au démon d'écarter une requête retardée, arrivée après une mesure plus récente
+//   si AGGREGATION_ENABLE, les statistiques des lectures faites depuis la requête précédente sont ajoutées :
+//      "injection_stats": { "mean": <moyenne>, "min": <minimum>, "max": <maximum>, "last": <dernière lecture>, "n": <nombre de lectures> }
+//      "solar_stats": idem pour la production (absent si SOLAR_SENSOR_ID est vide)
+//   si BATCH_ENABLE, le corps du POST est une liste de ces mesures, dans l'ordre chronologique : [ {...}, {...} ]. Elle ne contient
+//      qu'une mesure quand le démon répond, et les mesures gardées pendant son indisponibilité sinon. La réponse porte sur la dernière
 //
 // les infos retournées lors de cet appel POST sont également en format JSON : 
 //     {  "return_code": <return_code>, "message": <message>, ""power_limit_value": <power_limit>, "power_limit_increment": <increment>, "sensor_read_interval": <interval }
@@ -11,6 +19,7 @@
 //                     1 : Comme 0, mais le power_limit lu était différent du power_limit mémorisé. C'est un warning
 //                     2 : Une erreur de communication modbus a eu lieu, en lecture ou en écriture. power_limit n'a pas pu être écrit
 //                     3 : Erreur récurrente de communication modbus. Par exemple, 5 erreurs consécutives
+//                     4 : Mesure hors séquence ou trop ancienne : elle n'a pas été utilisée pour la régulation
 //                     9 : Autre erreur
 //        power_limit_value : la nouvelle valeur de power_limit calculée par le démon. Par exemple, 20.5.
 //        power_limit_increment : valeur de l'incrément (positif) ou du décrément (négatif) appliqué au power-limit, en pourcentage. Par exemple, -0.5 siginfie un décrément de 0.5% du power_limit.
@@ -33,6 +42,31 @@ const CONFIG = {
   DEFAULT_REQUEST_INTERVAL_S: 5,  // Intervalle par défaut (en secondes) entre les requêtes au démon
   PAUSE_ON_ERROR_S: 60,           // Pause (en secondes) en cas d'erreur de communication avec le démon
 
+  // --- Configuration du cadencement ---
+  //     false : la mesure suivante est programmée à la réception de la réponse du démon. La période réelle est donc le délai demandé
+  //             plus le temps de réponse du démon (écritures modbus comprises), et elle varie avec la latence de l'ECU.
+  //     true  : cadence fixe. Chaque mesure est calée sur l'instant prévu de la précédente + le délai demandé, indépendamment du
+  //             temps de réponse. Il n'y a jamais plus d'une requête en cours : si le démon répond après l'instant prévu de la mesure
+  //             suivante, cette mesure est sautée (elle n'est pas mise en file d'attente), et la cadence reprend sur la grille.
+  FIXED_RATE_ENABLE: false,
+  TIMING_REPORT_EVERY: 20,        // En mode DEBUG, nombre de mesures entre deux affichages de la période obtenue et de la gigue
+
+  // --- Configuration de l'agrégation ---
+  //     false : une seule lecture instantanée des capteurs par requête : les variations entre deux requêtes sont perdues.
+  //     true  : les capteurs sont lus toutes les AGGREGATION_SAMPLE_MS millisecondes, et chaque requête transmet en plus la moyenne,
+  //             le minimum, le maximum et la dernière valeur de ces lectures, avec leur nombre. Le démon choisit la statistique utilisée
+  //             par chacun de ses algorithmes (SAMPLE_STATISTICS). Le nombre de requêtes HTTP ne change pas.
+  AGGREGATION_ENABLE: false,
+  AGGREGATION_SAMPLE_MS: 500,
+
+  // --- Configuration de l'envoi par lots ---
+  //     false : une mesure par requête. Les mesures faites pendant une indisponibilité du démon sont perdues (pause de PAUSE_ON_ERROR_S).
+  //     true  : tant que le démon est injoignable, les mesures continuent toutes les DEFAULT_REQUEST_INTERVAL_S secondes et sont gardées
+  //             (au plus BATCH_MAX_SAMPLES : les plus anciennes sont abandonnées) ; un envoi est retenté toutes les PAUSE_ON_ERROR_S secondes.
+  //             Le démon traite le lot dans l'ordre (comptage d'énergie complet), seule la dernière mesure peut modifier power_limit.
+  BATCH_ENABLE: false,
+  BATCH_MAX_SAMPLES: 24,
+
   // --- Configuration du mode nuit ---
   //     Permet de réduite fortement le nombre de requetes la nuit
   NIGHT_MODE_ENABLE: true,        // Activer la pause nocturne
@@ -43,6 +77,21 @@ const CONFIG = {
 
 // --- Variables d'état ---
 let requestTimer = null;
+let sampleSeq = 0;              // numéro de la prochaine mesure envoyée
+
+// --- Cadencement et mesure de la cadence obtenue ---
+let sampleDueMs = Date.now();   // instant prévu de la prochaine mesure
+let requestedPeriodMs = 0;      // période demandée pour la prochaine mesure (0 après une pause : elle n'est pas mesurée)
+let lastSampleMs = 0;           // instant de la dernière mesure
+let timing = { n: 0, periodSumMs: 0, jitterSumMs: 0, jitterMaxMs: 0, skipped: 0 };
+
+// --- Agrégation des lectures entre deux requêtes ---
+let injectionStats = { n: 0, sum: 0, min: 0, max: 0, last: 0 };   // voir newStats()
+let solarStats = { n: 0, sum: 0, min: 0, max: 0, last: 0 };
+
+// --- Envoi par lots ---
+let pendingSamples = [];        // mesures pas encore reçues par le démon
+let retryAtMs = 0;              // instant du prochain envoi, si le démon est injoignable
 
 function logDebug(message) {
   if (CONFIG.DEBUG === 1) {
@@ -60,6 +109,59 @@ function getPower(sensorId) {
   return null;
 }
 
+function newStats() {
+  return { n: 0, sum: 0, min: 0, max: 0, last: 0 };
+}
+
+function addStat(stats, value) {
+  if (stats.n === 0 || value < stats.min) stats.min = value;
+  if (stats.n === 0 || value > stats.max) stats.max = value;
+  stats.sum += value;
+  stats.last = value;
+  stats.n++;
+}
+
+function statsPayload(stats) {
+  return { "mean": Math.round(stats.sum / stats.n), "min": Math.round(stats.min), "max": Math.round(stats.max), "last": Math.round(stats.last), "n": stats.n };
+}
+
+function getInjectionPower() {
+  let injectionPower = getPower(CONFIG.GRID_SENSOR_ID);
+  if (injectionPower !== null && CONFIG.GRID_REVERSE_MEASURE) {
+    injectionPower *= -1;
+  }
+  return injectionPower;
+}
+
+// lecture intermédiaire des capteurs, entre deux requêtes (AGGREGATION_ENABLE)
+function sampleSensors() {
+  const injectionPower = getInjectionPower();
+  if (injectionPower === null) return;
+  addStat(injectionStats, injectionPower);
+  if (CONFIG.SOLAR_SENSOR_ID) {
+    const solarPower = getPower(CONFIG.SOLAR_SENSOR_ID);
+    if (solarPower !== null) addStat(solarStats, solarPower);
+  }
+}
+
+// période obtenue entre deux mesures, et gigue : écart avec la période demandée
+function recordTiming(now) {
+  if (lastSampleMs > 0 && requestedPeriodMs > 0) {
+    const period = now - lastSampleMs;
+    const jitter = Math.abs(period - requestedPeriodMs);
+    timing.n++;
+    timing.periodSumMs += period;
+    timing.jitterSumMs += jitter;
+    if (jitter > timing.jitterMaxMs) timing.jitterMaxMs = jitter;
+    if (timing.n >= CONFIG.TIMING_REPORT_EVERY) {
+      logDebug("Cadence sur " + timing.n + " mesures : période moyenne " + Math.round(timing.periodSumMs / timing.n) + "ms, gigue moyenne " +
+               Math.round(timing.jitterSumMs / timing.n) + "ms (max " + Math.round(timing.jitterMaxMs) + "ms), " + timing.skipped + " mesure(s) sautée(s)");
+      timing = { n: 0, periodSumMs: 0, jitterSumMs: 0, jitterMaxMs: 0, skipped: 0 };
+    }
+  }
+  lastSampleMs = now;
+}
+
 function regulate() {
   if (CONFIG.NIGHT_MODE_ENABLE) {
     const currentHour = new Date().getHours();
@@ -70,61 +172,116 @@ function regulate() {
     }
   }
 
-  let injectionPower = getPower(CONFIG.GRID_SENSOR_ID);
+  let injectionPower = getInjectionPower();
   if (injectionPower === null) {
     rescheduleRequest(CONFIG.PAUSE_ON_ERROR_S);
     return;
   }
-
-  if (CONFIG.GRID_REVERSE_MEASURE) {
-    injectionPower *= -1;
-  }
+  recordTiming(Date.now());
 
   let solarPower = getPower(CONFIG.SOLAR_SENSOR_ID) || -1;
 
   const payload = {
     "injection_power": parseInt(injectionPower),
     "solar_power": parseInt(solarPower),
+    "seq": sampleSeq,
+    "ts": Math.round(Date.now()),
   };
+  sampleSeq++;
+  if (CONFIG.AGGREGATION_ENABLE) {
+    // la lecture de la requête est la dernière de l'intervalle
+    addStat(injectionStats, injectionPower);
+    if (solarPower >= 0) addStat(solarStats, solarPower);
+    payload.injection_stats = statsPayload(injectionStats);
+    if (solarStats.n > 0) payload.solar_stats = statsPayload(solarStats);
+    injectionStats = newStats();
+    solarStats = newStats();
+  }
+
+  let body = payload;
+  if (CONFIG.BATCH_ENABLE) {
+    pendingSamples.push(payload);
+    if (pendingSamples.length > CONFIG.BATCH_MAX_SAMPLES) pendingSamples.splice(0, 1);
+    if (Date.now() < retryAtMs) {
+      logDebug("Démon injoignable, mesure gardée : " + pendingSamples.length + " en attente.");
+      rescheduleRequest(CONFIG.DEFAULT_REQUEST_INTERVAL_S, false);
+      return;
+    }
+    body = pendingSamples;
+  }
 
   const requestParams = {
     method: "POST",
     url: CONFIG.MODBUS_DAEMON_URL,
     headers: {"Content-Type": "application/json"},
-    body: payload,
+    body: body,
     timeout: 5,
   };
 
-  logDebug("Envoi des données: " + JSON.stringify(payload));
+  logDebug("Envoi des données: " + JSON.stringify(body));
   
   Shelly.call("http.request", requestParams, 
     function (response, error_code, error_message) {
       let nextDelay = CONFIG.DEFAULT_REQUEST_INTERVAL_S;
+      let regular = true;
       if (error_code !== 0) {
         logDebug("Erreur HTTP: " + error_code + ": " + error_message);
         nextDelay = CONFIG.PAUSE_ON_ERROR_S;
+        regular = false;
       } else {
         try {
           const responseBody = JSON.parse(response.body);
           logDebug("Réponse reçue: " + JSON.stringify(responseBody));
+          pendingSamples = [];
+          retryAtMs = 0;
           if (responseBody.sensor_read_interval && responseBody.sensor_read_interval > 0) {
             nextDelay = responseBody.sensor_read_interval;
           }
         } catch (e) {
           logDebug("Erreur parsing JSON: " + e.toString());
           nextDelay = CONFIG.PAUSE_ON_ERROR_S;
+          regular = false;
         }
       }
-      rescheduleRequest(nextDelay);
+      if (!regular && CONFIG.BATCH_ENABLE) {
+        // les mesures continuent, l'envoi est retenté dans PAUSE_ON_ERROR_S secondes
+        retryAtMs = Date.now() + CONFIG.PAUSE_ON_ERROR_S * 1000;
+        nextDelay = CONFIG.DEFAULT_REQUEST_INTERVAL_S;
+      }
+      rescheduleRequest(nextDelay, regular);
     }
   );
 }
 
-function rescheduleRequest(delayS) {
+// regular : délai demandé par le démon après une requête réussie (sinon : pause, mode nuit, erreur)
+function rescheduleRequest(delayS, regular) {
   // if (requestTimer) Timer.clear(requestTimer);   // a priori, ne sert à rien : on cree un Timer à chaque cycle
-  requestTimer = Timer.set(delayS * 1000, false, regulate);
-  logDebug("Prochaine requête programmée dans " + delayS + " secondes.");
+  const now = Date.now();
+  let periodMs = delayS * 1000;
+  if (CONFIG.FIXED_RATE_ENABLE && regular) {
+    // cadence fixe : calage sur l'instant prévu de la mesure précédente. Les instants déjà passés sont sautés
+    let due = sampleDueMs + periodMs;
+    while (due <= now) {
+      due += delayS * 1000;
+      periodMs += delayS * 1000;
+      timing.skipped++;
+    }
+    sampleDueMs = due;
+  } else {
+    sampleDueMs = now + periodMs;
+  }
+  requestedPeriodMs = regular ? periodMs : 0;
+  if (!regular) {
+    // après une pause, les lectures accumulées sont trop anciennes
+    injectionStats = newStats();
+    solarStats = newStats();
+  }
+  requestTimer = Timer.set(sampleDueMs - now, false, regulate);
+  logDebug("Prochaine requête programmée dans " + (sampleDueMs - now) / 1000 + " secondes.");
 }
 
 logDebug("Script de régulation solaire démarré.");
+if (CONFIG.AGGREGATION_ENABLE) {
+  Timer.set(CONFIG.AGGREGATION_SAMPLE_MS, true, sampleSensors);
+}
 regulate();
\ No newline at end of file
@@ -1,23 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+_STARTUP_T0 = time.perf_counter()   # origine des mesures de l'option --startup-profile
+
 import argparse
+import heapq
+import importlib
 import logging
 import logging.handlers
+import math
 import signal
 import sys
 import json
-import time
 import os
+import queue
+import select
+from contextlib import contextmanager
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
-from threading import RLock, Thread
-from collections import deque
-from datetime import datetime
+from threading import Condition, RLock, Thread
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
 
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusException, ConnectionException
-import paho.mqtt.client as mqtt
+# pymodbus et paho.mqtt ne sont pas importés ici : leur import est long sur un Raspberry Pi.
+# Ils sont chargés par lazy_import(), en tâche de fond juste après l'ouverture du port HTTP (voir warmup_thread),
+# ou à la première utilisation si une requête arrive avant.
 
 # =================================================================================
 # --- CONFIGURATION DU DÉMON ---
@@ -46,6 +53,26 @@ MODBUS_POWER_LIMIT_REGISTER = 40189
 # Nombre d'échecs d'écriture Modbus successifs avant de passer en erreur récurrente.
 MODBUS_RECURRENT_ERROR_COUNT = 5
 
+# --- Disjoncteur et budgets de temps Modbus ---
+# Si l'ECU ne répond plus, chaque requête du Shelly ne doit pas attendre les timeouts Modbus (le Shelly abandonne au bout de 5s).
+# Nombre d'échecs consécutifs de commande Modbus avant d'ouvrir le disjoncteur : les commandes échouent alors immédiatement,
+# et une sonde en tâche de fond teste l'ECU jusqu'à ce qu'il réponde à nouveau.
+MODBUS_BREAKER_FAILURE_COUNT = 3
+# Délai avant la première sonde, en secondes. Il double à chaque sonde en échec, jusqu'au maximum.
+MODBUS_BREAKER_PROBE_INTERVAL_S = 10
+MODBUS_BREAKER_PROBE_MAX_INTERVAL_S = 300
+# Budget de temps total d'une commande Modbus (attente du verrou, connexion, requête et éventuelle nouvelle tentative).
+# Doit rester inférieur au timeout HTTP du Shelly (5s).
+MODBUS_COMMAND_BUDGET_S = 4.0
+# Timeout de connexion TCP à l'ECU, en secondes.
+MODBUS_CONNECT_TIMEOUT_S = 1.5
+# Temps de réponse d'une requête Modbus mesuré sur l'ECU-R (voir speedtests) : valeur initiale de l'estimation du RTT.
+MODBUS_RTT_ESTIMATE_S = 0.165
+# Timeout d'une requête = RTT estimé (moyenne glissante des requêtes réussies) x ce facteur, borné par les valeurs min et max.
+MODBUS_REQUEST_TIMEOUT_RTT_FACTOR = 8
+MODBUS_REQUEST_TIMEOUT_MIN_S = 1.0
+MODBUS_REQUEST_TIMEOUT_MAX_S = 3.0
+
 # --- Paramètres de l'algorithme (en "pour mille") ---
 # Limite de production minimale autorisée - power_limit (10 = 1.0%).
 MIN_POWER_LIMIT_PERMILLE = 10
@@ -100,9 +127,184 @@ FAST_COOLDOWN_NB = 5
 PERIODIC_MODBUS_READ_INTERVAL_S = 900
 # Si pas d'infos du shelly depuis 1h, power_limit = 100%.
 WATCHDOG_TIMEOUT_S = 3600
-# Intervalle pour les tâches de fond (tranches horaires, etc.).
+# Délai avant une nouvelle tentative de lecture périodique échouée. C'est aussi le délai demandé au Shelly hors des tranches horaires,
+# si ADAPTIVE_INTERVAL_ENABLE est False.
 PERIODIC_TASK_INTERVAL_S = 60
 
+# --- Ordonnanceur des tâches de fond ---
+# Les tâches de fond (watchdog, changements de tranche horaire, lecture périodique, journal d'état) sont exécutées par un seul thread,
+# qui dort jusqu'à la prochaine échéance. Durée maximum de sommeil, en secondes : l'horloge système peut être recalée par NTP
+# (le Raspberry Pi n'a pas d'horloge sauvegardée), les échéances sont alors réévaluées.
+SCHEDULER_MAX_SLEEP_S = 300
+# Retard d'exécution d'une tâche au-delà duquel un warning est écrit dans la log, en secondes.
+SCHEDULER_LATE_WARNING_S = 5
+# Délai avant une nouvelle exécution d'une tâche qui a levé une exception, en secondes.
+SCHEDULER_ERROR_RETRY_S = 60
+
+# --- Délai adaptatif entre deux mesures du Shelly (sensor_read_interval) ---
+# Dans la plage recherchée, si l'injection est stable, le délai demandé au Shelly augmente à chaque requête (x ADAPTIVE_INTERVAL_BACKOFF),
+# jusqu'à ADAPTIVE_INTERVAL_MAX_S. Il revient au délai court dès que l'injection varie de plus de ADAPTIVE_INTERVAL_VOLATILITY_W,
+# ou tant que la production n'est pas établie après une écriture de power_limit (temps d'établissement prévu : voir ACTUATION_*).
+# Hors des plages de régulation, le délai est le temps restant jusqu'à la prochaine tranche, limité à OUT_OF_WINDOW_MAX_INTERVAL_S
+# pour qu'un rechargement de la configuration soit pris en compte. Si False, les délais sont ceux des tables de seuils.
+ADAPTIVE_INTERVAL_ENABLE = True
+# Délai maximum demandé au Shelly quand la régulation est stable, en secondes.
+ADAPTIVE_INTERVAL_MAX_S = 30
+ADAPTIVE_INTERVAL_BACKOFF = 1.5
+# Délai court, quand la consommation ou la production varient, en secondes.
+ADAPTIVE_INTERVAL_MIN_S = 3
+# Variation d'injection entre deux requêtes au-delà de laquelle la situation est considérée comme instable, en W.
+ADAPTIVE_INTERVAL_VOLATILITY_W = 60
+# Délai par défaut du script Shelly (DEFAULT_REQUEST_INTERVAL_S dans solar_power_regulator.js), pour les seuils à -1.
+SHELLY_DEFAULT_INTERVAL_S = 5
+# Temps d'établissement des MO supposé, tant que la mesure de latence d'actionnement n'a pas assez d'échantillons, en secondes.
+ACTUATION_DEFAULT_SETTLE_S = 15
+OUT_OF_WINDOW_MAX_INTERVAL_S = 3600
+
+# --- Mesure de la latence d'actionnement ---
+# Après chaque écriture de power_limit, le démon suit la production (solar_power) transmise par le Shelly, pour mesurer
+# le délai de début de réaction des MO et leur temps d'établissement. Les percentiles glissants sont disponibles par GET /stats
+# et sur le topic MQTT /actuation : ils permettent de repérer un ECU qui se dégrade.
+# Variation de production attendue minimum pour qu'une écriture soit mesurée, en W.
+ACTUATION_MIN_STEP_W = 100
+# Variation de production, dans le sens attendu, qui marque le début de la réaction, en W.
+ACTUATION_ONSET_W = 50
+# La production est établie quand deux mesures successives diffèrent de moins de cette valeur, en W.
+ACTUATION_SETTLE_TOLERANCE_W = 30
+# Au-delà de ce délai sans réaction ou sans établissement, la mesure est abandonnée, en secondes.
+ACTUATION_TIMEOUT_S = 60
+# Nombre de mesures conservées pour le calcul des percentiles glissants.
+ACTUATION_STATS_WINDOW = 50
+
+# --- Plafond de production disponible ---
+# Les MO ne produisent souvent que 70% de leur puissance nominale : une limite au-dessus de la production disponible n'a aucun effet.
+# Le démon estime ce plafond à partir des mesures du Shelly : quand la production est établie après la dernière écriture, et
+# nettement sous la limite courante, elle n'est pas bridée : c'est la production disponible. L'estimation est abandonnée si la
+# production atteint le plafond estimé, ou si elle est trop ancienne.
+# Les décisions de la régulation sont ramenées dans la plage utile : une hausse au-delà du plafond n'est pas écrite, et une baisse
+# qui resterait au-dessus du plafond part du plafond, pour avoir un effet immédiat.
+HEADROOM_CLAMP_ENABLE = True
+# La production n'est pas bridée si elle est sous cette fraction de la limite courante.
+HEADROOM_UNCONSTRAINED_RATIO = 0.9
+# Marge ajoutée à la limite utile, en pour mille de la puissance nominale : la production peut augmenter un peu avant d'être bridée.
+HEADROOM_MARGIN_PERMILLE = 20
+# Age maximum de l'estimation du plafond, en secondes.
+HEADROOM_MAX_AGE_S = 60
+
+# --- Séquencement des mesures du Shelly ---
+# Le script Shelly numérote ses mesures (seq) et les horodate (ts, en ms). Le serveur HTTP traite les requêtes en parallèle : une requête
+# retardée (réseau, attente du verrou pendant une écriture Modbus) peut arriver après une plus récente, et ne doit pas piloter power_limit.
+#   . une mesure antérieure à la dernière reçue (seq ou ts inférieur) est ignorée. Un seq inférieur avec un ts plus récent est un
+#     redémarrage du script : la séquence repart.
+#   . une mesure dépassée par une plus récente pendant l'attente du verrou, ou plus vieille que SAMPLE_MAX_AGE_S au moment de la décision,
+#     est intégrée aux compteurs (énergie, latence d'actionnement) mais ne pilote pas power_limit.
+# Les horloges du Shelly et du démon ne sont pas synchronisées à la milliseconde : l'âge d'une mesure est compté à partir du délai de
+# transport minimum des SAMPLE_OFFSET_WINDOW dernières mesures (décalage des horloges + délai incompressible). Les délais de transport
+# sont disponibles par GET /stats. Les requêtes sans seq ni ts (anciens scripts) sont traitées dans l'ordre d'arrivée.
+# Age maximum d'une mesure pour piloter power_limit, en secondes. Doit rester inférieur au timeout HTTP du Shelly (5s).
+SAMPLE_MAX_AGE_S = 4.0
+SAMPLE_OFFSET_WINDOW = 20
+# Après ce nombre de mesures consécutives ignorées (horloge du Shelly recalée, redémarrage avant la mise à l'heure),
+# la séquence et le décalage des horloges sont réinitialisés.
+SAMPLE_RESYNC_COUNT = 3
+# Statistique utilisée par chaque usage, quand le Shelly transmet des mesures agrégées (AGGREGATION_ENABLE dans solar_power_regulator.js) :
+# "last" (dernière lecture), "mean", "min" ou "max" des lectures faites entre deux requêtes. Sans agrégation, c'est la mesure instantanée.
+#   regulation : algorithmes de régulation (seuils, FAST_*, anticipation, mode shadow) et délai adaptatif
+#   energy     : comptage d'énergie ; la moyenne donne l'énergie de l'intervalle, y compris les pointes entre deux requêtes
+#   actuation  : mesure de la latence d'actionnement ; la dernière lecture date la réaction au plus près
+#   trend      : estimation du plafond de production disponible et tendance de l'anticipation
+SAMPLE_STATISTICS = {"regulation": "mean", "energy": "mean", "actuation": "last", "trend": "mean"}
+# Envoi par lots (BATCH_ENABLE dans solar_power_regulator.js) : le corps de la requête peut être une liste de mesures, dans l'ordre
+# chronologique (mesures gardées par le Shelly pendant une indisponibilité du démon). Chaque mesure est intégrée aux compteurs (énergie,
+# latence d'actionnement, plafond de production, tendance, mode shadow) à son instant, et fait avancer les compteurs de la régulation ;
+# seule la dernière peut modifier power_limit, et la réponse porte sur elle. Nombre maximum de mesures d'un lot :
+SAMPLE_BATCH_MAX = 720
+
+# --- Anticipation (feed-forward) ---
+# Les MO ne réagissent qu'environ 2s après une écriture, et ne sont établis qu'après 15 à 20s : une régulation qui ne réagit qu'à
+# l'injection mesurée est toujours en retard sur les passages nuageux et les rampes de production du matin et du soir.
+# Si activée, la régulation ne reçoit pas les mesures du Shelly, mais leur prévision au moment où la nouvelle limite aura pris effet :
+# la tendance de la consommation et de la production est estimée sur les dernières mesures (pente de Theil-Sen, insensible aux
+# mesures isolées), et prolongée sur l'horizon d'actionnement. La production n'entre dans la tendance que si elle n'est pas bridée
+# et qu'elle est établie après la dernière écriture : sinon, sa variation est l'effet de la régulation elle-même.
+# Le gain se mesure en rejouant des journées enregistrées : voir regulator_replay.py.
+FEEDFORWARD_ENABLE = False
+# Durée de l'historique des mesures utilisé pour la tendance, en secondes.
+FEEDFORWARD_WINDOW_S = 60
+# Nombre minimum de mesures dans l'historique pour estimer une tendance.
+FEEDFORWARD_MIN_SAMPLES = 4
+# Horizon de la prévision, en fraction du temps d'établissement prévu des MO.
+FEEDFORWARD_HORIZON_RATIO = 0.5
+# Correction maximum apportée à chaque mesure, en W.
+FEEDFORWARD_MAX_CORRECTION_W = 300
+
+# --- Modèle de l'installation (simulations) ---
+# Réponse des MO à une écriture de power_limit, pour le rejeu de journées enregistrées (regulator_replay.py) : temps mort,
+# puis premier ordre vers min(production disponible, limite). Valeurs de l'émulateur d'ECU (modbus_tools/ecu_emulator.py).
+PLANT_DEAD_TIME_S = 2.0
+PLANT_TIME_CONSTANT_S = 5.0
+
+# --- Mode shadow ---
+# Evaluation de configurations candidates de la régulation sur les mesures réelles, sans risque : chaque candidate (fichier JSON
+# au format de --config, qui surcharge la configuration active) reçoit chaque mesure du Shelly en même temps que la régulation
+# active. Ses décisions ne sont jamais écrites : elles pilotent un modèle de l'installation (PlantModel), alimenté par la consommation
+# mesurée et la production disponible estimée, et l'énergie injectée et importée qui en résulte est comptée. La configuration active
+# est simulée de la même façon (candidate "active"), pour comparer les candidates à modèle égal. Résultats par GET /stats et sur
+# le topic MQTT /shadow. Laisser la liste vide pour désactiver. Peut être surchargé par la ligne de commande (--shadow).
+SHADOW_CONFIG_FILES = []
+# Nombre de changements de limite conservés par candidate (instant, ancienne et nouvelle limite).
+SHADOW_HISTORY_SIZE = 20
+# Intervalle entre deux publications MQTT des résultats, en secondes.
+SHADOW_PUBLISH_INTERVAL_S = 300
+
+# --- Comptage d'énergie ---
+# Les puissances transmises par le Shelly (injection, production) sont intégrées au fil de l'eau, par la méthode des trapèzes :
+# énergie injectée, importée, autoconsommée, et estimation de l'énergie bridée par power_limit. Compteurs par jour et par heure,
+# disponibles par GET /stats, publiés sur le topic MQTT /energy, et sauvegardés dans un fichier pour survivre aux redémarrages.
+# Au-delà de cet écart entre deux mesures (Shelly muet, démon arrêté), l'intervalle n'est pas intégré : il est compté comme trou, en s.
+ENERGY_MAX_GAP_S = 120
+# Nombre de jours de compteurs conservés.
+ENERGY_DAYS_KEPT = 7
+# Intervalle entre deux sauvegardes et publications MQTT des compteurs, en secondes.
+ENERGY_PUBLISH_INTERVAL_S = 300
+# Fichier de sauvegarde des compteurs. Chemin relatif au répertoire de lancement. Laisser vide pour désactiver.
+# Peut être surchargé par la ligne de commande.
+ENERGY_JOURNAL_FILE = "solar_power_regulator_energy.json"
+
+# --- Journal d'état (redémarrage à chaud) ---
+# Fichier JSON dans lequel l'état de la régulation est sauvegardé périodiquement (écriture atomique).
+# Au redémarrage, le démon reprend cet état et vérifie power_limit en tâche de fond. Laisser vide pour désactiver.
+# Chemin relatif au répertoire de lancement (WorkingDirectory du service systemd). Peut être surchargé par la ligne de commande.
+STATE_JOURNAL_FILE = "solar_power_regulator_state.json"
+# Intervalle entre deux sauvegardes du journal. Le fichier n'est réécrit que si l'état a changé.
+STATE_JOURNAL_INTERVAL_S = 30
+# Age maximum du journal pour qu'il soit repris au démarrage. Au-delà, l'état est considéré comme périmé.
+STATE_JOURNAL_MAX_AGE_S = 900
+
+# --- Fichier de configuration externe ---
+# Fichier JSON optionnel qui surcharge les paramètres de régulation, de temporisation et MQTT ci-dessus (voir RegulationConfig.PARAMETERS).
+# Il est relu à chaud sur réception du signal SIGHUP ou d'une requête POST /reload : les nouvelles tables sont validées et précompilées,
+# puis substituées d'un bloc, sans redémarrage et sans perte de l'état de régulation.
+# Laisser vide pour n'utiliser que les valeurs du code. Peut être surchargé par la ligne de commande.
+CONFIG_FILE = ""
+
+# --- Serveur HTTP ---
+# HTTP/1.1 persistant (keep-alive) : un client qui réutilise sa connexion TCP d'une mesure à l'autre évite, à chaque mesure, l'ouverture
+# et la fermeture de la connexion. Les connexions sont traitées par un groupe de threads réutilisés, et non par un thread créé à chaque
+# connexion : HTTP_WORKERS au démarrage, un de plus quand une connexion attend et qu'aucun n'est libre, jusqu'à HTTP_MAX_WORKERS.
+# Une connexion persistante inactive cède son thread quand une autre connexion attend et que le groupe est au maximum : elle en est
+# avertie par un octet écrit dans un tube (self-pipe), surveillé avec sa connexion, sans attente active. Les clients HTTP/1.0 (shelly_fleet.py) gardent
+# une connexion par requête. Gain mesuré par speedtests/http_keepalive_speedtest.py.
+HTTP_KEEPALIVE_ENABLE = True
+HTTP_WORKERS = 4
+HTTP_MAX_WORKERS = 64
+# Une connexion persistante est fermée après une inactivité égale au délai le plus long demandé au Shelly dans une tranche de régulation
+# (ADAPTIVE_INTERVAL_MAX_S de la configuration active, rechargeable), plus cette marge en secondes : la connexion n'est jamais fermée
+# par le démon au moment où le Shelly l'utilise. Hors tranche ou la nuit, les mesures sont espacées, la connexion est fermée entre deux.
+HTTP_IDLE_MARGIN_S = 2 * SHELLY_DEFAULT_INTERVAL_S
+# Délai maximum de réception d'une requête commencée, en secondes (le Shelly abandonne après 5s).
+HTTP_REQUEST_TIMEOUT_S = 10
+
 # --- Paramètres MQTT ---
 # 0 : Désactiver l'envoi d'informations MQTT. 1 : MQTT activé, pour tout. 2 : MQTT activé, mais juste pour les évènements
 MQTT_ENABLE = 1
@@ -111,7 +313,8 @@ MQTT_ENABLE = 1
 #    le serveur - le port TCP - le compte de connexion - le mot de passe. 1 si SSL ou TLS
 MQTT_CONN = ("localhost", 1883, "user", "password", 0)
 
-# le topic MQTT racine pour cette fonction. Il y aura ensuite 2 sous-topics : /run pour les infos courantes, /evt pour les évenement
+# le topic MQTT racine pour cette fonction. Il y aura ensuite des sous-topics : /run pour les infos courantes, /evt pour les évenement,
+# /actuation pour les mesures de latence d'actionnement, /energy pour les compteurs d'énergie, /shadow pour le mode shadow
 MQTT_ROOT_TOPIC = "solar_power_regulator"
 
 #les codes évenements MQTT
@@ -136,10 +339,192 @@ class ReturnCode:
     DIFFERENT_POWER_LIMIT = (1, "Power-limit value read on device is different from stored value")
     MODBUS_FAILURE = (2, "Modbus communication failed")
     MODBUS_RECURRENT_FAILURE = (3, "Modbus recurrent communication failure")
+    STALE_SAMPLE = (4, "Sample out of sequence or stale, not used for regulation")
     OTHER_ERROR = (9, "An other error occurred")
 
+class StartupProfiler:
+    """Mesure la durée des étapes du démarrage, pour l'option --startup-profile."""
+    def __init__(self):
+        self.steps = []
+        self.lock = RLock()
+
+    def record(self, name, duration):
+        with self.lock:
+            self.steps.append((name, duration, time.perf_counter() - _STARTUP_T0))
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        """Ecrit dans la log le détail des étapes : durée de l'étape, et instant de fin depuis le lancement du script."""
+        with self.lock:
+            steps = sorted(self.steps, key=lambda step: step[2])
+        logging.info("Profil de démarrage (durée de l'étape / fin depuis le lancement du script) :")
+        for name, duration, end in steps:
+            logging.info(f"  {name:<32} {duration*1000:8.1f} ms   t+{end*1000:8.1f} ms")
+
+_lazy_modules = {}
+_lazy_import_lock = RLock()
+
+def lazy_import(module_name):
+    """Importe un module lourd à la première utilisation. La durée du premier import est enregistrée dans le profil de démarrage."""
+    module = _lazy_modules.get(module_name)
+    if module is None:
+        with _lazy_import_lock:
+            module = _lazy_modules.get(module_name)
+            if module is None:
+                with startup_profiler.measure(f"import {module_name}"):
+                    module = importlib.import_module(module_name)
+                _lazy_modules[module_name] = module
+    return module
+
+def _check_int(name, value, minimum=None, maximum=None):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{name}: entier attendu, reçu {value!r}")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ValueError(f"{name}: valeur {value} hors de la plage [{minimum}, {maximum}]")
+    return value
+
+def _check_bool(name, value):
+    if not isinstance(value, bool):
+        raise ValueError(f"{name}: booléen attendu, reçu {value!r}")
+    return value
+
+def _check_int_tuple(name, value, length):
+    if not isinstance(value, (list, tuple)) or len(value) != length:
+        raise ValueError(f"{name}: liste de {length} entiers attendue, reçu {value!r}")
+    return tuple(_check_int(name, item) for item in value)
+
+def _check_windows(name, value):
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f"{name}: liste de tranches [\"HH:MM\", \"HH:MM\"] attendue, reçu {value!r}")
+    windows = []
+    for window in value:
+        if not isinstance(window, (list, tuple)) or len(window) != 2:
+            raise ValueError(f"{name}: tranche [\"HH:MM\", \"HH:MM\"] attendue, reçu {window!r}")
+        try:
+            datetime.strptime(window[0], "%H:%M"); datetime.strptime(window[1], "%H:%M")
+        except (TypeError, ValueError):
+            raise ValueError(f"{name}: horaire invalide dans {window!r}")
+        windows.append((window[0], window[1]))
+    return windows
+
+def _check_thresholds(name, value):
+    if not isinstance(value, (list, tuple)) or not value:
+        raise ValueError(f"{name}: liste non vide de seuils [seuil, incrément, délai] attendue")
+    return sorted((_check_int_tuple(name, item, 3) for item in value), key=lambda x: x[0], reverse=True)
+
+def _check_mqtt_conn(name, value):
+    if not isinstance(value, (list, tuple)) or len(value) != 5:
+        raise ValueError(f"{name}: [serveur, port, compte, mot de passe, tls] attendu, reçu {value!r}")
+    host, port, user, password, use_tls = value
+    if not all(isinstance(item, str) for item in (host, user, password)):
+        raise ValueError(f"{name}: serveur, compte et mot de passe doivent être des chaînes")
+    return (host, _check_int(name, port, 1, 65535), user, password, _check_int(name, use_tls, 0, 1))
+
+def _check_topic(name, value):
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"{name}: chaîne non vide attendue, reçu {value!r}")
+    return value
+
+def _check_statistics(name, value):
+    uses, names = ("regulation", "energy", "actuation", "trend"), ("last", "mean", "min", "max")
+    if not isinstance(value, dict) or set(value) - set(uses) or any(v not in names for v in value.values()):
+        raise ValueError(f"{name}: dictionnaire {{usage: statistique}} attendu (usages {', '.join(uses)} ; statistiques {', '.join(names)}), reçu {value!r}")
+    return dict(value)
+
+class RegulationConfig:
+    """Paramètres rechargeables de la régulation, validés et précompilés.
+
+    Les valeurs par défaut sont les constantes en tête de ce fichier ; le fichier de configuration peut les surcharger.
+    Une instance n'est jamais modifiée : un rechargement en construit une nouvelle hors du chemin critique,
+    puis la substitue d'un bloc à la variable globale `config`.
+    """
+    # nom du paramètre -> fonction de validation
+    PARAMETERS = {
+        "TOTAL_RATED_SOLAR_POWER":            lambda n, v: _check_int(n, v, 1),
+        "REGULATION_WINDOWS":                 _check_windows,
+        "MIN_POWER_LIMIT_PERMILLE":           lambda n, v: _check_int(n, v, 0, 1000),
+        "MAX_POWER_LIMIT_PERMILLE":           lambda n, v: _check_int(n, v, 0, 1000),
+        "INJECTION_POWER_THRESHOLDS":         _check_thresholds,
+        "CONSECUTIVE_IMPORT_COUNT_FOR_RESET": lambda n, v: _check_int(n, v, 1),
+        "FAST_DROP_ALGORITHM_ENABLE":         _check_bool,
+        "FAST_DROP_THRESHOLDS":               lambda n, v: _check_int_tuple(n, v, 4),
+        "FAST_RISE_ALGORITHM_ENABLE":         _check_bool,
+        "FAST_RISE_THRESHOLDS":               lambda n, v: _check_int_tuple(n, v, 4),
+        "FAST_COOLDOWN_NB":                   lambda n, v: _check_int(n, v, 0),
+        "PERIODIC_MODBUS_READ_INTERVAL_S":    lambda n, v: _check_int(n, v, 1),
+        "WATCHDOG_TIMEOUT_S":                 lambda n, v: _check_int(n, v, 1),
+        "PERIODIC_TASK_INTERVAL_S":           lambda n, v: _check_int(n, v, 1),
+        "ADAPTIVE_INTERVAL_ENABLE":           _check_bool,
+        "ADAPTIVE_INTERVAL_MAX_S":            lambda n, v: _check_int(n, v, 1),
+        "HEADROOM_CLAMP_ENABLE":              _check_bool,
+        "FEEDFORWARD_ENABLE":                 _check_bool,
+        "SAMPLE_STATISTICS":                  _check_statistics,
+        "MQTT_ENABLE":                        lambda n, v: _check_int(n, v, 0, 2),
+        "MQTT_CONN":                          _check_mqtt_conn,
+        "MQTT_ROOT_TOPIC":                    _check_topic,
+    }
+
+    def __init__(self, overrides=None, source="code"):
+        overrides = {k: v for k, v in (overrides or {}).items() if not k.startswith("_")}   # clés "_..." : commentaires
+        unknown = set(overrides) - set(self.PARAMETERS)
+        if unknown:
+            raise ValueError(f"paramètre(s) inconnu(s) ou non rechargeable(s): {', '.join(sorted(unknown))}")
+        self.source = source
+        self.values = {}
+        for name, check in self.PARAMETERS.items():
+            self.values[name] = check(name, overrides.get(name, globals()[name]))
+            setattr(self, name.lower(), self.values[name])
+        if self.min_power_limit_permille > self.max_power_limit_permille:
+            raise ValueError("MIN_POWER_LIMIT_PERMILLE doit être inférieur à MAX_POWER_LIMIT_PERMILLE")
+
+        # --- tables précompilées ---
+        # tranches horaires : (début, fin) en datetime.time
+        self.windows = tuple((datetime.strptime(start, "%H:%M").time(), datetime.strptime(end, "%H:%M").time())
+                             for start, end in self.regulation_windows)
+        # seuils : (seuil, incrément, délai, libellé de la plage)
+        thresholds = []
+        for i, (threshold, increment, interval) in enumerate(self.injection_power_thresholds):
+            lower_bound_str, upper_bound_str = f"{threshold}W", f"<{self.injection_power_thresholds[i-1][0]}W" if i > 0 else ""
+            threshold_info = f"{lower_bound_str}..{upper_bound_str}" if upper_bound_str else f">{lower_bound_str}"
+            thresholds.append((threshold, increment, interval, threshold_info))
+        self.thresholds = tuple(thresholds)
+        # paramètres figés du coeur de régulation (voir controller_step)
+        self.controller_params = ControllerParams(
+            self.min_power_limit_permille, self.max_power_limit_permille, BUGGY_LIMIT_PERMILLE, self.thresholds,
+            self.consecutive_import_count_for_reset, self.fast_drop_algorithm_enable, self.fast_drop_thresholds,
+            self.fast_rise_algorithm_enable, self.fast_rise_thresholds, self.fast_cooldown_nb, self.total_rated_solar_power)
+
+    @classmethod
+    def from_file(cls, path, base=None):
+        """Construit la configuration à partir d'un fichier JSON. Les paramètres absents du fichier sont ceux de la configuration
+        base si elle est donnée (candidates du mode shadow), sinon les constantes du code.
+        Lève OSError ou ValueError si le fichier est invalide."""
+        with open(path, 'r', encoding='utf-8') as f:
+            overrides = json.load(f)
+        if not isinstance(overrides, dict):
+            raise ValueError("le fichier de configuration doit contenir un objet JSON")
+        return cls({**base.values, **overrides} if base else overrides, source=path)
+
+    def changed_parameters(self, other):
+        """Liste des paramètres dont la valeur diffère entre deux configurations."""
+        return [name for name in self.PARAMETERS if self.values[name] != other.values[name]]
+
 class RegulationState:
     """Encapsule l'état dynamique de la régulation."""
+    # Attributs sauvegardés dans le journal d'état, et restaurés au redémarrage
+    JOURNAL_FIELDS = (
+        "current_power_limit_permille", "last_modbus_read_time", "consecutive_modbus_write_errors",
+        "last_shelly_request_time", "watchdog_triggered", "consecutive_import_count",
+        "consecutive_high_injection_count", "consecutive_deep_import_count", "fast_cooldown",
+    )
+
     def __init__(self):
         self.current_power_limit_permille = -1
         self.last_modbus_read_time = 0
@@ -152,19 +537,599 @@ class RegulationState:
         self.consecutive_deep_import_count = 0
         self.fast_cooldown = 0
         self.last_run_payload = ""
+        self.restored_from_journal = False
+        # délai adaptatif : instant de la dernière écriture, dernière injection reçue, nombre de requêtes stables consécutives
+        self.last_write_time = 0
+        self.last_injection_power = None
+        self.stable_count = 0
+
+    def to_journal(self):
+        """Retourne un instantané de l'état, sérialisable en JSON."""
+        return {field: getattr(self, field) for field in self.JOURNAL_FIELDS}
+
+    def restore_journal(self, data):
+        """Restaure l'état à partir d'un instantané du journal."""
+        for field in self.JOURNAL_FIELDS:
+            if field in data:
+                setattr(self, field, data[field])
+        self.restored_from_journal = True
 
     def is_in_regulation_window(self):
         """Vérifie si l'heure actuelle est dans une des fenêtres de régulation."""
-        if not REGULATION_WINDOWS: return True
+        windows = config.windows
+        if not windows: return True
         now = datetime.now().time()
-        for start_str, end_str in REGULATION_WINDOWS:
-            start_time, end_time = datetime.strptime(start_str, "%H:%M").time(), datetime.strptime(end_str, "%H:%M").time()
+        for start_time, end_time in windows:
             if start_time <= end_time:
                 if start_time <= now <= end_time: return True
             else:
                 if start_time <= now or now <= end_time: return True
         return False
 
+    def seconds_to_next_window(self):
+        """Nombre de secondes jusqu'au début de la prochaine tranche de régulation (None s'il n'y a pas de tranche)."""
+        if not config.windows: return None
+        now = datetime.now()
+        starts = []
+        for start_time, _ in config.windows:
+            start = datetime.combine(now.date(), start_time)
+            starts.append(start if start > now else start + timedelta(days=1))
+        return (min(starts) - now).total_seconds()
+
+    def next_window_transition(self):
+        """Instant (time.time()) du prochain début ou fin de tranche, juste après la borne (None s'il n'y a pas de tranche)."""
+        if not config.windows: return None
+        now = datetime.now()
+        transitions = []
+        for start_time, end_time in config.windows:
+            for boundary in (datetime.combine(now.date(), start_time), datetime.combine(now.date(), end_time)):
+                transitions.append(boundary if boundary > now else boundary + timedelta(days=1))
+        return min(transitions).timestamp() + 0.001
+
+def load_inventory(path):
+    """Lit l'inventaire des MO produit par modbus_tools/discover_MO.py (même format que mo_metadata.load_inventory).
+    Lève OSError ou ValueError si le fichier est invalide ou ne contient aucun MO."""
+    with open(path, 'r', encoding='utf-8') as f:
+        inventory = json.load(f)
+    if not isinstance(inventory, dict) or not inventory.get("units"):
+        raise ValueError("aucun MO dans l'inventaire")
+    return inventory
+
+class StateJournal:
+    """Journal d'état sur disque, pour un redémarrage à chaud du démon.
+
+    L'écriture est atomique (fichier temporaire, fsync, puis rename) : en cas de crash ou de coupure,
+    le fichier contient soit l'ancien, soit le nouvel état, jamais un état partiel.
+    """
+    def __init__(self, path, max_age_s=STATE_JOURNAL_MAX_AGE_S):
+        self.path = path
+        self.max_age_s = max_age_s    # None : le journal est toujours repris (compteurs d'énergie)
+        self.last_saved_payload = None
+        self.lock = RLock()
+
+    def save(self, snapshot):
+        """Ecrit l'instantané s'il a changé depuis la dernière sauvegarde. A appeler hors de state_lock."""
+        if not self.path: return
+        payload = json.dumps(snapshot, sort_keys=True)
+        with self.lock:
+            if payload == self.last_saved_payload: return
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps({"saved_at": time.time(), "state": snapshot}))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self.last_saved_payload = payload
+            except OSError as e:
+                logging.error(f"Echec de la sauvegarde du journal d'état {self.path}: {e}")
+
+    def load(self):
+        """Lit le journal. Retourne l'instantané, ou None s'il est absent, illisible ou périmé."""
+        if not self.path or not os.path.exists(self.path): return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            age = time.time() - data["saved_at"]
+            snapshot = data["state"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Journal d'état {self.path} illisible, ignoré: {e}")
+            return None
+        if self.max_age_s is not None and age > self.max_age_s:
+            logging.info(f"Journal d'état périmé ({age:.0f}s), ignoré.")
+            return None
+        self.last_saved_payload = json.dumps(snapshot, sort_keys=True)
+        return snapshot
+
+class CircuitBreaker:
+    """Disjoncteur des commandes Modbus.
+
+    FERMÉ : fonctionnement normal. Après MODBUS_BREAKER_FAILURE_COUNT échecs consécutifs, il passe OUVERT :
+    les commandes échouent immédiatement. Une sonde en tâche de fond le fait passer SEMI-OUVERT le temps d'un essai ;
+    si l'essai réussit il se referme, sinon il redevient OUVERT et la sonde suivante est espacée.
+    """
+    CLOSED, OPEN, HALF_OPEN = "FERMÉ", "OUVERT", "SEMI-OUVERT"
+
+    def __init__(self, probe_func):
+        self.probe_func = probe_func
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_time = 0
+        self.lock = RLock()
+
+    def allow(self):
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                logging.info(f"Disjoncteur Modbus refermé après {time.time() - self.opened_time:.0f}s : l'ECU répond à nouveau.")
+                self.state = self.CLOSED
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == self.CLOSED and self.consecutive_failures >= MODBUS_BREAKER_FAILURE_COUNT:
+                logging.error(f"Disjoncteur Modbus ouvert après {self.consecutive_failures} échecs consécutifs. Les commandes échouent immédiatement jusqu'au retour de l'ECU.")
+                self.state = self.OPEN
+                self.opened_time = time.time()
+                Thread(target=self._probe_loop, daemon=True).start()
+            elif self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def _probe_loop(self):
+        interval = MODBUS_BREAKER_PROBE_INTERVAL_S
+        while self.state != self.CLOSED:
+            time.sleep(interval)
+            with self.lock:
+                self.state = self.HALF_OPEN
+            logging.debug("Disjoncteur Modbus semi-ouvert : sonde de l'ECU.")
+            self.probe_func()
+            interval = min(interval * 2, MODBUS_BREAKER_PROBE_MAX_INTERVAL_S)
+
+def _percentile(sorted_values, p):
+    """Percentile (rang le plus proche) d'une liste triée non vide."""
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+class SampleSequencer:
+    """Ordre et fraîcheur des mesures du Shelly (voir SAMPLE_*), et délai de transport de chaque mesure.
+
+    admit() est appelé à l'arrivée de la requête : une mesure hors séquence est écartée. claim() est appelé sous state_lock, juste avant
+    la décision : seule une mesure qui n'a pas été dépassée pendant l'attente du verrou, et qui n'est pas trop vieille, pilote power_limit.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.last = None              # (seq, ts) de la dernière mesure admise
+        self.ticket = 0               # numéro d'ordre de la dernière mesure admise
+        self.claimed = 0              # numéro d'ordre de la dernière mesure qui a piloté la régulation
+        self.rejected = 0             # mesures ignorées consécutives
+        self.offsets = deque(maxlen=SAMPLE_OFFSET_WINDOW)    # arrivée - ts, en s : décalage des horloges + transport
+        self.transport = deque(maxlen=ACTUATION_STATS_WINDOW)
+        self.waits = deque(maxlen=ACTUATION_STATS_WINDOW)
+        self.counters = {"accepted": 0, "unsequenced": 0, "out_of_order": 0, "duplicates": 0, "superseded": 0, "stale": 0, "restarts": 0, "resyncs": 0}
+
+    def _reject(self, outcome):
+        self.counters[outcome] += 1
+        self.rejected += 1
+        if self.rejected >= SAMPLE_RESYNC_COUNT:
+            self.last, self.rejected = None, 0
+            self.offsets.clear()
+            self.counters["resyncs"] += 1
+
+    def admit(self, seq, ts, now=None, buffered=False):
+        """Mesure reçue (seq, ts : None si absents). Retourne son numéro d'ordre, ou None si elle est hors séquence.
+        buffered : mesure gardée par le Shelly avant l'envoi (lot), son délai de transport n'est pas significatif. Une mesure gardée
+        déjà reçue (lot renvoyé après un timeout du Shelly, alors que le démon l'avait traité) est écartée sans compter pour la
+        resynchronisation : seule la mesure courante, la dernière du lot, peut révéler un redémarrage ou une horloge recalée."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if seq is None and ts is None:
+                self.counters["unsequenced"] += 1
+                self.ticket += 1
+                return self.ticket
+            if self.last:
+                last_seq, last_ts = self.last
+                newer_ts = ts is not None and last_ts is not None and ts > last_ts
+                if seq is not None and last_seq is not None and seq <= last_seq:
+                    if not newer_ts:
+                        if buffered:
+                            self.counters["duplicates"] += 1; return None
+                        self._reject("out_of_order"); return None
+                    self.counters["restarts"] += 1
+                elif ts is not None and last_ts is not None and ts < last_ts:
+                    self._reject("out_of_order"); return None
+            self.last = (seq, ts)
+            if ts is not None and not buffered:
+                self.offsets.append(now - ts / 1000)
+                self.transport.append(self.offsets[-1] - min(self.offsets))
+            self.counters["accepted"] += 1
+            self.ticket += 1
+            return self.ticket
+
+    def claim(self, ticket, ts, arrival, now=None):
+        """Au moment de la décision. Retourne None si la mesure peut piloter power_limit, sinon la raison ("superseded", "stale")."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.waits.append(now - arrival)
+            if ticket < self.claimed:
+                self.counters["superseded"] += 1; return "superseded"
+            if ts is not None and self.offsets and now - ts / 1000 - min(self.offsets) > SAMPLE_MAX_AGE_S:
+                self._reject("stale"); return "stale"
+            self.claimed, self.rejected = ticket, 0
+            return None
+
+    def sample_time(self, ts, now):
+        """Instant d'une mesure sur l'horloge du démon (ts : horodatage du Shelly en ms), à défaut now (arrivée de la requête)."""
+        with self.lock:
+            if ts is None or not self.offsets: return now
+            return min(now, ts / 1000 + min(self.offsets))
+
+    def summary(self):
+        with self.lock:
+            result = dict(self.counters)
+            for name, values in (("transport_ms", self.transport), ("lock_wait_ms", self.waits)):
+                ordered = sorted(values)
+                result[name] = {"n": len(ordered), "p50": round(_percentile(ordered, 50) * 1000), "p90": round(_percentile(ordered, 90) * 1000),
+                                "max": round(ordered[-1] * 1000)} if ordered else {"n": 0}
+            return result
+
+class ActuationTracker:
+    """Mesure en ligne de la latence d'actionnement : délai entre l'écriture de power_limit et le début de la variation
+    de production (onset), puis jusqu'à son établissement (settle).
+
+    Une seule écriture est suivie à la fois : une nouvelle écriture termine la mesure en cours. Chaque échantillon de production
+    est traité au fil de l'eau (quelques comparaisons), et seules les ACTUATION_STATS_WINDOW dernières mesures sont conservées :
+    la mémoire utilisée est constante. Le début de réaction est interpolé linéairement entre deux échantillons : sa précision
+    dépend de l'intervalle entre les requêtes du Shelly, c'est surtout un indicateur de tendance.
+    Une écriture n'est mesurée que si une variation de production est attendue : baisse sous la production actuelle, ou hausse
+    alors que la production était bridée par la limite précédente.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.onsets = deque(maxlen=ACTUATION_STATS_WINDOW)
+        self.settles = deque(maxlen=ACTUATION_STATS_WINDOW)
+        self.counters = {"measured": 0, "no_response": 0, "superseded": 0, "unsettled": 0}
+        self.last_solar = None        # (instant, production) du dernier échantillon
+        self.pending = None           # mesure en cours
+
+    def record_write(self, old_limit, new_limit, rated_power):
+        """Appelé après une écriture réussie de power_limit. Retourne la mesure terminée par cette écriture, ou None."""
+        with self.lock:
+            finished = self._finish("superseded") if self.pending else None
+            if self.last_solar is None or old_limit < 0:
+                return finished
+            t_write, solar = time.time(), self.last_solar[1]
+            if new_limit < old_limit:
+                expected = min(0.0, new_limit * rated_power / 1000 - solar)
+            else:
+                throttled = solar >= 0.9 * old_limit * rated_power / 1000
+                expected = new_limit * rated_power / 1000 - solar if throttled else 0.0
+            if abs(expected) >= ACTUATION_MIN_STEP_W:
+                self.pending = {"t_write": t_write, "solar_0": solar, "sign": 1 if expected > 0 else -1,
+                                "from": old_limit, "to": new_limit, "onset_s": None, "prev": (t_write, solar)}
+            return finished
+
+    def observe(self, solar_power, now=None):
+        """Nouvel échantillon de production (now : instant de la mesure, pour les mesures d'un lot).
+        Retourne la mesure si elle vient de se terminer, sinon None."""
+        with self.lock:
+            now = time.time() if now is None else now
+            if self.last_solar and now < self.last_solar[0]: return None
+            self.last_solar = (now, solar_power)
+            m = self.pending
+            if not m or now < m["t_write"]: return None
+            t_prev, s_prev = m["prev"]
+            m["prev"] = (now, solar_power)
+            if m["onset_s"] is None:
+                moved, moved_prev = (solar_power - m["solar_0"]) * m["sign"], (s_prev - m["solar_0"]) * m["sign"]
+                if moved >= ACTUATION_ONSET_W:
+                    fraction = (ACTUATION_ONSET_W - moved_prev) / (moved - moved_prev) if moved > moved_prev else 1.0
+                    m["onset_s"] = t_prev + max(0.0, min(1.0, fraction)) * (now - t_prev) - m["t_write"]
+                elif now - m["t_write"] > ACTUATION_TIMEOUT_S:
+                    return self._finish("no_response")
+            elif abs(solar_power - s_prev) < ACTUATION_SETTLE_TOLERANCE_W:
+                return self._finish("measured", settle_s=t_prev - m["t_write"])
+            elif now - m["t_write"] > ACTUATION_TIMEOUT_S:
+                return self._finish("unsettled")
+            return None
+
+    def _finish(self, outcome, settle_s=None):
+        m, self.pending = self.pending, None
+        self.counters[outcome] += 1
+        if m["onset_s"] is not None:
+            self.onsets.append(m["onset_s"])
+        if settle_s is not None:
+            self.settles.append(max(settle_s, m["onset_s"]))
+        return {"outcome": outcome, "from": m["from"] / 10.0, "to": m["to"] / 10.0,
+                "onset_s": None if m["onset_s"] is None else round(m["onset_s"], 1),
+                "settle_s": None if settle_s is None else round(max(settle_s, m["onset_s"]), 1)}
+
+    def predicted_settle_s(self, default, min_samples=3):
+        """Temps d'établissement prévu : médiane des dernières mesures, ou la valeur par défaut s'il y en a trop peu."""
+        with self.lock:
+            return _percentile(sorted(self.settles), 50) if len(self.settles) >= min_samples else default
+
+    def summary(self):
+        """Percentiles glissants des dernières mesures, et compteurs."""
+        with self.lock:
+            result = dict(self.counters)
+            for name, values in (("onset_s", self.onsets), ("settle_s", self.settles)):
+                ordered = sorted(values)
+                result[name] = {"n": len(ordered), "p50": round(_percentile(ordered, 50), 1), "p90": round(_percentile(ordered, 90), 1),
+                                "max": round(ordered[-1], 1)} if ordered else {"n": 0}
+            return result
+
+class HeadroomEstimator:
+    """Estimation du plafond de production disponible (production non bridée), à partir des mesures du Shelly.
+
+    Une mesure prise après l'établissement de la production, et sous HEADROOM_UNCONSTRAINED_RATIO fois la limite courante, donne
+    directement le plafond. Une mesure au niveau de la limite ne renseigne que sur un minimum : si elle atteint le plafond estimé,
+    l'estimation est abandonnée (le soleil est revenu). Une estimation plus vieille que HEADROOM_MAX_AGE_S n'est pas utilisée.
+    Les DC1/DC2 power des MO ne sont pas utilisés : l'ECU ne les rafraichit que toutes les 5 minutes, et ils coûtent des requêtes.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.ceiling_w = None         # production disponible estimée, en W
+        self.updated = 0              # instant de la dernière estimation
+        self.counters = {"skipped_writes": 0, "clamped_rises": 0, "accelerated_drops": 0}
+
+    def observe(self, solar_power, limit_permille, rated_power, settled, now=None):
+        """Nouvel échantillon de production. settled : la production est établie depuis la dernière écriture."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if limit_permille < 0: return
+            if solar_power >= HEADROOM_UNCONSTRAINED_RATIO * limit_permille * rated_power / 1000:
+                if self.ceiling_w is not None and solar_power >= self.ceiling_w:
+                    self.ceiling_w = None    # production bridée au-dessus du plafond estimé : il a augmenté
+            elif settled:
+                self.ceiling_w, self.updated = solar_power, now
+
+    def useful_limit(self, rated_power, now=None):
+        """Limite au-delà de laquelle une hausse n'a pas d'effet, en pour mille, ou None si le plafond n'est pas connu.
+        A cette limite, la production disponible est sous HEADROOM_UNCONSTRAINED_RATIO : l'estimation reste alimentée."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.ceiling_w is None or now - self.updated > HEADROOM_MAX_AGE_S: return None
+            return math.ceil(self.ceiling_w / HEADROOM_UNCONSTRAINED_RATIO * 1000 / rated_power) + HEADROOM_MARGIN_PERMILLE
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def summary(self):
+        with self.lock:
+            age = time.time() - self.updated
+            return {**self.counters, "ceiling_w": None if self.ceiling_w is None else round(self.ceiling_w),
+                    "age_s": round(age) if self.ceiling_w is not None else None}
+
+def theil_sen_slope(points):
+    """Pente de Theil-Sen d'une série [(instant, valeur)] : médiane des pentes entre toutes les paires de points, en unité/s.
+    Insensible à une minorité de mesures aberrantes (un appel de charge bref par exemple). None sans deux instants distincts."""
+    slopes = sorted((v1 - v0) / (t1 - t0) for i, (t0, v0) in enumerate(points) for t1, v1 in points[i + 1:] if t1 > t0)
+    if not slopes: return None
+    middle = len(slopes) // 2
+    return slopes[middle] if len(slopes) % 2 else (slopes[middle - 1] + slopes[middle]) / 2
+
+class TrendPredictor:
+    """Prévision à court terme de la consommation et de la production, pour l'anticipation (voir FEEDFORWARD_*).
+
+    Deux historiques circulaires (instant, puissance), limités à FEEDFORWARD_WINDOW_S secondes et à max_samples mesures : la mémoire
+    et le calcul par mesure sont bornés. Ne lit pas l'état global du démon : utilisé aussi par regulator_replay.py.
+    """
+    def __init__(self, window_s=FEEDFORWARD_WINDOW_S, min_samples=FEEDFORWARD_MIN_SAMPLES,
+                 max_correction_w=FEEDFORWARD_MAX_CORRECTION_W, max_samples=32):
+        self.lock = RLock()
+        self.window_s, self.min_samples, self.max_correction_w = window_s, min_samples, max_correction_w
+        self.house = deque(maxlen=max_samples)
+        self.solar = deque(maxlen=max_samples)
+        self.slopes = (None, None)    # dernières pentes (production, consommation), en W/s
+        self.last_correction_w = 0
+        self.corrections = 0          # nombre de mesures corrigées
+
+    def observe(self, solar_power, house_power, solar_valid, now=None):
+        """Nouvelle mesure. solar_valid : la production n'est ni bridée, ni en cours de réaction à une écriture."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.house.append((now, house_power))
+            if solar_valid:
+                self.solar.append((now, solar_power))
+
+    def _slope(self, series, now):
+        while series and now - series[0][0] > self.window_s:
+            series.popleft()
+        return theil_sen_slope(list(series)) if len(series) >= self.min_samples else None
+
+    def predict(self, solar_power, injection_power, horizon_s, cap_w, now=None):
+        """Production et injection prévues dans horizon_s secondes, à limite inchangée (cap_w : production maximum à la limite
+        courante). Retourne les mesures telles quelles si aucune tendance n'est disponible."""
+        now = time.time() if now is None else now
+        bound = lambda w: max(-self.max_correction_w, min(w, self.max_correction_w))
+        with self.lock:
+            self.slopes = (self._slope(self.solar, now), self._slope(self.house, now))
+            solar_delta, house_delta = (bound((slope or 0.0) * horizon_s) for slope in self.slopes)
+            # à la limite courante, la production ne peut pas dépasser le bridage
+            predicted_solar = max(0.0, min(solar_power + solar_delta, max(solar_power, cap_w)))
+            predicted_injection = predicted_solar - (solar_power - injection_power + house_delta)
+            correction = round(bound(predicted_injection - injection_power))
+            self.last_correction_w = correction
+            if correction != 0:
+                self.corrections += 1
+            return round(predicted_solar), injection_power + correction
+
+    def summary(self):
+        with self.lock:
+            solar_slope, house_slope = (None if slope is None else round(slope, 2) for slope in self.slopes)
+            return {"solar_slope_w_s": solar_slope, "house_slope_w_s": house_slope, "last_correction_w": self.last_correction_w,
+                    "corrections": self.corrections}
+
+def _split_trapezoid(p0, p1, dt):
+    """Intégrale, en Wh, de la puissance variant linéairement de p0 à p1 pendant dt secondes : (partie positive, partie négative)."""
+    if p0 >= 0 and p1 >= 0: return (p0 + p1) * dt / 7200, 0.0
+    if p0 <= 0 and p1 <= 0: return 0.0, -(p0 + p1) * dt / 7200
+    crossing = dt * p0 / (p0 - p1)    # instant du passage par zéro
+    if p0 > 0: return p0 * crossing / 7200, -p1 * (dt - crossing) / 7200
+    return p1 * (dt - crossing) / 7200, -p0 * crossing / 7200
+
+class EnergyAccountant:
+    """Comptage d'énergie, à partir des mesures du Shelly (injection et production, toutes les 5s environ).
+
+    Chaque mesure est intégrée avec la précédente par la méthode des trapèzes, en temps constant : l'injection est séparée en
+    énergie injectée et importée (au passage par zéro près), l'autoconsommation est la production moins l'injection.
+    L'énergie bridée est une estimation : quand la production plafonne à la limite courante, elle est comptée comme l'écart
+    entre la production et la puissance nominale des MO (majorant : les MO ne donnent pas toujours leur puissance nominale).
+    Un intervalle plus long que ENERGY_MAX_GAP_S n'est pas intégré, sa durée est comptée dans "gap_s".
+    Chaque intervalle est compté dans le jour et l'heure de sa fin ; seuls les ENERGY_DAYS_KEPT derniers jours sont gardés.
+    """
+    COUNTERS = ("solar_wh", "injected_wh", "imported_wh", "self_consumed_wh", "curtailed_wh")
+
+    def __init__(self):
+        self.lock = RLock()
+        self.days = {}               # "AAAA-MM-JJ" -> {compteur: Wh, "gap_s": s, "hours": {"HH": {compteur: Wh}}}
+        self.last_sample = None      # (instant, injection, production, bridage) de la mesure précédente
+
+    def add(self, injection_power, solar_power, limit_permille, rated_power, now=None):
+        """Intègre une mesure du Shelly. limit_permille : power_limit courant (-1 si inconnu)."""
+        now = time.time() if now is None else now
+        throttled = 0 <= limit_permille < config.max_power_limit_permille and solar_power >= 0.9 * limit_permille * rated_power / 1000
+        curtailed = max(0.0, rated_power - solar_power) if throttled else 0.0
+        with self.lock:
+            previous = self.last_sample
+            if previous is not None and now <= previous[0]: return
+            self.last_sample = (now, injection_power, solar_power, curtailed)
+            if previous is None: return
+            t0, injection_0, solar_0, curtailed_0 = previous
+            stamp = datetime.fromtimestamp(now)
+            day = self.days.get(stamp.strftime("%Y-%m-%d"))
+            if day is None:
+                day = self._new_day(stamp.strftime("%Y-%m-%d"))
+            dt = now - t0
+            if dt > ENERGY_MAX_GAP_S:
+                day["gap_s"] += dt
+                return
+            injected, imported = _split_trapezoid(injection_0, injection_power, dt)
+            self_0, self_1 = max(0, solar_0 - max(0, injection_0)), max(0, solar_power - max(0, injection_power))
+            increments = {"solar_wh": (solar_0 + solar_power) * dt / 7200, "injected_wh": injected, "imported_wh": imported,
+                          "self_consumed_wh": (self_0 + self_1) * dt / 7200, "curtailed_wh": (curtailed_0 + curtailed) * dt / 7200}
+            hour = day["hours"].setdefault(stamp.strftime("%H"), dict.fromkeys(self.COUNTERS, 0.0))
+            for name, value in increments.items():
+                day[name] += value; hour[name] += value
+
+    def _new_day(self, key):
+        self.days[key] = {**dict.fromkeys(self.COUNTERS, 0.0), "gap_s": 0.0, "hours": {}}
+        for old in sorted(self.days)[:-ENERGY_DAYS_KEPT]:
+            del self.days[old]
+        return self.days[key]
+
+    def today(self):
+        """Compteurs du jour et de l'heure en cours, en kWh (pour MQTT)."""
+        with self.lock:
+            stamp = datetime.now()
+            day = self.days.get(stamp.strftime("%Y-%m-%d"), {})
+            hour = day.get("hours", {}).get(stamp.strftime("%H"), {})
+            result = {"date": stamp.strftime("%Y-%m-%d"), "gap_s": round(day.get("gap_s", 0))}
+            for name in self.COUNTERS:
+                kwh = name.replace("_wh", "_kwh")
+                result[kwh] = round(day.get(name, 0.0) / 1000, 3)
+                result[f"hour_{kwh}"] = round(hour.get(name, 0.0) / 1000, 3)
+            return result
+
+    def summary(self):
+        """Compteurs des jours conservés, en kWh, avec le détail horaire."""
+        with self.lock:
+            def kwh(counters):
+                return {name.replace("_wh", "_kwh"): round(counters[name] / 1000, 3) for name in self.COUNTERS}
+            return {date: {**kwh(day), "gap_s": round(day["gap_s"]), "hours": {h: kwh(c) for h, c in sorted(day["hours"].items())}}
+                    for date, day in sorted(self.days.items())}
+
+    def to_journal(self):
+        with self.lock:
+            return {"days": json.loads(json.dumps(self.days))}
+
+    def restore_journal(self, data):
+        """Reprend les compteurs sauvegardés. La mesure précédente n'est pas reprise : la durée de l'arrêt n'est pas intégrée."""
+        with self.lock:
+            self.days = {date: day for date, day in data.get("days", {}).items()
+                         if isinstance(day, dict) and all(name in day for name in self.COUNTERS)}
+
+class Scheduler:
+    """Ordonnanceur à échéances des tâches de fond, dans un seul thread.
+
+    Les échéances sont dans un tas (heapq) ; le thread dort jusqu'à la plus proche, et ne se réveille que pour elle
+    (ou quand une échéance plus proche est programmée). Une tâche est une fonction sans argument qui retourne l'instant
+    (time.time()) de sa prochaine exécution, ou None pour ne plus être exécutée. Reprogrammer une tâche remplace son échéance :
+    l'ancienne entrée du tas est ignorée quand elle arrive en tête.
+    Pour chaque tâche, le retard entre l'échéance et l'exécution effective est mesuré (précision de l'ordonnancement).
+    """
+    def __init__(self):
+        self.cond = Condition()
+        self.heap = []        # (échéance, numéro de programmation, nom)
+        self.jobs = {}        # nom -> fonction, programmation en cours, statistiques
+        self.seq = 0
+
+    def schedule(self, name, due, func=None):
+        """Programme (ou reprogramme) la tâche `name` à l'instant `due`. `func` est obligatoire à la première programmation."""
+        with self.cond:
+            job = self.jobs.setdefault(name, {"func": func, "due": None, "seq": None, "runs": 0, "errors": 0,
+                                              "late_last": 0.0, "late_max": 0.0, "late_sum": 0.0, "duration_max": 0.0})
+            if func: job["func"] = func
+            self.seq += 1
+            job["due"], job["seq"] = due, self.seq
+            heapq.heappush(self.heap, (due, self.seq, name))
+            self.cond.notify()
+
+    def cancel(self, name):
+        with self.cond:
+            if name in self.jobs:
+                self.jobs[name]["due"] = self.jobs[name]["seq"] = None
+
+    def _next_job(self):
+        """Attend la prochaine échéance, et retourne (échéance, nom)."""
+        with self.cond:
+            while True:
+                while self.heap and self.jobs[self.heap[0][2]]["seq"] != self.heap[0][1]:
+                    heapq.heappop(self.heap)    # échéance remplacée ou annulée
+                delay = self.heap[0][0] - time.time() if self.heap else SCHEDULER_MAX_SLEEP_S
+                if delay <= 0: break
+                self.cond.wait(min(delay, SCHEDULER_MAX_SLEEP_S))
+            due, _, name = heapq.heappop(self.heap)
+            self.jobs[name]["due"] = self.jobs[name]["seq"] = None
+            return due, name
+
+    def run(self):
+        while True:
+            due, name = self._next_job()
+            job = self.jobs[name]
+            started = time.time()
+            late = started - due
+            if late > SCHEDULER_LATE_WARNING_S:
+                logging.warning(f"Tâche de fond {name} exécutée avec {late:.1f}s de retard.")
+            try:
+                next_due = job["func"]()
+            except Exception as e:
+                logging.exception(f"Tâche de fond {name} en erreur: {e}")
+                job["errors"] += 1
+                next_due = time.time() + SCHEDULER_ERROR_RETRY_S
+            with self.cond:
+                job["runs"] += 1
+                job["late_last"], job["late_sum"] = late, job["late_sum"] + late
+                job["late_max"] = max(job["late_max"], late)
+                job["duration_max"] = max(job["duration_max"], time.time() - started)
+                reprogrammed = job["seq"] is not None    # reprogrammée par un autre thread pendant son exécution
+            if next_due is not None and not reprogrammed:
+                self.schedule(name, next_due)
+
+    def summary(self):
+        """Précision de l'ordonnancement de chaque tâche, en millisecondes, et délai jusqu'à sa prochaine exécution."""
+        with self.cond:
+            now = time.time()
+            return {name: {"runs": job["runs"], "errors": job["errors"],
+                           "next_in_s": None if job["due"] is None else round(job["due"] - now, 1),
+                           "late_ms_last": round(job["late_last"] * 1000, 1), "late_ms_max": round(job["late_max"] * 1000, 1),
+                           "late_ms_mean": round(job["late_sum"] * 1000 / job["runs"], 1) if job["runs"] else None,
+                           "duration_ms_max": round(job["duration_max"] * 1000, 1)}
+                    for name, job in sorted(self.jobs.items())}
+
 class ModbusController:
     """Gère une connexion Modbus persistante et thread-safe avec l'ECU-R."""
     def __init__(self, host, port, slave_id):
@@ -173,15 +1138,19 @@ class ModbusController:
         self.first_connect = True
         self.lock = RLock()
         self.client = None
+        self.rtt_estimate = MODBUS_RTT_ESTIMATE_S
+        self.breaker = CircuitBreaker(self.probe)
 
-    def _connect(self):
+    def _connect(self, timeout=MODBUS_CONNECT_TIMEOUT_S):
         """Établit la connexion Modbus si elle n'est pas déjà active."""
         with self.lock:
             if self.client and self.client.is_socket_open():
                 return True
             try:
                 logging.debug(f"Tentative de connexion Modbus à {self.host}:{self.port}")
-                self.client = ModbusTcpClient(self.host, port=self.port, timeout=10)
+                ModbusTcpClient = lazy_import("pymodbus.client").ModbusTcpClient
+                # pas de nouvelle tentative dans pymodbus : elles sont gérées ici, dans le budget de temps de la commande
+                self.client = ModbusTcpClient(self.host, port=self.port, timeout=timeout, retries=0)
                 if self.client.connect():
                     if self.first_connect:
                         logging.info("Premiere connexion Modbus établie.")
@@ -204,6 +1173,11 @@ class ModbusController:
                 self.client = None
                 return False
 
+    def warmup(self):
+        """Charge pymodbus et établit la connexion par avance, pour que la première requête n'en paie pas le coût."""
+        lazy_import("pymodbus.exceptions")
+        self._connect()
+
     def disconnect(self):
         """Ferme la connexion Modbus si elle est active."""
         with self.lock:
@@ -212,27 +1186,56 @@ class ModbusController:
                 self.client.close()
             self.client = None
 
+    def request_timeout(self):
+        """Timeout d'une requête, dérivé du RTT mesuré."""
+        return max(MODBUS_REQUEST_TIMEOUT_MIN_S, min(self.rtt_estimate * MODBUS_REQUEST_TIMEOUT_RTT_FACTOR, MODBUS_REQUEST_TIMEOUT_MAX_S))
 
 # a savoir : l'ECU coupe la connexion modbus si pas de requete pendant environ plus de 5s.
-    def _execute_command(self, action_func, is_retry=False):
-        """Exécute une commande Modbus en gérant la connexion et les erreurs."""
-        with self.lock:
-            if not self._connect():
-                return None, "CONNECTION_ERROR"
-
-            try:
-                result = action_func(self.client)
-                if result.isError():
-                    raise ModbusException(str(result))
-                return result, "OK"
-            except (ModbusException, ConnectionException) as e:
-                logging.debug(f"Erreur de communication Modbus: {e}. Tentative de reconnexion...")
-                self.disconnect() # Force la fermeture avant de réessayer
-                if not is_retry:
-                    return self._execute_command(action_func, is_retry=True)
-                else:
-                    logging.error("Échec de la commande Modbus même après reconnexion.")
-                    return None, "COMMUNICATION_ERROR"
+    def _execute_command(self, action_func, probe=False):
+        """Exécute une commande Modbus en gérant la connexion et les erreurs, dans le budget de temps MODBUS_COMMAND_BUDGET_S.
+        Echoue immédiatement ("CIRCUIT_OPEN") si le disjoncteur est ouvert, sauf pour la sonde."""
+        if not probe and not self.breaker.allow():
+            return None, "CIRCUIT_OPEN"
+        modbus_exceptions = lazy_import("pymodbus.exceptions")
+        deadline = time.monotonic() + MODBUS_COMMAND_BUDGET_S
+        if not self.lock.acquire(timeout=MODBUS_COMMAND_BUDGET_S):
+            logging.warning("Budget de temps Modbus dépassé en attente du verrou.")
+            return None, "DEADLINE_EXCEEDED"
+        try:
+            status = "CONNECTION_ERROR"
+            for attempt in range(2):
+                remaining = deadline - time.monotonic()
+                if remaining < MODBUS_REQUEST_TIMEOUT_MIN_S:
+                    break
+                if not self._connect(timeout=min(MODBUS_CONNECT_TIMEOUT_S, remaining)):
+                    status = "CONNECTION_ERROR"
+                    continue
+                self.client.comm_params.timeout_connect = min(self.request_timeout(), deadline - time.monotonic())
+                start = time.monotonic()
+                try:
+                    result = action_func(self.client)
+                    if result.isError():
+                        raise modbus_exceptions.ModbusException(str(result))
+                    self.rtt_estimate += 0.2 * ((time.monotonic() - start) - self.rtt_estimate)
+                    self.breaker.record_success()
+                    return result, "OK"
+                except (modbus_exceptions.ModbusException, modbus_exceptions.ConnectionException, OSError) as e:
+                    # OSError : pymodbus laisse passer les erreurs du socket (Broken pipe, Connection reset) ; la socket morte
+                    # resterait "ouverte" pour is_socket_open(), elle est fermée pour que la tentative suivante se reconnecte
+                    logging.debug(f"Erreur de communication Modbus: {e}. Tentative de reconnexion...")
+                    self.disconnect() # Force la fermeture avant de réessayer
+                    status = "COMMUNICATION_ERROR"
+            logging.error(f"Échec de la commande Modbus ({status}).")
+            self.breaker.record_failure()
+            return None, status
+        finally:
+            self.lock.release()
+
+    def probe(self):
+        """Sonde du disjoncteur : une lecture de power_limit, qui ne met pas à jour l'état de la régulation."""
+        def action(client):
+            return client.read_holding_registers(address=MODBUS_POWER_LIMIT_REGISTER, count=1, slave=self.slave_id)
+        self._execute_command(action, probe=True)
 
     def read_power_limit(self):
         """Lit la valeur brute du registre."""
@@ -257,7 +1260,8 @@ class MQTTController:
         with self.lock:
             if self.is_connected: return
             try:
-                host, port, user, password, use_tls = MQTT_CONN
+                mqtt = lazy_import("paho.mqtt.client")
+                host, port, user, password, use_tls = config.mqtt_conn
                 self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
                 self.client.on_disconnect = lambda client, userdata, flags, rc, properties: self.on_disconnect()
                 self.client.username_pw_set(user, password)
@@ -270,64 +1274,244 @@ class MQTTController:
             except Exception as e:
                 logging.error(f"Echec de la connexion MQTT: {e}")
                 self.is_connected = False
+    def warmup(self):
+        with self.lock:
+            if not self.is_connected: self._connect()
     def on_disconnect(self):
         with self.lock: self.is_connected = False
         logging.warning("Connexion MQTT perdue. Tentative de reconnexion en cours...")
+    def reset(self):
+        """Ferme la connexion, pour qu'elle soit rétablie avec les nouveaux paramètres à la prochaine publication."""
+        with self.lock:
+            if self.client:
+                self.client.on_disconnect = None
+                self.client.loop_stop(); self.client.disconnect()
+            self.client = None; self.is_connected = False
     def publish(self, topic_suffix, payload):
-        if MQTT_ENABLE == 0: return
+        if config.mqtt_enable == 0: return
         with self.lock:
             if not self.is_connected: self._connect()
             if not self.is_connected: return
             try:
-                topic = f"{MQTT_ROOT_TOPIC}/{topic_suffix}"
+                topic = f"{config.mqtt_root_topic}/{topic_suffix}"
                 self.client.publish(topic, json.dumps(payload), qos=0)
             except Exception as e:
                 logging.error(f"Echec de la publication MQTT sur le topic {topic}: {e}"); self.is_connected = False
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    """Serveur HTTP qui gère chaque requête dans un thread séparé."""
-    pass
+class PooledHTTPServer(HTTPServer):
+    """Serveur HTTP dont les connexions sont traitées par un groupe de threads réutilisés (voir HTTP_*)."""
+    def __init__(self, server_address, handler_class, workers=HTTP_WORKERS, max_workers=HTTP_MAX_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.connections = queue.Queue()     # connexions acceptées, en attente d'un thread
+        self.lock = RLock()
+        self.counters = {"connections": 0, "requests": 0}
+        self.workers, self.idle, self.max_workers = 0, 0, max_workers
+        # un octet par connexion en attente qu'aucun thread ne peut prendre : un thread inactif sur une connexion persistante le lit
+        # et cède son thread (voir KeepAliveRequestHandler._wait_next_request)
+        self.wakeup_fd, self._wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_fd, False); os.set_blocking(self._wakeup_w, False)
+        for _ in range(workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        with self.lock:
+            self.workers += 1; self.idle += 1
+        Thread(target=self._worker, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+        with self.lock:
+            waiting = self.idle < self.backlog()
+            grow = waiting and self.workers < self.max_workers
+        if grow:
+            self._start_worker()
+        elif waiting:
+            try:
+                os.write(self._wakeup_w, b"!")
+            except BlockingIOError:
+                pass    # tube plein : les threads inactifs sont déjà avertis
+
+    def backlog(self):
+        return self.connections.qsize()
+
+    def take_wakeup(self):
+        """Appelé par un thread inactif sur une connexion persistante quand wakeup_fd est lisible. Retourne True s'il doit céder son
+        thread : il a lu l'octet (un seul thread par connexion en attente), et la connexion n'a pas été prise entre-temps."""
+        try:
+            os.read(self.wakeup_fd, 1)
+        except BlockingIOError:
+            return False
+        return self.backlog() > 0
+
+    def server_close(self):
+        super().server_close()
+        os.close(self.wakeup_fd); os.close(self._wakeup_w)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _worker(self):
+        while True:
+            request, client_address = self.connections.get()
+            with self.lock:
+                self.idle -= 1; self.counters["connections"] += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.lock: self.idle += 1
+
+    def summary(self):
+        with self.lock:
+            result = dict(self.counters, workers=self.workers, backlog=self.backlog())
+        result["requests_per_connection"] = round(result["requests"] / result["connections"], 1) if result["connections"] else None
+        return result
 
 class QuietRequestHandler(BaseHTTPRequestHandler):
     """RequestHandler qui supprime les logs HTTP standards."""
     def log_message(self, format, *args):
         return
 
-class RequestHandler(QuietRequestHandler):
+class KeepAliveRequestHandler(QuietRequestHandler):
+    """Connexions persistantes HTTP/1.1 (voir HTTP_*). Les réponses doivent porter un Content-Length : c'est lui qui délimite
+    la réponse, la connexion n'étant plus fermée après chaque requête."""
+    protocol_version = "HTTP/1.1" if HTTP_KEEPALIVE_ENABLE else "HTTP/1.0"
+    timeout = HTTP_REQUEST_TIMEOUT_S
+    # l'entête et le corps de la réponse sont deux écritures : sans TCP_NODELAY, le second attendrait l'acquittement du premier
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_next_request():
+            self.handle_one_request()
+
+    def parse_request(self):
+        self.server.count("requests")
+        return super().parse_request()
+
+    def _peek(self):
+        """Données reçues et pas encore lues (vide si aucune, ou si le client a fermé la connexion), sans attendre."""
+        self.connection.settimeout(0)
+        try:
+            return self.rfile.peek(1)
+        except OSError:
+            return b""
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def _wait_next_request(self):
+        """Attend la requête suivante sur une connexion persistante. Retourne False si la connexion doit être fermée :
+        inactive depuis le délai maximum demandé au Shelly (voir HTTP_IDLE_MARGIN_S), fermée par le client, ou une autre connexion
+        attend un thread."""
+        if self._peek(): return True
+        deadline = time.monotonic() + config.adaptive_interval_max_s + HTTP_IDLE_MARGIN_S
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            ready = select.select([self.connection, self.server.wakeup_fd], [], [], remaining)[0]
+            if self.connection in ready:
+                return bool(self._peek())
+            if ready and self.server.take_wakeup():
+                return False
+
+class RequestHandler(KeepAliveRequestHandler):
     """Gère les requêtes HTTP entrantes du Shelly."""
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self.send_json_response(200, {"actuation": actuation_tracker.summary(), "scheduler": scheduler.summary(), "energy": energy_accountant.summary(), "headroom": headroom_estimator.summary(), "feedforward": trend_predictor.summary(), "shadow": shadow_evaluator.summary(), "samples": sample_sequencer.summary(), "http": self.server.summary()})
+        else:
+            self.send_json_response(404, {"message": f"URL inconnue: {self.path}"})
+
     def do_POST(self):
+        if self.path.rstrip('/') == '/reload':
+            # corps ignoré, mais lu : sur une connexion persistante, il serait pris pour le début de la requête suivante
+            try:
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            except ValueError:
+                self.close_connection = True
+            reloaded, message = reload_config()
+            self.send_json_response(200, {"return_code": ReturnCode.OK[0] if reloaded else ReturnCode.OTHER_ERROR[0], "message": message})
+            return
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             params = json.loads(post_data)
-            injection_power = params['injection_power']
-            solar_power = params['solar_power']
-        except (json.JSONDecodeError, KeyError) as e:
+            # une mesure, ou une liste de mesures dans l'ordre chronologique (envoi par lots, voir SAMPLE_BATCH_MAX)
+            samples = [parse_sample(p) for p in (params if isinstance(params, list) else [params])]
+            if not 0 < len(samples) <= SAMPLE_BATCH_MAX:
+                raise ValueError(f"Lot de {len(samples)} mesures (de 1 à {SAMPLE_BATCH_MAX})")
+        except (ValueError, KeyError, TypeError) as e:
             logging.error(f"Invalid JSON or missing key: {e}")
             self.send_json_response(400, {"message": str(e)})
             return
 
+        arrival = time.time()
+        # le Shelly est joignable, même si toutes ses mesures sont écartées ci-dessous
+        shelly_seen(arrival)
+        admitted = []
+        for i, sample in enumerate(samples):
+            ticket = sample_sequencer.admit(sample.seq, sample.ts, arrival, buffered=i < len(samples) - 1)
+            if ticket is None:
+                logging.debug(f"Mesure hors séquence ignorée : seq={sample.seq}, ts={sample.ts}. Solar={sample.solar_power}W, Injection={sample.injection_power}W.")
+            else:
+                admitted.append((sample, ticket))
+        if not admitted:
+            self.send_response_and_exit(ReturnCode.STALE_SAMPLE, state.current_power_limit_permille, 0, -1)
+            return
+        if len(samples) > 1:
+            logging.debug(f"Lot de {len(samples)} mesures, {len(samples) - len(admitted)} déjà reçues ou hors séquence.")
+        admitted = [(sample, ticket, sample_sequencer.sample_time(sample.ts, arrival)) for sample, ticket in admitted]
+        (last, ticket, last_time), earlier = admitted[-1], admitted[:-1]
+        seq, ts, stats = last.seq, last.ts, last.stats
+        # chaque usage prend la statistique qui lui convient, si le Shelly transmet des mesures agrégées (voir SAMPLE_STATISTICS)
+        measure = lambda sample, use: sample_statistic(sample.injection_power, sample.solar_power, sample.stats, config.sample_statistics.get(use, "last"))
+        for sample, _, sample_time in admitted:
+            publish_actuation(actuation_tracker.observe(measure(sample, "actuation")[1], now=sample_time))
+            energy_accountant.add(*measure(sample, "energy"), state.current_power_limit_permille, config.total_rated_solar_power, now=sample_time)
         with state_lock:
-            state.last_shelly_request_time = time.time()
-            if state.watchdog_triggered:
-                logging.info("Communication avec le Shelly rétablie.")
-                state.watchdog_triggered = False
+            # une mesure plus récente a pu piloter power_limit pendant l'attente du verrou
+            reason = sample_sequencer.claim(ticket, ts, arrival)
+            if reason:
+                logging.debug(f"Mesure seq={seq} non utilisée pour la régulation ({reason}). Solar={last.solar_power}W, Injection={last.injection_power}W.")
+                self.send_response_and_exit(ReturnCode.STALE_SAMPLE, state.current_power_limit_permille, 0, -1)
+                return
 
             return_code_tuple = ReturnCode.OK
             if state.current_power_limit_permille == -1:
                 return_code_tuple, _ = handle_state_and_reads()
 
             if not state.is_in_regulation_window():
-                self.send_response_and_exit(ReturnCode.OK, state.current_power_limit_permille, 0, PERIODIC_TASK_INTERVAL_S)
+                self.send_response_and_exit(ReturnCode.OK, state.current_power_limit_permille, 0, out_of_window_interval())
                 return
 
             if return_code_tuple not in [ReturnCode.OK, ReturnCode.DIFFERENT_POWER_LIMIT]:
                 self.send_response_and_exit(return_code_tuple, -1, 0, -1)
                 return
 
-            new_limit, increment, threshold_info, next_interval = calculate_new_limit(injection_power, solar_power)
+            for sample, _, sample_time in admitted:
+                settled = sample_time - state.last_write_time > actuation_tracker.predicted_settle_s(ACTUATION_DEFAULT_SETTLE_S)
+                trend_injection, trend_solar = measure(sample, "trend")
+                headroom_estimator.observe(trend_solar, state.current_power_limit_permille, config.total_rated_solar_power, settled, now=sample_time)
+                if trend_solar >= 0:
+                    unconstrained = trend_solar < HEADROOM_UNCONSTRAINED_RATIO * state.current_power_limit_permille * config.total_rated_solar_power / 1000
+                    trend_predictor.observe(trend_solar, trend_solar - trend_injection, settled and unconstrained, now=sample_time)
+            for sample, _, sample_time in earlier:
+                injection_power, solar_power = measure(sample, "regulation")
+                advance_controller(injection_power, solar_power)
+                shadow_evaluator.observe(injection_power, solar_power, state.current_power_limit_permille, config.total_rated_solar_power, now=sample_time)
+            injection_power, solar_power = measure(last, "regulation")
+            decision = clamp_to_headroom(calculate_new_limit(injection_power, solar_power))
+            shadow_evaluator.observe(injection_power, solar_power, state.current_power_limit_permille, config.total_rated_solar_power, now=last_time)
+            new_limit, increment, threshold_info, _ = decision
+            next_interval = adaptive_interval(decision, injection_power)
 
             log_msg = f"Solar={solar_power}W, Injection={injection_power}W. Seuil=\"{threshold_info}\". "
+            if isinstance(stats[0], dict):
+                log_msg = f"Injection {stats[0].get('min')}..{stats[0].get('max')}W sur {stats[0].get('n')} lectures. " + log_msg
             delay_str = "default" if next_interval == -1 else f"{next_interval}s"
             if increment != 0:
                 log_msg += f"Incrément={increment/10.0:.1f}%. Limite: {state.current_power_limit_permille/10.0:.1f}% -> {new_limit/10.0:.1f}%. Delay={delay_str}."
@@ -335,7 +1519,7 @@ class RequestHandler(QuietRequestHandler):
                 log_msg += f"Pas de changement. Limite: {new_limit/10.0:.1f}%. Delay={delay_str}."
             logging.debug(log_msg)
 
-            if MQTT_ENABLE == 1:
+            if config.mqtt_enable == 1:
                 run_payload = {"solar": solar_power, "injection": injection_power, "house_power": solar_power - injection_power, "power_limit": new_limit / 10.0, "delay": next_interval}
                 if json.dumps(run_payload) != state.last_run_payload:
                     mqtt_controller.publish("run", run_payload); state.last_run_payload = json.dumps(run_payload)
@@ -347,15 +1531,46 @@ class RequestHandler(QuietRequestHandler):
             self.send_response_and_exit(return_code_tuple, state.current_power_limit_permille, increment, next_interval)
 
     def send_json_response(self, http_code, data):
+        body = json.dumps(data).encode('utf-8')
         self.send_response(http_code)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if http_code == 400 or self.close_connection or self.server.backlog():
+            # corps de la requête peut-être pas lu, ou d'autres connexions attendent un thread
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
 
     def send_response_and_exit(self, return_code_tuple, limit, increment, interval):
         response_payload = { "return_code": return_code_tuple[0], "message": return_code_tuple[1], "power_limit_value": f"{limit / 10.0:.1f}", "power_limit_increment": f"{increment / 10.0:.1f}", "sensor_read_interval": interval, }
         self.send_json_response(200, response_payload)
 
+def shelly_seen(now):
+    """Requête du Shelly reçue : instant de la dernière requête pour le watchdog, et réarmement du watchdog s'il s'était déclenché.
+    L'instant est mis à jour sans state_lock : une réponse à une mesure écartée n'attend pas une écriture Modbus en cours."""
+    state.last_shelly_request_time = now
+    if state.watchdog_triggered:
+        with state_lock:
+            if state.watchdog_triggered:
+                logging.info("Communication avec le Shelly rétablie.")
+                state.watchdog_triggered = False
+                scheduler.schedule("watchdog", now + config.watchdog_timeout_s, watchdog_job)
+
+Sample = namedtuple("Sample", ("injection_power", "solar_power", "seq", "ts", "stats"))
+
+def parse_sample(params):
+    """Mesure du Shelly (objet JSON décodé). Lève KeyError ou TypeError si elle est incomplète."""
+    return Sample(params['injection_power'], params['solar_power'], params.get('seq'), params.get('ts'),
+                  (params.get('injection_stats'), params.get('solar_stats')))
+
+def sample_statistic(injection_power, solar_power, stats, statistic):
+    """(injection, production) selon la statistique demandée, si le Shelly a transmis des mesures agrégées (injection_stats,
+    solar_stats : {"mean", "min", "max", "last", "n"}) ; sinon, ou si la statistique est absente, les mesures instantanées."""
+    def pick(value, aggregated):
+        chosen = aggregated.get(statistic) if isinstance(aggregated, dict) else None
+        return chosen if isinstance(chosen, (int, float)) and not isinstance(chosen, bool) else value
+    return pick(injection_power, stats[0]), pick(solar_power, stats[1])
+
 def handle_state_and_reads():
     """Effectue une lecture Modbus et met à jour l'état."""
     logging.debug("Vérification de l'état Modbus...")
@@ -371,10 +1586,10 @@ def handle_state_and_reads():
         mqtt_controller.publish("evt", {"code": 4, "msg": MQTT_EVT_CODE[4]})
     state.last_modbus_read_time = time.time()
     if read_value == BUGGY_LIMIT_PERMILLE:
-        logging.warning(f"Valeur lue de {BUGGY_LIMIT_PERMILLE/10.0:.1f}% détectée, correction à {MAX_POWER_LIMIT_PERMILLE/10.0:.1f}%.")
+        logging.warning(f"Valeur lue de {BUGGY_LIMIT_PERMILLE/10.0:.1f}% détectée, correction à {config.max_power_limit_permille/10.0:.1f}%.")
         mqtt_controller.publish("evt", {"code": 5, "msg": f"{MQTT_EVT_CODE[5]}. Passage forcé à 100.0%"})
-        perform_write(MAX_POWER_LIMIT_PERMILLE)
-        read_value = MAX_POWER_LIMIT_PERMILLE
+        perform_write(config.max_power_limit_permille)
+        read_value = config.max_power_limit_permille
         
     return_code = ReturnCode.OK
     if state.current_power_limit_permille != -1 and read_value != state.current_power_limit_permille:
@@ -385,85 +1600,297 @@ def handle_state_and_reads():
     state.current_power_limit_permille = read_value
     return return_code, read_value
 
-def calculate_new_limit(injection_power, solar_power):
-    """Calcule la nouvelle limite de puissance en appliquant les différents algorithmes."""
-    last_limit = state.current_power_limit_permille
-    if last_limit == -1: return -1, 0, "État inconnu", -1
+# --- Coeur de régulation, sans effet de bord ---
+# controller_step() ne lit ni l'état global ni les constantes du module, et ne publie rien : il peut être exécuté
+# pour de nombreuses instances indépendantes (simulations, réglages, voir regulator_batch.py).
+ControllerParams = namedtuple("ControllerParams", (
+    "min_limit", "max_limit", "buggy_limit", "thresholds", "import_count_for_reset",
+    "fast_drop_enable", "fast_drop_thresholds", "fast_rise_enable", "fast_rise_thresholds", "fast_cooldown_nb", "rated_power"))
+# limit : power_limit actuel (-1 si inconnu). Les compteurs sont ceux de RegulationState.
+ControllerState = namedtuple("ControllerState", ("limit", "import_count", "high_injection_count", "deep_import_count", "fast_cooldown"))
+Decision = namedtuple("Decision", ("limit", "increment", "threshold_info", "interval"))
+# évènements : (nom, ancienne limite, nouvelle limite). Noms : "FAST_RISE", "FAST_DROP", "IMPORT_RESET"
+ControllerEvent = namedtuple("ControllerEvent", ("name", "old_limit", "new_limit"))
+
+def controller_step(params, cstate, injection_power, solar_power):
+    """Une étape de régulation : (paramètres, état, mesure) -> (nouvel état, décision, évènements)."""
+    last_limit = cstate.limit
+    if last_limit == -1: return cstate, Decision(-1, 0, "État inconnu", -1), ()
+    import_count, high_count, deep_count, cooldown = cstate.import_count, cstate.high_injection_count, cstate.deep_import_count, cstate.fast_cooldown
 
     # Gestion du cooldown
-    if state.fast_cooldown > 0: state.fast_cooldown -=1
+    if cooldown > 0: cooldown -= 1
 
     # --- ALGO 1: FAST RISE ---
-    if FAST_RISE_ALGORITHM_ENABLE:
-        rise_thresh, rise_count, rise_limit, drop_next_delay = FAST_RISE_THRESHOLDS
-        if injection_power < rise_thresh:
-            state.consecutive_deep_import_count += 1
-        else:
-            state.consecutive_deep_import_count = 0
-
-        if state.consecutive_deep_import_count >= rise_count and state.fast_cooldown == 0:
-            if last_limit < rise_limit:
-                logging.info(f"FAST RISE: Importation forte détectée : {injection_power} (solaire {solar_power}). Ajustement de {last_limit/10.0:.1f}% à {rise_limit/10.0:.1f}%.")
-                state.fast_cooldown = FAST_COOLDOWN_NB
-                state.consecutive_deep_import_count = 0
-                mqtt_controller.publish("evt", {"code": 8, "msg": f"{MQTT_EVT_CODE[8]}. De {last_limit/10.0:.1f}% à {rise_limit/10.0:.1f}%. Solar={solar_power}W, Injection={injection_power}W"})
-                return rise_limit, rise_limit - last_limit, "Importation très forte", drop_next_delay
+    if params.fast_rise_enable:
+        rise_thresh, rise_count, rise_limit, rise_next_delay = params.fast_rise_thresholds
+        deep_count = deep_count + 1 if injection_power < rise_thresh else 0
+        if deep_count >= rise_count and cooldown == 0 and last_limit < rise_limit:
+            new_state = ControllerState(rise_limit, import_count, high_count, 0, params.fast_cooldown_nb)
+            return new_state, Decision(rise_limit, rise_limit - last_limit, "Importation très forte", rise_next_delay), (ControllerEvent("FAST_RISE", last_limit, rise_limit),)
 
     # --- ALGO 2: FAST DROP ---
-    if FAST_DROP_ALGORITHM_ENABLE:
-        drop_thresh, drop_count, drop_limit_thresh, drop_next_delay = FAST_DROP_THRESHOLDS
-        if injection_power > drop_thresh:
-            state.consecutive_high_injection_count += 1
-        else:
-            state.consecutive_high_injection_count = 0
-
-        if (state.consecutive_high_injection_count >= drop_count and last_limit > drop_limit_thresh and solar_power > 0 and state.fast_cooldown == 0):
-            estimated_limit = int(((solar_power - injection_power) / TOTAL_RATED_SOLAR_POWER) * 1000)
+    if params.fast_drop_enable:
+        drop_thresh, drop_count, drop_limit_thresh, drop_next_delay = params.fast_drop_thresholds
+        high_count = high_count + 1 if injection_power > drop_thresh else 0
+        if high_count >= drop_count and last_limit > drop_limit_thresh and solar_power > 0 and cooldown == 0:
+            estimated_limit = int(((solar_power - injection_power) / params.rated_power) * 1000)
             if estimated_limit < last_limit:
-                logging.info(f"FAST DROP: Injection haute détectée : {injection_power} (solaire {solar_power}). Ajustement de {last_limit/10.0:.1f}% à {estimated_limit/10.0:.1f}%.")
-                new_limit = estimated_limit
-                state.fast_cooldown = FAST_COOLDOWN_NB
-                state.consecutive_high_injection_count = 0
-                mqtt_controller.publish("evt", {"code": 7, "msg": f"{MQTT_EVT_CODE[7]}. De {last_limit/10.0:.1f}% à {new_limit/10.0:.1f}%. Solar={solar_power}W, Injection={injection_power}W"})
-                return new_limit, new_limit - last_limit, "Injection haute", drop_next_delay
+                new_state = ControllerState(estimated_limit, import_count, 0, deep_count, params.fast_cooldown_nb)
+                return new_state, Decision(estimated_limit, estimated_limit - last_limit, "Injection haute", drop_next_delay), (ControllerEvent("FAST_DROP", last_limit, estimated_limit),)
 
     # --- ALGO 3: IMPORT LOCK ---
     if injection_power < 0:
-        state.consecutive_import_count += 1
-        if state.consecutive_import_count >= CONSECUTIVE_IMPORT_COUNT_FOR_RESET:
-            if last_limit < MAX_POWER_LIMIT_PERMILLE:
-                logging.info(f"Importation continue détectée. Passage à 100%.")
-            state.consecutive_import_count = 0
-            return MAX_POWER_LIMIT_PERMILLE, MAX_POWER_LIMIT_PERMILLE - last_limit, "Importation continue", -1
+        import_count += 1
+        if import_count >= params.import_count_for_reset:
+            events = (ControllerEvent("IMPORT_RESET", last_limit, params.max_limit),) if last_limit < params.max_limit else ()
+            new_state = ControllerState(params.max_limit, 0, high_count, deep_count, cooldown)
+            return new_state, Decision(params.max_limit, params.max_limit - last_limit, "Importation continue", -1), events
     else:
-        state.consecutive_import_count = 0
+        import_count = 0
 
     # --- ALGO 4: Logique principale par seuils ---
-    for i, (threshold, increment, interval) in enumerate(INJECTION_POWER_THRESHOLDS):
+    decision = Decision(last_limit, 0, "Hors plage", -1)
+    for threshold, increment, interval, threshold_info in params.thresholds:
         if injection_power >= threshold:
-            lower_bound_str, upper_bound_str = f"{threshold}W", f"<{INJECTION_POWER_THRESHOLDS[i-1][0]}W" if i > 0 else ""
-            threshold_info = f"{lower_bound_str}..{upper_bound_str}" if upper_bound_str else f">{lower_bound_str}"
-
-            if increment == 0: return last_limit, 0, threshold_info, interval
-
-            new_limit = last_limit + increment
-            new_limit = max(MIN_POWER_LIMIT_PERMILLE, min(new_limit, MAX_POWER_LIMIT_PERMILLE))
-
-            if last_limit == MAX_POWER_LIMIT_PERMILLE and new_limit == MAX_POWER_LIMIT_PERMILLE: interval = -1
-            if round(new_limit) == BUGGY_LIMIT_PERMILLE: new_limit += 5 if increment > 0 else -5
+            if increment == 0:
+                decision = Decision(last_limit, 0, threshold_info, interval)
+                break
+            new_limit = max(params.min_limit, min(last_limit + increment, params.max_limit))
+            if last_limit == params.max_limit and new_limit == params.max_limit: interval = -1
+            if round(new_limit) == params.buggy_limit: new_limit += 5 if increment > 0 else -5
+            decision = Decision(new_limit, new_limit - last_limit, threshold_info, interval)
+            break
+    return ControllerState(decision.limit, import_count, high_count, deep_count, cooldown), decision, ()
+
+def written_limit(params, limit):
+    """Valeur réellement écrite dans l'ECU pour une limite demandée (jamais la valeur buggée, jamais sous le minimum)."""
+    if limit == params.buggy_limit: limit += 1
+    return max(limit, params.min_limit)
+
+class PlantModel:
+    """Modèle de l'installation pour les simulations : après une écriture, la limite n'agit qu'au bout de dead_time_s secondes,
+    puis la production tend vers min(production disponible, limite) avec un premier ordre de constante time_constant_s."""
+    def __init__(self, rated_power, limit, production=0.0, dead_time_s=PLANT_DEAD_TIME_S, time_constant_s=PLANT_TIME_CONSTANT_S):
+        self.rated_power, self.dead_time_s, self.time_constant_s = rated_power, dead_time_s, time_constant_s
+        self.limit, self.production = limit, production
+        self.pending = deque()        # (instant d'effet, limite) des écritures pas encore effectives
+        self.t = None
+
+    def write(self, t, limit):
+        self.pending.append((t + self.dead_time_s, limit))
+
+    def step(self, t, available_w):
+        """Avance le modèle jusqu'à l'instant t. Retourne la production, en W."""
+        while self.pending and self.pending[0][0] <= t:
+            self.limit = self.pending.popleft()[1]
+        target = max(0.0, min(available_w, self.limit * self.rated_power / 1000))
+        dt = 0.0 if self.t is None else t - self.t
+        self.t = t
+        self.production += (target - self.production) * (1 - math.exp(-dt / self.time_constant_s))
+        return self.production
+
+class ShadowController:
+    """Une configuration de la régulation exécutée en mode shadow : coeur de régulation, anticipation si la configuration l'active,
+    et modèle de l'installation. N'a accès ni à l'état global du démon, ni à Modbus : ses décisions ne peuvent pas être écrites."""
+    def __init__(self, name, config):
+        self.name, self.config = name, config
+        self.cstate = ControllerState(-1, 0, 0, 0, 0)
+        self.plant = None
+        self.predictor = TrendPredictor()
+        self.last_write = float("-inf")
+        self.previous = None          # (instant, injection simulée) de la mesure précédente
+        self.history = deque(maxlen=SHADOW_HISTORY_SIZE)
+        self.counters = {"samples": 0, "writes": 0, "injected_wh": 0.0, "imported_wh": 0.0, "FAST_RISE": 0, "FAST_DROP": 0, "IMPORT_RESET": 0}
+
+    def step(self, now, house_power, available_w, live_limit):
+        """Une mesure du Shelly : simule la production et l'injection de cette configuration, puis sa décision. Temps constant."""
+        rated = self.config.total_rated_solar_power
+        if self.plant is None:
+            # démarrage à la limite active : les configurations divergent ensuite
+            self.cstate = self.cstate._replace(limit=live_limit)
+            self.plant = PlantModel(rated, live_limit, production=min(available_w, live_limit * rated / 1000))
+        production = self.plant.step(now, available_w)
+        injection = production - house_power
+        if self.previous is not None and now - self.previous[0] <= ENERGY_MAX_GAP_S:
+            positive, negative = _split_trapezoid(self.previous[1], injection, now - self.previous[0])
+            self.counters["injected_wh"] += positive; self.counters["imported_wh"] += negative
+        self.previous = (now, injection)
+        self.counters["samples"] += 1
+
+        solar, injection = round(production), round(injection)
+        step_solar, step_injection = solar, injection
+        if self.config.feedforward_enable:
+            unconstrained = solar < HEADROOM_UNCONSTRAINED_RATIO * self.cstate.limit * rated / 1000
+            self.predictor.observe(solar, solar - injection, now - self.last_write > ACTUATION_DEFAULT_SETTLE_S and unconstrained, now=now)
+            step_solar, step_injection = self.predictor.predict(solar, injection, ACTUATION_DEFAULT_SETTLE_S * FEEDFORWARD_HORIZON_RATIO,
+                                                                self.cstate.limit * rated / 1000, now=now)
+        old_limit = self.cstate.limit
+        self.cstate, decision, events = controller_step(self.config.controller_params, self.cstate, step_injection, step_solar)
+        for event in events:
+            self.counters[event.name] += 1
+        if decision.limit != old_limit:
+            self.cstate = self.cstate._replace(limit=written_limit(self.config.controller_params, decision.limit))
+            self.plant.write(now, self.cstate.limit)
+            self.last_write = now
+            self.counters["writes"] += 1
+            self.history.append((datetime.fromtimestamp(now).strftime("%H:%M:%S"), old_limit / 10.0, self.cstate.limit / 10.0))
+        return self.cstate.limit
+
+    def summary(self):
+        return {**{k: round(v, 1) if isinstance(v, float) else v for k, v in self.counters.items()},
+                "source": self.config.source, "power_limit": self.cstate.limit / 10.0 if self.cstate.limit >= 0 else None,
+                "history": list(self.history)}
+
+class ShadowEvaluator:
+    """Mode shadow : la configuration active et les candidates (SHADOW_CONFIG_FILES) reçoivent chaque mesure du Shelly.
+
+    La production disponible, commune à toutes, est estimée à partir de la mesure réelle : la production elle-même quand elle n'est pas
+    bridée, sinon la dernière production non bridée (au moins la production mesurée). Le coût par mesure est constant pour chaque
+    configuration (un pas de régulation, un pas du modèle, un historique borné).
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.paths = []
+        self.controllers = []
+        self.last_available = None
+        self.since = None
+
+    def configure(self, active_config, paths):
+        """(Re)construit les configurations évaluées, et remet les compteurs à zéro.
+        Lève OSError ou ValueError si un fichier est invalide : les configurations précédentes sont alors conservées."""
+        candidates = [ShadowController(os.path.splitext(os.path.basename(path))[0], RegulationConfig.from_file(path, base=active_config))
+                      for path in paths]
+        with self.lock:
+            self.paths = list(paths)
+            self.controllers = [ShadowController("active", active_config)] + candidates if candidates else []
+            self.last_available, self.since = None, time.time()
 
-            return new_limit, new_limit - last_limit, threshold_info, interval
+    def observe(self, injection_power, solar_power, live_limit, rated_power, now=None):
+        """Nouvelle mesure du Shelly (dans une tranche de régulation, limite active connue)."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if not self.controllers or solar_power < 0 or live_limit < 0: return
+            if solar_power < HEADROOM_UNCONSTRAINED_RATIO * live_limit * rated_power / 1000:
+                self.last_available = solar_power
+            available = max(solar_power, self.last_available or 0)
+            house = solar_power - injection_power
+            for controller in self.controllers:
+                controller.step(now, house, available, live_limit)
+
+    def summary(self):
+        with self.lock:
+            if not self.controllers: return None
+            return {"since": datetime.fromtimestamp(self.since).isoformat(timespec="seconds"),
+                    "configs": {c.name: c.summary() for c in self.controllers}}
 
-    return last_limit, 0, "Hors plage", -1
+def calculate_new_limit(injection_power, solar_power):
+    """Calcule la nouvelle limite de puissance en appliquant les différents algorithmes.
+    Adaptateur entre l'état global du démon et controller_step() : met à jour les compteurs, journalise et publie les évènements.
+    La limite elle-même n'est mémorisée qu'après une écriture Modbus réussie (perform_write)."""
+    cstate = ControllerState(state.current_power_limit_permille, state.consecutive_import_count,
+                             state.consecutive_high_injection_count, state.consecutive_deep_import_count, state.fast_cooldown)
+    step_injection, step_solar = injection_power, solar_power
+    if config.feedforward_enable and solar_power >= 0 and cstate.limit >= 0:
+        # anticipation : la régulation reçoit les mesures prévues au moment où la nouvelle limite aura pris effet
+        horizon = actuation_tracker.predicted_settle_s(ACTUATION_DEFAULT_SETTLE_S) * FEEDFORWARD_HORIZON_RATIO
+        step_solar, step_injection = trend_predictor.predict(solar_power, injection_power, horizon,
+                                                             cstate.limit * config.total_rated_solar_power / 1000)
+        if step_injection != injection_power:
+            logging.debug(f"Anticipation à {horizon:.0f}s : injection prévue {step_injection:.0f}W, production prévue {step_solar}W.")
+    new_cstate, decision, events = controller_step(config.controller_params, cstate, step_injection, step_solar)
+    _, state.consecutive_import_count, state.consecutive_high_injection_count, state.consecutive_deep_import_count, state.fast_cooldown = new_cstate
+
+    for event in events:
+        old_str, new_str = f"{event.old_limit/10.0:.1f}%", f"{event.new_limit/10.0:.1f}%"
+        if event.name == "FAST_RISE":
+            logging.info(f"FAST RISE: Importation forte détectée : {injection_power} (solaire {solar_power}). Ajustement de {old_str} à {new_str}.")
+            mqtt_controller.publish("evt", {"code": 8, "msg": f"{MQTT_EVT_CODE[8]}. De {old_str} à {new_str}. Solar={solar_power}W, Injection={injection_power}W"})
+        elif event.name == "FAST_DROP":
+            logging.info(f"FAST DROP: Injection haute détectée : {injection_power} (solaire {solar_power}). Ajustement de {old_str} à {new_str}.")
+            mqtt_controller.publish("evt", {"code": 7, "msg": f"{MQTT_EVT_CODE[7]}. De {old_str} à {new_str}. Solar={solar_power}W, Injection={injection_power}W"})
+        elif event.name == "IMPORT_RESET":
+            logging.info(f"Importation continue détectée. Passage à 100%.")
+    return decision
+
+def advance_controller(injection_power, solar_power):
+    """Mesure intermédiaire d'un lot : fait avancer les compteurs de la régulation (mesures consécutives en importation, en injection
+    haute...), sans décision. Si la mesure déclencherait un algorithme FAST ou le retour à 100%, les compteurs ne sont pas modifiés :
+    seule la dernière mesure du lot peut écrire, et elle décide sur les compteurs accumulés."""
+    cstate = ControllerState(state.current_power_limit_permille, state.consecutive_import_count,
+                             state.consecutive_high_injection_count, state.consecutive_deep_import_count, state.fast_cooldown)
+    new_cstate, _, events = controller_step(config.controller_params, cstate, injection_power, solar_power)
+    if events: return
+    _, state.consecutive_import_count, state.consecutive_high_injection_count, state.consecutive_deep_import_count, state.fast_cooldown = new_cstate
+
+def clamp_to_headroom(decision):
+    """Ramène la décision de la régulation dans la plage utile, sous le plafond de production disponible (voir HeadroomEstimator).
+    Hors du coeur de régulation : le plafond dépend de l'historique des mesures, pas seulement de l'état de controller_step().
+    Une hausse au-delà du plafond est ramenée au plafond, et n'est pas écrite si la limite y est déjà ; une baisse qui resterait
+    au-dessus du plafond est appliquée à partir du plafond."""
+    current = state.current_power_limit_permille
+    if not config.headroom_clamp_enable or decision.increment == 0 or current < 0: return decision
+    useful = headroom_estimator.useful_limit(config.total_rated_solar_power)
+    if useful is None: return decision
+    useful = max(config.min_power_limit_permille, min(useful, config.max_power_limit_permille))
+    if decision.limit <= useful: return decision
+    if decision.increment > 0:
+        limit = max(useful, current)
+        headroom_estimator.count("skipped_writes" if limit == current else "clamped_rises")
+    else:
+        limit = max(config.min_power_limit_permille, useful + decision.increment)
+        headroom_estimator.count("accelerated_drops")
+    logging.debug(f"Plafond de production {useful/10.0:.1f}% : limite {decision.limit/10.0:.1f}% ramenée à {limit/10.0:.1f}%.")
+    return decision._replace(limit=limit, increment=limit - current, threshold_info=f"{decision.threshold_info}, plafond {useful/10.0:.1f}%")
+
+def adaptive_interval(decision, injection_power):
+    """Délai demandé au Shelly avant sa prochaine mesure (sensor_read_interval).
+    Pendant un changement de consigne, c'est le délai des tables de seuils ; dans la plage recherchée, il est court si l'injection
+    varie ou si la production n'est pas encore établie après la dernière écriture, et s'allonge progressivement si tout est stable."""
+    previous, state.last_injection_power = state.last_injection_power, injection_power
+    if not config.adaptive_interval_enable:
+        return decision.interval
+    if decision.increment != 0:
+        state.stable_count = 0
+        return decision.interval
+    if previous is not None and abs(injection_power - previous) >= ADAPTIVE_INTERVAL_VOLATILITY_W:
+        state.stable_count = 0
+        return ADAPTIVE_INTERVAL_MIN_S
+    settle_remaining = state.last_write_time + actuation_tracker.predicted_settle_s(ACTUATION_DEFAULT_SETTLE_S) - time.time()
+    if settle_remaining > 0:
+        state.stable_count = 0
+        return int(min(max(settle_remaining, ADAPTIVE_INTERVAL_MIN_S), SHELLY_DEFAULT_INTERVAL_S) + 0.5)
+    interval = SHELLY_DEFAULT_INTERVAL_S * ADAPTIVE_INTERVAL_BACKOFF ** (state.stable_count + 1)
+    # une fois le délai maximum atteint, le compteur n'augmente plus : la puissance déborderait (OverflowError) après une longue stabilité
+    if interval < config.adaptive_interval_max_s:
+        state.stable_count += 1
+    return int(min(interval, config.adaptive_interval_max_s))
+
+def out_of_window_interval():
+    """Délai demandé au Shelly hors des tranches de régulation : jusqu'au début de la prochaine tranche."""
+    seconds = state.seconds_to_next_window()
+    if not config.adaptive_interval_enable or seconds is None:
+        return config.periodic_task_interval_s
+    return max(1, min(int(seconds) + 1, OUT_OF_WINDOW_MAX_INTERVAL_S))
+
+def publish_actuation(measure):
+    """Journalise une mesure de latence d'actionnement terminée, et la publie avec les percentiles glissants."""
+    if not measure: return
+    onset, settle = (f"{measure[k]}s" if measure[k] is not None else "-" for k in ("onset_s", "settle_s"))
+    logging.debug(f"Actionnement {measure['from']:.1f}% -> {measure['to']:.1f}% : {measure['outcome']}, début de réaction {onset}, établi {settle}.")
+    if config.mqtt_enable == 1:
+        mqtt_controller.publish("actuation", {**measure, "stats": actuation_tracker.summary()})
 
 def perform_write(limit_to_write):
     """Wrapper pour l'écriture Modbus."""
-    if limit_to_write == BUGGY_LIMIT_PERMILLE: limit_to_write +=1
-    if limit_to_write < MIN_POWER_LIMIT_PERMILLE: limit_to_write = MIN_POWER_LIMIT_PERMILLE
+    limit_to_write = written_limit(config.controller_params, limit_to_write)
     status = modbus_controller.write_power_limit(limit_to_write)
     if status == "OK":
         if state.consecutive_modbus_write_errors > 0:
             mqtt_controller.publish("evt", {"code": 4, "msg": MQTT_EVT_CODE[4]})
+        if limit_to_write != state.current_power_limit_permille:
+            state.last_write_time = time.time()
+            publish_actuation(actuation_tracker.record_write(state.current_power_limit_permille, limit_to_write, config.total_rated_solar_power))
         state.current_power_limit_permille = limit_to_write
         state.consecutive_modbus_write_errors = 0
     else:
@@ -511,8 +1938,9 @@ def parse_arguments():
     """Analyse les arguments de la ligne de commande."""
     parser = argparse.ArgumentParser(description="Démon de régulation d'injection solaire.", formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('ecu_ip', type=str, nargs='?', default=None, help=f"Adresse IP de l'ECU-R (défaut: {MODBUS_ECU_IP}).")
-    parser.add_argument('--modbus-port', type=int, default=MODBUS_ECU_PORT)
-    parser.add_argument('--modbus-slave', type=int, default=MODBUS_SLAVE_ID)
+    parser.add_argument('--modbus-port', type=int, default=None, help=f"Port Modbus de l'ECU-R (défaut: celui de l'inventaire, sinon {MODBUS_ECU_PORT}).")
+    parser.add_argument('--modbus-slave', type=int, default=None, help=f"ID Modbus du MO adressé (défaut: le premier MO de l'inventaire, sinon {MODBUS_SLAVE_ID}).")
+    parser.add_argument('--inventory', type=str, help="Inventaire des MO produit par modbus_tools/discover_MO.py : donne l'ECU et l'ID Modbus par défaut.")
     parser.add_argument('--http-host', type=str, default='0.0.0.0')
     parser.add_argument('--http-port', type=int, default=8000)
     parser.add_argument('-nd', '--no-daemon', action='store_true', help="Mode console (ne pas se détacher du terminal).")
@@ -520,17 +1948,16 @@ def parse_arguments():
     log_group = parser.add_mutually_exclusive_group()
     log_group.add_argument('-lf', '--logfile', type=str, help="Écrire les logs dans un fichier.")
     log_group.add_argument('-sf', '--syslog-facility', type=str, choices=[f'local{i}' for i in range(8)], help="Activer le logging vers syslog.")
+    parser.add_argument('--state-file', type=str, default=STATE_JOURNAL_FILE, help=f"Journal d'état pour le redémarrage à chaud (défaut: {STATE_JOURNAL_FILE}). Chaîne vide pour désactiver.")
+    parser.add_argument('--energy-file', type=str, default=ENERGY_JOURNAL_FILE, help=f"Fichier de sauvegarde des compteurs d'énergie (défaut: {ENERGY_JOURNAL_FILE}). Chaîne vide pour désactiver.")
+    parser.add_argument('-c', '--config', type=str, default=CONFIG_FILE, help="Fichier JSON de configuration, rechargeable à chaud (SIGHUP ou POST /reload).")
+    parser.add_argument('--shadow', type=str, action='append', help="Configuration candidate évaluée en mode shadow (fichier JSON au format de --config). Répétable.")
+    parser.add_argument('--startup-profile', action='store_true', help="Ecrit dans la log le détail des durées d'import et d'initialisation au démarrage.")
     return parser.parse_args()
 
-def periodic_task_thread():
-    """Tâche de fond pour les actions non déclenchées par HTTP."""
-    handle_periodic_tasks()
-    while True:
-        time.sleep(PERIODIC_TASK_INTERVAL_S)
-        handle_periodic_tasks()
-
-def handle_periodic_tasks():
-    """Logique exécutée périodiquement par le thread de fond."""
+# --- Tâches de fond, exécutées par l'ordonnanceur. Chacune retourne l'instant de sa prochaine exécution (voir Scheduler) ---
+def window_job():
+    """Changement de tranche horaire, exécuté juste après chaque début ou fin de tranche."""
     with state_lock:
         is_currently_in_window = state.is_in_regulation_window()
         if is_currently_in_window != state.was_in_regulation_window:
@@ -538,56 +1965,219 @@ def handle_periodic_tasks():
             evt_code = 1 if is_currently_in_window else 2
             logging.info(f"Changement de tranche horaire. {in_out_str} régulation. Passage à 100%.")
             mqtt_controller.publish("evt", {"code": evt_code, "msg": MQTT_EVT_CODE[evt_code]})
-            perform_write(MAX_POWER_LIMIT_PERMILLE)
+            perform_write(config.max_power_limit_permille)
             # --- Déconnexion Modbus hors de la tranche ---
             if not is_currently_in_window and modbus_controller:
                 modbus_controller.disconnect()
             state.was_in_regulation_window = is_currently_in_window
+        return state.next_window_transition()
 
-        if is_currently_in_window and time.time() - state.last_modbus_read_time > PERIODIC_MODBUS_READ_INTERVAL_S:
-            return_code_tuple, power_limit = handle_state_and_reads()
-            if return_code_tuple in [ReturnCode.OK]:
-                logging.info(f"Lecture périodique du power_limit. Valeur lue : {power_limit/10.0:.1f}%")
-            else:
-                logging.info(f"Lecture périodique du power_limit échouée")
-
-
-def watchdog_thread():
-    """Surveille la communication avec le Shelly et réagit en cas de silence prolongé."""
-    while True:
-        with state_lock:
-            if not state.watchdog_triggered and state.is_in_regulation_window() and (time.time() - state.last_shelly_request_time > WATCHDOG_TIMEOUT_S):
-                logging.warning(f"WATCHDOG: Aucune requête du Shelly depuis {WATCHDOG_TIMEOUT_S}s. Production à 100%.")
-                if modbus_controller:
-                    perform_write(MAX_POWER_LIMIT_PERMILLE)
-                state.watchdog_triggered = True
-        time.sleep(60)
+def periodic_read_job():
+    """Lecture modbus de contrôle de power_limit, si aucune lecture n'a eu lieu depuis PERIODIC_MODBUS_READ_INTERVAL_S."""
+    with state_lock:
+        if not state.is_in_regulation_window():
+            return time.time() + state.seconds_to_next_window() + 0.001
+        due = state.last_modbus_read_time + config.periodic_modbus_read_interval_s
+        if time.time() < due:
+            return due    # une lecture a eu lieu entre temps
+        return_code_tuple, power_limit = handle_state_and_reads()
+        if return_code_tuple in [ReturnCode.OK]:
+            logging.info(f"Lecture périodique du power_limit. Valeur lue : {power_limit/10.0:.1f}%")
+        else:
+            logging.info(f"Lecture périodique du power_limit échouée")
+            return time.time() + config.periodic_task_interval_s
+        return state.last_modbus_read_time + config.periodic_modbus_read_interval_s
+
+def watchdog_job():
+    """Surveille la communication avec le Shelly : exécuté à l'instant exact où le silence dépasse WATCHDOG_TIMEOUT_S.
+    Hors des tranches horaires, il est réarmé au début de la prochaine tranche. Après déclenchement, il n'est reprogrammé
+    qu'au retour du Shelly (voir RequestHandler)."""
+    with state_lock:
+        if state.watchdog_triggered:
+            return None
+        now = time.time()
+        if not state.is_in_regulation_window():
+            return now + state.seconds_to_next_window() + config.watchdog_timeout_s
+        due = state.last_shelly_request_time + config.watchdog_timeout_s
+        if now < due:
+            return due    # le Shelly a envoyé une requête entre temps
+        logging.warning(f"WATCHDOG: Aucune requête du Shelly depuis {config.watchdog_timeout_s}s. Production à 100%.")
+        if modbus_controller:
+            perform_write(config.max_power_limit_permille)
+        state.watchdog_triggered = True
+        return None
+
+def state_journal_job():
+    """Sauvegarde périodique du journal d'état. L'instantané est pris sous state_lock, l'écriture disque se fait hors verrou."""
+    with state_lock:
+        snapshot = state.to_journal()
+    state_journal.save(snapshot)
+    return time.time() + STATE_JOURNAL_INTERVAL_S
+
+def energy_job():
+    """Sauvegarde des compteurs d'énergie, et publication MQTT des compteurs du jour."""
+    energy_journal.save(energy_accountant.to_journal())
+    if config.mqtt_enable == 1:
+        mqtt_controller.publish("energy", energy_accountant.today())
+    return time.time() + ENERGY_PUBLISH_INTERVAL_S
+
+def shadow_job():
+    """Publication MQTT des résultats du mode shadow."""
+    summary = shadow_evaluator.summary()
+    if summary and config.mqtt_enable == 1:
+        mqtt_controller.publish("shadow", {**summary, "configs": {name: {k: v for k, v in result.items() if k != "history"}
+                                                                  for name, result in summary["configs"].items()}})
+    return time.time() + SHADOW_PUBLISH_INTERVAL_S
+
+def verify_restored_state():
+    """Après une reprise du journal, vérifie en tâche de fond la valeur réelle de power_limit."""
+    with state_lock:
+        return_code_tuple, power_limit = handle_state_and_reads()
+    if return_code_tuple == ReturnCode.OK:
+        logging.info(f"Etat restauré confirmé par lecture Modbus. power_limit = {power_limit/10.0:.1f}%")
+    elif return_code_tuple == ReturnCode.DIFFERENT_POWER_LIMIT:
+        logging.info(f"Etat restauré corrigé par lecture Modbus. power_limit = {power_limit/10.0:.1f}%")
+    else:
+        logging.warning("Vérification Modbus de l'état restauré échouée. Nouvelle tentative à la prochaine lecture périodique.")
+
+def reload_config():
+    """Relit le fichier de configuration. La validation et la précompilation se font hors verrou ;
+    la nouvelle configuration est ensuite substituée d'un bloc, sans toucher à l'état de régulation.
+    Retourne (succès, message)."""
+    global config
+    if not config_file:
+        return False, "Pas de fichier de configuration (option --config)"
+    try:
+        new_config = RegulationConfig.from_file(config_file)
+    except (OSError, ValueError) as e:
+        logging.error(f"Rechargement de la configuration refusé, configuration actuelle conservée. {config_file}: {e}")
+        return False, f"Configuration invalide: {e}"
+    try:
+        # les candidates du mode shadow surchargent la configuration active : elles sont reconstruites, et leurs compteurs remis à zéro
+        shadow_evaluator.configure(new_config, shadow_evaluator.paths)
+    except (OSError, ValueError) as e:
+        logging.error(f"Configuration shadow invalide, mode shadow inchangé: {e}")
+    with state_lock:
+        old_config, config = config, new_config
+    changed = new_config.changed_parameters(old_config)
+    if any(name.startswith("MQTT_") for name in changed):
+        mqtt_controller.reset()
+    # les échéances dépendent des tranches horaires et des délais : elles sont recalculées par les tâches elles-mêmes
+    now = time.time()
+    for name, job in (("window", window_job), ("periodic_read", periodic_read_job), ("watchdog", watchdog_job)):
+        if name in scheduler.jobs:
+            scheduler.schedule(name, now, job)
+    message = f"Configuration rechargée. Paramètres modifiés: {', '.join(changed) if changed else 'aucun'}"
+    logging.info(message)
+    return True, message
+
+def warmup_thread(args):
+    """Initialisations différées, lancées une fois le port HTTP ouvert : imports lourds, connexions Modbus et MQTT."""
+    with startup_profiler.measure("connexion Modbus"):
+        modbus_controller.warmup()
+    if config.mqtt_enable != 0:
+        with startup_profiler.measure("connexion MQTT"):
+            mqtt_controller.warmup()
+    if state.restored_from_journal and state.current_power_limit_permille != -1:
+        with startup_profiler.measure("vérification de l'état restauré"):
+            verify_restored_state()
+    now = time.time()
+    scheduler.schedule("window", now, window_job)
+    scheduler.schedule("periodic_read", now, periodic_read_job)
+    if args.startup_profile:
+        startup_profiler.report()
 
 def main():
     """Point d'entrée principal."""
-    global modbus_controller
-    args = parse_arguments()
+    global modbus_controller, state_journal, energy_journal, config, config_file
+    startup_profiler.record("chargement du script", time.perf_counter() - _STARTUP_T0)
+    with startup_profiler.measure("analyse des arguments"):
+        args = parse_arguments()
+    # le mode démon change de répertoire courant : le chemin du journal est résolu avant
+    state_file = os.path.abspath(args.state_file) if args.state_file else ""
+    energy_file = os.path.abspath(args.energy_file) if args.energy_file else ""
+    config_file = os.path.abspath(args.config) if args.config else ""
+    shadow_files = [os.path.abspath(path) for path in (args.shadow or SHADOW_CONFIG_FILES)]
+    if args.inventory: args.inventory = os.path.abspath(args.inventory)
     if not args.no_daemon: daemonize()
-    setup_logging(args)
-    ecu_ip = args.ecu_ip if args.ecu_ip else MODBUS_ECU_IP
-    modbus_controller = ModbusController(ecu_ip, args.modbus_port, args.modbus_slave)
-
-    Thread(target=watchdog_thread, daemon=True).start()
-    Thread(target=periodic_task_thread, daemon=True).start()
-
+    with startup_profiler.measure("configuration des logs"):
+        setup_logging(args)
+    if config_file:
+        try:
+            with startup_profiler.measure("lecture de la configuration"):
+                new_config = RegulationConfig.from_file(config_file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Fichier de configuration {config_file} invalide: {e}")
+            sys.exit(1)
+        with state_lock:
+            config = new_config
+            state.was_in_regulation_window = state.is_in_regulation_window()
+        logging.info(f"Configuration lue depuis {config_file}")
+    if shadow_files:
+        try:
+            shadow_evaluator.configure(config, shadow_files)
+        except (OSError, ValueError) as e:
+            logging.error(f"Configuration shadow invalide: {e}")
+            sys.exit(1)
+        logging.info(f"Mode shadow : {len(shadow_files)} configuration(s) candidate(s) évaluée(s), {', '.join(shadow_files)}")
+    inventory = {}
+    if args.inventory:
+        try:
+            inventory = load_inventory(args.inventory)
+        except (OSError, ValueError) as e:
+            logging.error(f"Inventaire des MO {args.inventory} invalide: {e}")
+            sys.exit(1)
+    units = sorted(int(unit) for unit in inventory.get("units", {}))
+    ecu_ip = args.ecu_ip or inventory.get("host") or MODBUS_ECU_IP
+    modbus_port = args.modbus_port or inventory.get("port") or MODBUS_ECU_PORT
+    modbus_slave = args.modbus_slave if args.modbus_slave is not None else (units[0] if units else MODBUS_SLAVE_ID)
+    if units:
+        logging.info(f"Inventaire {args.inventory} : {len(units)} MO, ID Modbus {', '.join(str(unit) for unit in units)}. MO adressé : {modbus_slave}")
+        if modbus_slave not in units:
+            logging.warning(f"Le MO {modbus_slave} n'est pas dans l'inventaire {args.inventory}")
+    modbus_controller = ModbusController(ecu_ip, modbus_port, modbus_slave)
+
+    with startup_profiler.measure("lecture du journal d'état"):
+        state_journal = StateJournal(state_file)
+        snapshot = state_journal.load()
+    if snapshot:
+        with state_lock:
+            state.restore_journal(snapshot)
+        logging.info(f"Etat restauré depuis le journal {state_file}. power_limit = {state.current_power_limit_permille/10.0:.1f}%")
+    energy_journal = StateJournal(energy_file, max_age_s=None)
+    energy_snapshot = energy_journal.load()
+    if energy_snapshot:
+        energy_accountant.restore_journal(energy_snapshot)
+        logging.info(f"Compteurs d'énergie restaurés depuis {energy_file}")
+
+    # Le port HTTP est ouvert en premier : le noyau accepte les connexions du Shelly pendant la fin de l'initialisation
     server_address = (args.http_host, args.http_port)
     try:
-        httpd = ThreadingHTTPServer(server_address, RequestHandler)
+        with startup_profiler.measure("ouverture du port HTTP"):
+            httpd = PooledHTTPServer(server_address, RequestHandler)
     except OSError as e:
         logging.error(f"Impossible de démarrer le serveur HTTP sur {args.http_host}:{args.http_port}. Erreur: {e}")
         sys.exit(1)
 
+    Thread(target=scheduler.run, daemon=True).start()
+    Thread(target=warmup_thread, args=(args,), daemon=True).start()
+    scheduler.schedule("watchdog", time.time(), watchdog_job)
+    if state_file:
+        scheduler.schedule("state_journal", time.time() + STATE_JOURNAL_INTERVAL_S, state_journal_job)
+    scheduler.schedule("energy", time.time() + ENERGY_PUBLISH_INTERVAL_S, energy_job)
+    if shadow_files:
+        scheduler.schedule("shadow", time.time() + SHADOW_PUBLISH_INTERVAL_S, shadow_job)
+
     def shutdown_handler(signum, frame):
         logging.info("Signal d'arrêt reçu... Passage de power_limit à 100% avant arrêt")
         perform_write(1000)
+        state_journal.save(state.to_journal())
+        energy_journal.save(energy_accountant.to_journal())
         Thread(target=httpd.shutdown).start()
         
     signal.signal(signal.SIGTERM, shutdown_handler); signal.signal(signal.SIGINT, shutdown_handler)
+    # le rechargement se fait dans un thread : il prend state_lock, qui peut être détenu par le thread interrompu
+    signal.signal(signal.SIGHUP, lambda signum, frame: Thread(target=reload_config, daemon=True).start())
 
     logging.info(f"Démon démarré sur http://{args.http_host}:{args.http_port}")
     try: httpd.serve_forever()
@@ -598,10 +2188,22 @@ def main():
     logging.info("Démon arrêté.")
 
 # --- Fonctions de service ---
+config = RegulationConfig()
+config_file = CONFIG_FILE
 state = RegulationState()
 state_lock = RLock()
 modbus_controller = None
+state_journal = StateJournal("")
 mqtt_controller = MQTTController()
+startup_profiler = StartupProfiler()
+actuation_tracker = ActuationTracker()
+energy_accountant = EnergyAccountant()
+headroom_estimator = HeadroomEstimator()
+trend_predictor = TrendPredictor()
+shadow_evaluator = ShadowEvaluator()
+sample_sequencer = SampleSequencer()
+energy_journal = StateJournal("", max_age_s=None)
+scheduler = Scheduler()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
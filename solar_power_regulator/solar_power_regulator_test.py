@@ -12,7 +12,7 @@ THRESHOLD_LOW = -10  # Seuil bas d'injection (valeur négative, ex: -10W)
 
 def main():
     parser = argparse.ArgumentParser(description="Script de test pour le démon de régulation de puissance solaire.")
-    parser.add_argument('daemon_ip', type=str, default="127.0.0.1", help="Adresse IP du démon (défaut 127.0.0.1")
+    parser.add_argument('daemon_ip', type=str, nargs='?', default="127.0.0.1", help="Adresse IP du démon (défaut 127.0.0.1")
     parser.add_argument("-p", "--daemon_port", type=int, default=8000, help="Port TCP du démon (défaut: 8000)")
     parser.add_argument("-ip", "--injection_power", type=int, required=True, help="Injection simulée du réseau en W (ex: +700 pour injection, -100 pour importation)")
     parser.add_argument("-sp", "--solar_power", type=int, default=-1, help="Production solaire simulée en W")
@@ -22,8 +22,8 @@ def main():
     daemon_url = f"http://{args.daemon_ip}:{args.daemon_port}/regulate"
     
     payload = {
-        "injection-power": arg.injection_power,
-        "solar-power": arg.solar_power,
+        "injection_power": args.injection_power,
+        "solar_power": args.solar_power,
     }
 
     print(f"Tentative d'envoi d'une requête POST à {daemon_url} avec les données: {json.dumps(payload, indent=2)}")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+http_keepalive_speedtest.py
+
+Mesure du temps d'une requête HTTP au démon de régulation, avec et sans connexion persistante (HTTP/1.1 keep-alive, voir HTTP_*
+dans solar_power_regulator.py). Les requêtes sont envoyées l'une après l'autre, comme le fait le Shelly.
+
+Sans URL, trois serveurs sont démarrés dans ce processus, sur l'interface locale, avec le RequestHandler du démon (GET /stats) :
+  . "1 thread/connexion" : le serveur du démon avant le keep-alive : HTTP/1.0, un thread créé par connexion
+  . "pool, HTTP/1.0"     : le serveur actuel (PooledHTTPServer), une connexion par requête : gain de la réutilisation des threads
+  . "pool, keep-alive"   : le serveur actuel, une seule connexion pour toutes les requêtes
+Avec une URL (un démon en fonctionnement, par exemple depuis une machine sur le réseau du Shelly), seul le client varie : une
+connexion par requête, ou une connexion persistante. Le gain comprend alors l'ouverture de la connexion TCP sur le réseau réel.
+
+syntaxe :
+  http_keepalive_speedtest.py : comparaison des trois serveurs en local, 500 requêtes
+  http_keepalive_speedtest.py -n 200 http://192.168.1.147:8000/stats : sur le démon en fonctionnement
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import time
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from solar_power_regulator import PooledHTTPServer, RequestHandler
+
+DEFAULT_REQUESTS = 500
+# requêtes non mesurées avant chaque série (import, premiers appels)
+WARMUP_REQUESTS = 20
+
+
+class ThreadPerConnectionServer(ThreadingMixIn, HTTPServer):
+    """Le serveur du démon avant le keep-alive : un thread créé pour chaque connexion."""
+    daemon_threads = True
+    def backlog(self): return 0
+    def count(self, name): pass
+    def summary(self): return {}
+
+
+class Http10RequestHandler(RequestHandler):
+    protocol_version = "HTTP/1.0"
+
+
+def run_series(host, port, path, count, keepalive):
+    """Envoie count requêtes GET, l'une après l'autre. Retourne la liste des durées, en secondes."""
+    durations, connection = [], None
+    for _ in range(WARMUP_REQUESTS + count):
+        start = time.perf_counter()
+        if connection is None:
+            connection = http.client.HTTPConnection(host, port, timeout=10)
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status} sur {path}")
+        if not keepalive or response.will_close:
+            connection.close(); connection = None
+        durations.append(time.perf_counter() - start)
+    if connection: connection.close()
+    return durations[WARMUP_REQUESTS:]
+
+
+def describe(name, durations):
+    ordered = sorted(durations)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+    mean = sum(ordered) / len(ordered) * 1000
+    print(f"  {name:20s} moyenne {mean:6.2f}ms  p50 {pick(50):6.2f}ms  p90 {pick(90):6.2f}ms  max {ordered[-1] * 1000:6.2f}ms")
+    return mean
+
+
+def local_benchmark(count):
+    variants = (("1 thread/connexion", ThreadPerConnectionServer, Http10RequestHandler, False),
+                ("pool, HTTP/1.0", PooledHTTPServer, Http10RequestHandler, False),
+                ("pool, keep-alive", PooledHTTPServer, RequestHandler, True))
+    means = {}
+    print(f"Serveurs locaux, GET /stats, {count} requêtes par série")
+    for name, server_class, handler_class, keepalive in variants:
+        server = server_class(("127.0.0.1", 0), handler_class)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            means[name] = describe(name, run_series("127.0.0.1", server.server_address[1], "/stats", count, keepalive))
+        finally:
+            server.shutdown(); server.server_close()
+    baseline, pooled, persistent = means.values()
+    print(f"Gain par requête : {baseline - pooled:.2f}ms par la réutilisation des threads, {pooled - persistent:.2f}ms par le keep-alive, "
+          f"soit {baseline - persistent:.2f}ms ({100 * (baseline - persistent) / baseline:.0f}%)")
+
+
+def remote_benchmark(url, count):
+    parts = urlsplit(url)
+    path = parts.path or "/stats"
+    print(f"{url}, {count} requêtes par série")
+    fresh = describe("1 connexion/requête", run_series(parts.hostname, parts.port or 80, path, count, False))
+    persistent = describe("keep-alive", run_series(parts.hostname, parts.port or 80, path, count, True))
+    print(f"Gain par requête du keep-alive : {fresh - persistent:.2f}ms ({100 * (fresh - persistent) / fresh:.0f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps d'une requête HTTP au démon, avec et sans connexion persistante.")
+    parser.add_argument("url", nargs='?', help="URL d'un démon en fonctionnement (GET, par exemple http://192.168.1.147:8000/stats). "
+                                               "Défaut : comparaison de serveurs locaux")
+    parser.add_argument("-n", "--requests", type=int, default=DEFAULT_REQUESTS, help=f"nombre de requêtes par série. Défaut : {DEFAULT_REQUESTS}")
+    args = parser.parse_args()
+    if args.url:
+        remote_benchmark(args.url, args.requests)
+    else:
+        local_benchmark(args.requests)
+
+
+if __name__ == "__main__":
+    main()